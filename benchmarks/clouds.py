@@ -0,0 +1,85 @@
+#
+#
+#      0=================================0
+#      |    Kernel Point Convolutions    |
+#      0=================================0
+#
+#
+# ----------------------------------------------------------------------------------------------------------------------
+#
+#      Synthetic point clouds used by the benchmarks
+#
+# ----------------------------------------------------------------------------------------------------------------------
+#
+
+# ----------------------------------------------------------------------------------------------------------------------
+#
+#           Imports and global variables
+#       \**********************************/
+#
+
+# Common libs
+import numpy as np
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+#
+#           Synthetic clouds
+#       \**********************/
+#
+
+
+def aerial_cloud(n, size, rng):
+    """Ground surface with a few roofs, as seen by an aerial scanner (2.5D)"""
+    xy = rng.random((n, 2)) * size
+    z = 0.5 * np.sin(xy[:, 0] / 7) + 0.3 * np.cos(xy[:, 1] / 5)
+    roofs = (np.floor(xy[:, 0] / 10) + np.floor(xy[:, 1] / 10)) % 3 == 0
+    z[roofs] += 6
+    return np.hstack((xy, z[:, None])).astype(np.float32)
+
+
+def indoor_cloud(n, size, rng, height=3.0):
+    """Room scanned from the inside: floor, ceiling, walls and a few boxes, denser around the scanner"""
+
+    # Floor and ceiling get half of the points, with a density decreasing away from the scanner (room center)
+    n_h = n // 2
+    r = size / 2 * np.sqrt(rng.random(n_h)) ** 1.5
+    theta = rng.random(n_h) * 2 * np.pi
+    xy = np.clip(size / 2 + np.stack((r * np.cos(theta), r * np.sin(theta)), axis=1), 0, size)
+    z = np.where(rng.random(n_h) < 0.6, 0.0, height)
+    horizontal = np.hstack((xy, z[:, None]))
+
+    # Walls
+    n_w = n // 4
+    t = rng.random(n_w) * size
+    wall = rng.integers(0, 4, n_w)
+    x = np.choose(wall, [t, t, np.zeros(n_w), np.full(n_w, size)])
+    y = np.choose(wall, [np.zeros(n_w), np.full(n_w, size), t, t])
+    walls = np.stack((x, y, rng.random(n_w) * height), axis=1)
+
+    # Furniture: points on the faces of boxes standing on the floor
+    n_b = n - n_h - n_w
+    n_boxes = 8
+    corners = rng.random((n_boxes, 2)) * (size - 1.5)
+    dims = np.hstack((0.5 + rng.random((n_boxes, 2)), 0.4 + rng.random((n_boxes, 1)) * 1.2))
+    box = rng.integers(0, n_boxes, n_b)
+    local = rng.random((n_b, 3))
+    face = rng.integers(0, 3, n_b)
+    local[np.arange(n_b), face] = np.round(local[np.arange(n_b), face])
+    furniture = np.hstack((corners[box], np.zeros((n_b, 1)))) + local * dims[box]
+
+    # Scanner noise
+    points = np.vstack((horizontal, walls, furniture))
+    points += rng.normal(scale=0.003, size=points.shape)
+    return points[rng.permutation(n)].astype(np.float32)
+
+
+def volumetric_cloud(n, size, rng):
+    """Points filling a cube (vegetation like)"""
+    return (rng.random((n, 3)) * size).astype(np.float32)
+
+
+# Cloud generator and side length (in meters) of each density profile
+PROFILES = {'aerial': (aerial_cloud, 60.0),
+            'indoor': (indoor_cloud, 8.0),
+            'volumetric': (volumetric_cloud, 12.0)}
@@ -0,0 +1,248 @@
+#
+#
+#      0=================================0
+#      |    Kernel Point Convolutions    |
+#      0=================================0
+#
+#
+# ----------------------------------------------------------------------------------------------------------------------
+#
+#      Microbenchmarks of the C++ wrappers (subsample, subsample_batch, batch_query and KDTree.query_radius)
+#
+# ----------------------------------------------------------------------------------------------------------------------
+#
+#      Usage:
+#          python benchmarks/native_kernels.py run -o before.json [--quick]
+#          (rebuild the wrappers)
+#          python benchmarks/native_kernels.py run -o after.json [--quick]
+#          python benchmarks/native_kernels.py compare before.json after.json
+#
+
+# ----------------------------------------------------------------------------------------------------------------------
+#
+#           Imports and global variables
+#       \**********************************/
+#
+
+# Common libs
+import os
+import sys
+import json
+import time
+import platform
+import argparse
+import subprocess
+import numpy as np
+from os.path import abspath, dirname
+
+sys.path.insert(0, dirname(dirname(abspath(__file__))))
+
+from cpp_wrappers.cpp_neighbors import radius_neighbors as cpp_neighbors
+from cpp_wrappers.cpp_subsampling import grid_subsampling as cpp_subsampling
+from benchmarks.clouds import PROFILES
+
+# Point counts, grid sizes and radii of each suite. Radii are given in number of grid cells, as conv_radius
+SUITES = {'full': {'points': [100000, 1000000], 'dls': [0.05, 0.2], 'radii': [2.5, 5.0], 'batch_size': 8,
+                   'batch_points': 60000, 'repeats': 5},
+          'quick': {'points': [100000], 'dls': [0.2], 'radii': [2.5], 'batch_size': 4,
+                    'batch_points': 30000, 'repeats': 3}}
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+#
+#           Utilities
+#       \***************/
+#
+
+
+def timed(fn, repeats):
+    """Median and minimum time of fn over repeats calls, after a warm up call. Also returns the last result"""
+    res = fn()
+    times = []
+    for _ in range(repeats):
+        t0 = time.perf_counter()
+        res = fn()
+        times.append(time.perf_counter() - t0)
+    return float(np.median(times)), float(np.min(times)), res
+
+
+def environment():
+    """Description of the build and of the machine, stored with the results"""
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=dirname(abspath(__file__)),
+                                capture_output=True, text=True).stdout.strip()
+    except OSError:
+        commit = ''
+    return {'commit': commit,
+            'date': time.strftime('%Y-%m-%d %H:%M:%S'),
+            'machine': platform.machine(),
+            'processor': platform.processor(),
+            'cpu_count': os.cpu_count(),
+            'python': platform.python_version(),
+            'numpy': np.__version__}
+
+
+def case_key(case):
+    """Identifier of a benchmark case, used to match the cases of two result files"""
+    return ' '.join('{:s}={}'.format(k, v) for k, v in sorted(case['params'].items()))
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+#
+#           Benchmarks
+#       \****************/
+#
+
+
+def run_suite(suite, thread_counts, profiles, seed=42):
+
+    results = []
+
+    def record(kernel, params, fn, size_fn):
+        median_t, min_t, res = timed(fn, suite['repeats'])
+        params = dict(params, kernel=kernel)
+        results.append({'params': params, 'median_s': median_t, 'min_s': min_t, 'output_size': size_fn(res)})
+        print('{:100s} {:10.2f}ms {:10.2f}ms {:10d}'.format(case_key(results[-1]), 1000 * median_t, 1000 * min_t,
+                                                          results[-1]['output_size']))
+
+    print('\n{:100s} {:>12s} {:>12s} {:>10s}'.format('case', 'median', 'min', 'output'))
+    for profile in profiles:
+        cloud_fn, size = PROFILES[profile]
+        for n in suite['points']:
+            rng = np.random.default_rng(seed)
+            points = cloud_fn(n, size, rng)
+            features = rng.random((n, 4)).astype(np.float32)
+            labels = rng.integers(0, 10, n).astype(np.int32)
+
+            for dl in suite['dls']:
+                for T in thread_counts:
+                    params = {'profile': profile, 'points': n, 'dl': dl, 'threads': T}
+
+                    # Single cloud subsampling, as when preparing a dataset
+                    record('subsample', params,
+                           lambda: cpp_subsampling.subsample(points, features=features, classes=labels, sampleDl=dl,
+                                                             num_threads=T),
+                           lambda res: res[0].shape[0])
+
+                    # Representative point indices
+                    record('subsample', dict(params, method='first'),
+                           lambda: cpp_subsampling.subsample(points, sampleDl=dl, method='first', num_threads=T),
+                           lambda res: res.shape[0])
+
+            # Input sphere extraction of the datasets, one radius query at a time
+            tree = cpp_neighbors.KDTree(points)
+            centers = points[rng.integers(0, n, 100)]
+            params = {'profile': profile, 'points': n, 'radius': size / 10, 'queries': len(centers)}
+            record('kdtree_query_radius', params,
+                   lambda: [tree.query_radius(center[None, :], r=size / 10)[0] for center in centers],
+                   lambda res: sum(inds.shape[0] for inds in res))
+
+        # Batch of input spheres, as in the input pipeline
+        B = suite['batch_size']
+        rng = np.random.default_rng(seed)
+        batch = np.vstack([cloud_fn(suite['batch_points'], size / 4, rng) for _ in range(B)])
+        lengths = np.full(B, suite['batch_points'], dtype=np.int32)
+        rotations = np.tile(np.eye(3, dtype=np.float32), (B, 1, 1))
+        for dl in suite['dls']:
+            for T in thread_counts:
+                params = {'profile': profile, 'points': batch.shape[0], 'batch': B, 'dl': dl, 'threads': T}
+                record('subsample_batch', params,
+                       lambda: cpp_subsampling.subsample_batch(batch, lengths, sampleDl=dl, rotations=rotations,
+                                                               num_threads=T),
+                       lambda res: res[0].shape[0])
+
+            # Neighbors of the first layer points (subsampled batch)
+            supports, s_lengths = cpp_subsampling.subsample_batch(batch, lengths, sampleDl=dl)
+            for radius in suite['radii']:
+                for backend in ['kdtree', 'grid']:
+                    for T in thread_counts:
+                        params = {'profile': profile, 'points': supports.shape[0], 'batch': B, 'dl': dl,
+                                  'radius': radius, 'backend': backend, 'threads': T}
+                        record('batch_query', params,
+                               lambda: cpp_neighbors.batch_query(supports, supports, s_lengths, s_lengths,
+                                                                 radius=radius * dl, num_threads=T, ragged=True,
+                                                                 backend=backend),
+                               lambda res: res[1].shape[0])
+
+    return results
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+#
+#           Comparison
+#       \****************/
+#
+
+
+def compare(before_file, after_file, threshold=0.05):
+    """Speedup of every case found in both files. Returns False if a case got slower than the threshold"""
+
+    with open(before_file, 'r') as f:
+        before = json.load(f)
+    with open(after_file, 'r') as f:
+        after = json.load(f)
+    print('\nbefore: {:s} ({:s})'.format(before['environment']['commit'], before['environment']['date']))
+    print('after:  {:s} ({:s})'.format(after['environment']['commit'], after['environment']['date']))
+
+    before_cases = {case_key(case): case for case in before['results']}
+    ok = True
+    print('\n{:100s} {:>12s} {:>12s} {:>8s}'.format('case', 'before', 'after', 'speedup'))
+    for case in after['results']:
+        key = case_key(case)
+        if key not in before_cases:
+            continue
+        old = before_cases[key]
+
+        # Medians are compared, changes below the threshold are noise
+        speedup = old['median_s'] / case['median_s']
+        flag = ''
+        if speedup < 1 - threshold:
+            flag = ' slower'
+            ok = False
+        elif speedup > 1 + threshold:
+            flag = ' faster'
+
+        # A different output size means that the result itself changed, not only its speed
+        if old['output_size'] != case['output_size']:
+            flag += ' (output size {:d} -> {:d})'.format(old['output_size'], case['output_size'])
+        print('{:100s} {:10.2f}ms {:10.2f}ms {:7.2f}x{:s}'.format(key, 1000 * old['median_s'],
+                                                                 1000 * case['median_s'], speedup, flag))
+
+    return ok
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+#
+#           Main Call
+#       \***************/
+#
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Microbenchmarks of the C++ wrappers')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    run_parser = commands.add_parser('run', help='time the wrappers and write the results to a JSON file')
+    run_parser.add_argument('-o', '--output', default='native_kernels.json')
+    run_parser.add_argument('--quick', action='store_true', help='smaller clouds and fewer cases')
+    run_parser.add_argument('--threads', type=int, nargs='+', default=sorted({1, os.cpu_count() or 1}),
+                            help='thread counts to time (0 for all the available cores)')
+    run_parser.add_argument('--profiles', nargs='+', default=['aerial', 'indoor'], choices=sorted(PROFILES))
+
+    compare_parser = commands.add_parser('compare', help='compare two result files')
+    compare_parser.add_argument('before')
+    compare_parser.add_argument('after')
+    compare_parser.add_argument('--threshold', type=float, default=0.05, help='relative change considered as noise')
+
+    args = parser.parse_args()
+
+    if args.command == 'run':
+        suite_name = 'quick' if args.quick else 'full'
+        results = run_suite(SUITES[suite_name], args.threads, args.profiles)
+        with open(args.output, 'w') as f:
+            json.dump({'environment': environment(), 'suite': suite_name, 'results': results}, f, indent=2)
+        print('\nResults written to {:s}'.format(args.output))
+
+    else:
+        sys.exit(0 if compare(args.before, args.after, args.threshold) else 1)
@@ -0,0 +1,96 @@
+#
+#
+#      0=================================0
+#      |    Kernel Point Convolutions    |
+#      0=================================0
+#
+#
+# ----------------------------------------------------------------------------------------------------------------------
+#
+#      Benchmark of the radius neighbors search engines (nanoflann KDTree vs voxel hash grid)
+#
+# ----------------------------------------------------------------------------------------------------------------------
+#
+#      Usage: python benchmarks/neighbors_backends.py
+#
+
+# ----------------------------------------------------------------------------------------------------------------------
+#
+#           Imports and global variables
+#       \**********************************/
+#
+
+# Common libs
+import sys
+import time
+import numpy as np
+from os.path import abspath, dirname
+
+sys.path.insert(0, dirname(dirname(abspath(__file__))))
+
+from cpp_wrappers.cpp_neighbors import radius_neighbors as cpp_neighbors
+from cpp_wrappers.cpp_subsampling import grid_subsampling as cpp_subsampling
+from benchmarks.clouds import PROFILES
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+#
+#           Utilities
+#       \***************/
+#
+
+
+def subsampled_batch(cloud_fn, n, size, dl, batch_size, rng):
+    """Batch of grid subsampled clouds, as the first layer of the network"""
+    clouds = [cpp_subsampling.subsample(cloud_fn(n, size, rng), sampleDl=dl) for _ in range(batch_size)]
+    points = np.vstack(clouds)
+    lengths = np.array([c.shape[0] for c in clouds], dtype=np.int32)
+    return points, lengths
+
+
+def timed(fn, repeats):
+    t0 = time.time()
+    for _ in range(repeats):
+        res = fn()
+    return (time.time() - t0) / repeats, res
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+#
+#           Main Call
+#       \***************/
+#
+
+
+if __name__ == '__main__':
+
+    rng = np.random.default_rng(42)
+    dl = 0.2
+    batch_size = 4
+    repeats = 3
+
+    print('\n{:12s} {:>9s} {:>7s} {:>9s} {:>11s} {:>11s} {:>11s} {:>8s}'.format('cloud', 'points', 'radius', 'avg_n',
+                                                                          'build_kd', 'query_kd', 'query_grid',
+                                                                          'speedup'))
+    for name in ['aerial', 'volumetric']:
+        cloud_fn, size = PROFILES[name]
+        for n in [50000, 200000]:
+            points, lengths = subsampled_batch(cloud_fn, n, size, dl, batch_size, rng)
+            for radius in [2.5 * dl, 5.0 * dl]:
+
+                # Index build and query with both backends (same neighbors, only the order of ties can differ). The
+                # ragged format is used so that the timings are not dominated by the padding of the output
+                build_kd, kd_index = timed(lambda: cpp_neighbors.BatchIndex(points, lengths), repeats)
+                query_kd, kd_neighbors = timed(lambda: cpp_neighbors.batch_query(points, points, lengths, lengths,
+                                                                                 radius=radius,
+                                                                                 ragged=True), repeats)
+                query_grid, grid_neighbors = timed(lambda: cpp_neighbors.batch_query(points, points, lengths, lengths,
+                                                                                     radius=radius,
+                                                                                     ragged=True,
+                                                                                     backend='grid'), repeats)
+                assert np.array_equal(kd_neighbors[0], grid_neighbors[0])
+                avg_n = kd_neighbors[1].shape[0] / points.shape[0]
+
+                print('{:12s} {:9d} {:7.2f} {:9.1f} {:9.1f}ms {:9.1f}ms {:9.1f}ms {:7.2f}x'.format(
+                    name, points.shape[0], radius, avg_n, 1000 * build_kd, 1000 * query_kd, 1000 * query_grid,
+                    query_kd / query_grid))
@@ -8,4 +8,9 @@ cd ..
 # Compile cpp neighbors
 cd cpp_neighbors
 python3 setup.py build_ext --inplace
-cd ..
\ No newline at end of file
+cd ..
+
+# Compile cpp pyramid
+cd cpp_pyramid
+python3 setup.py build_ext --inplace
+cd ..
@@ -208,54 +208,151 @@ void batch_ordered_neighbors(vector<PointXYZ>& queries,
 }
 
 
-void batch_nanoflann_neighbors(vector<PointXYZ>& queries,
-                                vector<PointXYZ>& supports,
-                                vector<int>& q_batches,
-                                vector<int>& s_batches,
-                                vector<int>& neighbors_indices,
-                                float radius)
+// Result set keeping the max_neighbors closest points within the radius (max-heap on the distances)
+class BoundedRadiusResultSet
 {
+public:
 
-	// Initialize variables
-	// ******************
+	float radius;
+	size_t capacity;
+	vector<pair<size_t, float>>& inds_dists;
 
-	// indices
-	int i0 = 0;
+	BoundedRadiusResultSet(float radius_, size_t capacity_, vector<pair<size_t, float>>& inds_dists_) :
+		radius(radius_), capacity(capacity_), inds_dists(inds_dists_)
+	{
+		inds_dists.clear();
+	}
 
-	// Square radius
-	float r2 = radius * radius;
+	static bool closer(const pair<size_t, float>& a, const pair<size_t, float>& b)
+	{
+		return a.second < b.second;
+	}
 
-	// Counting vector
-	int max_count = 0;
-	float d2;
-	vector<vector<pair<size_t, float>>> all_inds_dists(queries.size());
+	inline size_t size() const { return inds_dists.size(); }
 
-	// batch index
-	int b = 0;
-	int sum_qb = 0;
-	int sum_sb = 0;
+	inline bool full() const { return inds_dists.size() == capacity; }
+
+	inline bool addPoint(float dist, size_t index)
+	{
+		if (dist >= worstDist())
+			return true;
+
+		// The heap is only built once the set is full
+		if (full())
+		{
+			pop_heap(inds_dists.begin(), inds_dists.end(), closer);
+			inds_dists.back() = make_pair(index, dist);
+			push_heap(inds_dists.begin(), inds_dists.end(), closer);
+		}
+		else
+		{
+			inds_dists.push_back(make_pair(index, dist));
+			if (full())
+				make_heap(inds_dists.begin(), inds_dists.end(), closer);
+		}
+		return true;
+	}
+
+	inline float worstDist() const
+	{
+		// Once full, only points closer than the furthest kept neighbor are interesting
+		if (full())
+			return inds_dists.front().second;
+		return radius;
+	}
+
+	void sort()
+	{
+		if (full())
+			sort_heap(inds_dists.begin(), inds_dists.end(), closer);
+		else
+			std::sort(inds_dists.begin(), inds_dists.end(), closer);
+	}
+};
+
+
+// Order of the neighbors found in the voxel hash grid, which are not visited in any particular order
+static bool closer_then_smaller(const pair<size_t, float>& a, const pair<size_t, float>& b)
+{
+	return a.second < b.second || (a.second == b.second && a.first < b.first);
+}
+
+
+BatchNeighborsIndex::BatchNeighborsIndex(ArrayView<PointXYZ> supports,
+                                         ArrayView<int> s_batches,
+                                         int num_threads,
+                                         int backend,
+                                         float cell_size) : backend(backend)
+{
 
-	// Nanoflann related variables
-	// ***************************
+	// Number of batch elements
+	size_t Nb = s_batches.size();
 
-	// CLoud variable
-	PointCloud current_cloud;
+	// First support index of each batch element
+	n_supports = supports.size();
+	s_starts = vector<size_t>(Nb + 1, 0);
+	for (size_t b = 0; b < Nb; b++)
+		s_starts[b + 1] = s_starts[b] + s_batches[b];
+
+	// Voxel hash grids of all batch elements (independent so they are built in parallel)
+	if (backend == GRID_BACKEND)
+	{
+		grids = vector<VoxelHashGrid>(Nb);
+		parallel_for_each(Nb, num_threads, [&](size_t b)
+		{
+			grids[b].build(supports.data() + s_starts[b], s_starts[b + 1] - s_starts[b], cell_size);
+		});
+		return;
+	}
 
 	// Tree parameters
 	nanoflann::KDTreeSingleIndexAdaptorParams tree_params(10 /* max leaf */);
 
-	// KDTree type definition
-    typedef nanoflann::KDTreeSingleIndexAdaptor< nanoflann::L2_Simple_Adaptor<float, PointCloud > ,
-                                                        PointCloud,
-                                                        3 > my_kd_tree_t;
+	// One cloud and one tree per batch element (the trees keep a reference on the clouds, which are never resized)
+	clouds = vector<PointCloud>(Nb);
+	trees = vector<my_kd_tree_t*>(Nb, NULL);
+
+	// Build the KDTrees of all batch elements (independent so they are built in parallel)
+	parallel_for_each(Nb, num_threads, [&](size_t b)
+	{
+		clouds[b].pts = vector<PointXYZ>(supports.begin() + s_starts[b], supports.begin() + s_starts[b + 1]);
+		trees[b] = new my_kd_tree_t(3, clouds[b], tree_params);
+		trees[b]->buildIndex();
+	});
+}
+
+
+BatchNeighborsIndex::~BatchNeighborsIndex()
+{
+	for (auto& tree : trees)
+		delete tree;
+}
+
+
+void BatchNeighborsIndex::search(ArrayView<PointXYZ> queries,
+                                 ArrayView<int> q_batches,
+                                 vector<vector<pair<size_t, float>>>& all_inds_dists,
+                                 float radius,
+                                 int max_neighbors,
+                                 int num_threads) const
+{
+
+	// Initialize variables
+	// ******************
+
+	// Square radius
+	float r2 = radius * radius;
+
+	// Number of batch elements
+	size_t Nb = q_batches.size();
 
-    // Pointer to trees
-    my_kd_tree_t* index;
+	// First query index of each batch element
+	vector<size_t> q_starts(Nb + 1, 0);
+	for (size_t b = 0; b < Nb; b++)
+		q_starts[b + 1] = q_starts[b] + q_batches[b];
 
-    // Build KDTree for the first batch element
-    current_cloud.pts = vector<PointXYZ>(supports.begin() + sum_sb, supports.begin() + sum_sb + s_batches[b]);
-    index = new my_kd_tree_t(3, current_cloud, tree_params);
-    index->buildIndex();
+	// Neighbors of every query
+	all_inds_dists.resize(queries.size());
 
 
 	// Search neigbors indices
@@ -265,69 +362,282 @@ void batch_nanoflann_neighbors(vector<PointXYZ>& queries,
     nanoflann::SearchParams search_params;
     search_params.sorted = true;
 
-	for (auto& p0 : queries)
+	// Every thread handles a contiguous chunk of queries
+	parallel_for_chunks(queries.size(), num_threads, [&](int t, size_t i_begin, size_t i_end)
 	{
+		if (i_begin >= i_end)
+			return;
 
-	    // Check if we changed batch
-	    if (i0 == sum_qb + q_batches[b])
-	    {
-	        sum_qb += q_batches[b];
-	        sum_sb += s_batches[b];
-	        b++;
+		// Batch element of the first query in this chunk
+		size_t b = upper_bound(q_starts.begin(), q_starts.end(), i_begin) - q_starts.begin() - 1;
 
-	        // Change the points
-	        current_cloud.pts.clear();
-            current_cloud.pts = vector<PointXYZ>(supports.begin() + sum_sb, supports.begin() + sum_sb + s_batches[b]);
+		size_t max_count = 0;
+		for (size_t i0 = i_begin; i0 < i_end; i0++)
+		{
+			// Check if we changed batch (skip empty batch elements)
+			while (i0 >= q_starts[b + 1])
+				b++;
 
-	        // Build KDTree of the current element of the batch
-            delete index;
-            index = new my_kd_tree_t(3, current_cloud, tree_params);
-            index->buildIndex();
-	    }
+			// Initial guess of neighbors size
+			all_inds_dists[i0].reserve(max_count);
 
-	    // Initial guess of neighbors size
-        all_inds_dists[i0].reserve(max_count);
+			// Find neighbors (only the closest ones if a cap is given)
+			float query_pt[3] = { queries[i0].x, queries[i0].y, queries[i0].z};
+			size_t nMatches;
+			if (backend == GRID_BACKEND)
+			{
+				// Same result sets as nanoflann, sorted by distance then index so that the order is deterministic
+				if (max_neighbors > 0)
+				{
+					BoundedRadiusResultSet result_set(r2, (size_t)max_neighbors, all_inds_dists[i0]);
+					grids[b].find_neighbors(result_set, queries[i0], r2);
+				}
+				else
+				{
+					nanoflann::RadiusResultSet<float, size_t> result_set(r2, all_inds_dists[i0]);
+					grids[b].find_neighbors(result_set, queries[i0], r2);
+				}
+				sort(all_inds_dists[i0].begin(), all_inds_dists[i0].end(), closer_then_smaller);
+				nMatches = all_inds_dists[i0].size();
+			}
+			else if (max_neighbors > 0)
+			{
+				BoundedRadiusResultSet result_set(r2, (size_t)max_neighbors, all_inds_dists[i0]);
+				nMatches = trees[b]->radiusSearchCustomCallback(query_pt, result_set, search_params);
+				result_set.sort();
+			}
+			else
+				nMatches = trees[b]->radiusSearch(query_pt, r2, all_inds_dists[i0], search_params);
 
-	    // Find neighbors
-	    float query_pt[3] = { p0.x, p0.y, p0.z};
-		size_t nMatches = index->radiusSearch(query_pt, r2, all_inds_dists[i0], search_params);
+			// Indices in the stacked supports
+			for (auto& ind_dist : all_inds_dists[i0])
+				ind_dist.first += s_starts[b];
 
-        // Update max count
-        if (nMatches > max_count)
-            max_count = nMatches;
+			// Update max count
+			if (nMatches > max_count)
+				max_count = nMatches;
+		}
+	});
 
-        // Increment query idx
-		i0++;
+	return;
+}
+
+
+void BatchNeighborsIndex::query(ArrayView<PointXYZ> queries,
+                                ArrayView<int> q_batches,
+                                vector<int>& neighbors_indices,
+                                float radius,
+                                int max_neighbors,
+                                int num_threads) const
+{
+
+	// Search neighbors
+	int used_threads = resolve_num_threads(num_threads);
+	vector<vector<pair<size_t, float>>> all_inds_dists;
+	search(queries, q_batches, all_inds_dists, radius, max_neighbors, used_threads);
+
+	// Maximal number of neighbors
+	size_t max_count = 0;
+	for (auto& inds_dists : all_inds_dists)
+	{
+		if (inds_dists.size() > max_count)
+			max_count = inds_dists.size();
 	}
 
 	// Reserve the memory
 	neighbors_indices.resize(queries.size() * max_count);
-	i0 = 0;
-	sum_sb = 0;
-	sum_qb = 0;
-	b = 0;
-	for (auto& inds_dists : all_inds_dists)
+
+	// Fill the padded matrix, shadow neighbors point to the number of supports
+	parallel_for_chunks(queries.size(), used_threads, [&](int t, size_t i_begin, size_t i_end)
 	{
-	    // Check if we changed batch
-	    if (i0 == sum_qb + q_batches[b])
-	    {
-	        sum_qb += q_batches[b];
-	        sum_sb += s_batches[b];
-	        b++;
-	    }
+		for (size_t i0 = i_begin; i0 < i_end; i0++)
+		{
+			auto& inds_dists = all_inds_dists[i0];
+			for (size_t j = 0; j < max_count; j++)
+			{
+				if (j < inds_dists.size())
+					neighbors_indices[i0 * max_count + j] = inds_dists[j].first;
+				else
+					neighbors_indices[i0 * max_count + j] = n_supports;
+			}
+		}
+	});
 
-		for (int j = 0; j < max_count; j++)
+	return;
+}
+
+
+void BatchNeighborsIndex::query_ragged(ArrayView<PointXYZ> queries,
+                                       ArrayView<int> q_batches,
+                                       vector<int64_t>& neighbors_offsets,
+                                       vector<int>& neighbors_indices,
+                                       float radius,
+                                       int max_neighbors,
+                                       int num_threads) const
+{
+
+	// Search neighbors
+	int used_threads = resolve_num_threads(num_threads);
+	vector<vector<pair<size_t, float>>> all_inds_dists;
+	search(queries, q_batches, all_inds_dists, radius, max_neighbors, used_threads);
+
+	// Offsets of the neighbors of each query (CSR format)
+	neighbors_offsets.resize(queries.size() + 1);
+	neighbors_offsets[0] = 0;
+	for (size_t i0 = 0; i0 < queries.size(); i0++)
+		neighbors_offsets[i0 + 1] = neighbors_offsets[i0] + (int64_t)all_inds_dists[i0].size();
+
+	// Reserve the memory
+	neighbors_indices.resize(neighbors_offsets.back());
+
+	// Fill the flat indices, no shadow neighbors needed
+	parallel_for_chunks(queries.size(), used_threads, [&](int t, size_t i_begin, size_t i_end)
+	{
+		for (size_t i0 = i_begin; i0 < i_end; i0++)
 		{
-			if (j < inds_dists.size())
-				neighbors_indices[i0 * max_count + j] = inds_dists[j].first + sum_sb;
-			else
-				neighbors_indices[i0 * max_count + j] = supports.size();
+			int* dst = neighbors_indices.data() + neighbors_offsets[i0];
+			for (auto& ind_dist : all_inds_dists[i0])
+				*dst++ = (int)ind_dist.first;
 		}
-		i0++;
-	}
+	});
+
+	return;
+}
 
-	delete index;
 
+void batch_nanoflann_neighbors(ArrayView<PointXYZ> queries,
+                                ArrayView<PointXYZ> supports,
+                                ArrayView<int> q_batches,
+                                ArrayView<int> s_batches,
+                                vector<int>& neighbors_indices,
+                                float radius,
+                                int max_neighbors,
+                                int num_threads)
+{
+	BatchNeighborsIndex index(supports, s_batches, num_threads);
+	index.query(queries, q_batches, neighbors_indices, radius, max_neighbors, num_threads);
 	return;
 }
 
+
+void batch_nanoflann_neighbors_ragged(ArrayView<PointXYZ> queries,
+                                       ArrayView<PointXYZ> supports,
+                                       ArrayView<int> q_batches,
+                                       ArrayView<int> s_batches,
+                                       vector<int64_t>& neighbors_offsets,
+                                       vector<int>& neighbors_indices,
+                                       float radius,
+                                       int max_neighbors,
+                                       int num_threads)
+{
+	BatchNeighborsIndex index(supports, s_batches, num_threads);
+	index.query_ragged(queries, q_batches, neighbors_offsets, neighbors_indices, radius, max_neighbors, num_threads);
+	return;
+}
+
+
+template <class Cloud>
+ViewKDTree<Cloud>::ViewKDTree(Cloud cloud0, int leaf_size)
+{
+	cloud = cloud0;
+	nanoflann::KDTreeSingleIndexAdaptorParams tree_params(leaf_size);
+	tree = new tree_t(3, cloud, tree_params);
+	tree->buildIndex();
+}
+
+
+template <class Cloud>
+ViewKDTree<Cloud>::~ViewKDTree()
+{
+	delete tree;
+}
+
+
+template <class Cloud>
+void ViewKDTree<Cloud>::query_radius(ArrayView<PointXYZ> queries,
+                                     float radius,
+                                     vector<int64_t>& neighbors_offsets,
+                                     vector<int64_t>& neighbors_indices,
+                                     vector<float>& neighbors_sq_dists,
+                                     bool sort_results,
+                                     int num_threads) const
+{
+
+	// Search neighbors
+	// ****************
+
+	int used_threads = resolve_num_threads(num_threads);
+	float r2 = radius * radius;
+	nanoflann::SearchParams search_params;
+	search_params.sorted = sort_results;
+
+	vector<vector<pair<uint32_t, float>>> all_inds_dists(queries.size());
+	parallel_for_chunks(queries.size(), used_threads, [&](int t, size_t i_begin, size_t i_end)
+	{
+		for (size_t i0 = i_begin; i0 < i_end; i0++)
+		{
+			float query_pt[3] = { queries[i0].x, queries[i0].y, queries[i0].z };
+			tree->radiusSearch(query_pt, r2, all_inds_dists[i0], search_params);
+		}
+	});
+
+	// CSR outputs
+	// ***********
+
+	neighbors_offsets.resize(queries.size() + 1);
+	neighbors_offsets[0] = 0;
+	for (size_t i0 = 0; i0 < queries.size(); i0++)
+		neighbors_offsets[i0 + 1] = neighbors_offsets[i0] + (int64_t)all_inds_dists[i0].size();
+
+	neighbors_indices.resize(neighbors_offsets.back());
+	neighbors_sq_dists.resize(neighbors_offsets.back());
+	parallel_for_chunks(queries.size(), used_threads, [&](int t, size_t i_begin, size_t i_end)
+	{
+		for (size_t i0 = i_begin; i0 < i_end; i0++)
+		{
+			int64_t j = neighbors_offsets[i0];
+			for (auto& ind_dist : all_inds_dists[i0])
+			{
+				neighbors_indices[j] = (int64_t)ind_dist.first;
+				neighbors_sq_dists[j++] = ind_dist.second;
+			}
+		}
+	});
+
+	return;
+}
+
+
+template <class Cloud>
+void ViewKDTree<Cloud>::query_knn(ArrayView<PointXYZ> queries,
+                                  size_t k,
+                                  vector<int64_t>& neighbors_indices,
+                                  vector<float>& neighbors_sq_dists,
+                                  int num_threads) const
+{
+	neighbors_indices.resize(queries.size() * k);
+	neighbors_sq_dists.resize(queries.size() * k);
+
+	// Every query fills its own row
+	parallel_for_chunks(queries.size(), num_threads, [&](int t, size_t i_begin, size_t i_end)
+	{
+		vector<uint32_t> inds(k);
+		for (size_t i0 = i_begin; i0 < i_end; i0++)
+		{
+			float query_pt[3] = { queries[i0].x, queries[i0].y, queries[i0].z };
+			size_t n_found = tree->knnSearch(query_pt, k, inds.data(), neighbors_sq_dists.data() + i0 * k);
+			for (size_t j = 0; j < n_found; j++)
+				neighbors_indices[i0 * k + j] = (int64_t)inds[j];
+		}
+	});
+
+	return;
+}
+
+
+// Supported storages of the cloud points: float32 points and integer coordinates of 16 or 32 bits
+template class ViewKDTree<PointCloudView>;
+template class ViewKDTree<QuantizedCloudView<int16_t>>;
+template class ViewKDTree<QuantizedCloudView<uint16_t>>;
+template class ViewKDTree<QuantizedCloudView<int32_t>>;
+template class ViewKDTree<QuantizedCloudView<uint32_t>>;
@@ -1,7 +1,11 @@
 
 
+# pragma once
+
 #include "../../cpp_utils/cloud/cloud.h"
 #include "../../cpp_utils/nanoflann/nanoflann.hpp"
+#include "../../cpp_utils/parallel/parallel.h"
+#include "voxel_hash.h"
 
 #include <set>
 #include <cstdint>
@@ -21,9 +25,202 @@ void batch_ordered_neighbors(vector<PointXYZ>& queries,
                                 vector<int>& neighbors_indices,
                                 float radius);
 
-void batch_nanoflann_neighbors(vector<PointXYZ>& queries,
-                                vector<PointXYZ>& supports,
-                                vector<int>& q_batches,
-                                vector<int>& s_batches,
+// KDTree type definition
+typedef nanoflann::KDTreeSingleIndexAdaptor< nanoflann::L2_Simple_Adaptor<float, PointCloud > ,
+                                             PointCloud,
+                                             3 > my_kd_tree_t;
+
+
+// Search engines of the neighbors index
+enum NeighborsBackend
+{
+	KDTREE_BACKEND = 0,
+	GRID_BACKEND = 1
+};
+
+
+// Persistent index on a batch of stacked support points: one KDTree (or one voxel hash grid) per batch element,
+// built once and reused by every query against these supports
+class BatchNeighborsIndex
+{
+public:
+
+	// Number of supports, first support index and tree (or grid) of each batch element
+	size_t n_supports;
+	vector<size_t> s_starts;
+	int backend;
+	vector<PointCloud> clouds;
+	vector<my_kd_tree_t*> trees;
+	vector<VoxelHashGrid> grids;
+
+	// The grid backend needs a cell size, ideally close to the radius of the queries
+	BatchNeighborsIndex(ArrayView<PointXYZ> supports,
+	                    ArrayView<int> s_batches,
+	                    int num_threads = 1,
+	                    int backend = KDTREE_BACKEND,
+	                    float cell_size = 0);
+	~BatchNeighborsIndex();
+
+	BatchNeighborsIndex(const BatchNeighborsIndex&) = delete;
+	BatchNeighborsIndex& operator=(const BatchNeighborsIndex&) = delete;
+
+	// Number of batch elements
+	size_t num_batches() const { return s_starts.size() - 1; }
+
+	// Sorted neighbors (global support indices and square distances) of every query
+	void search(ArrayView<PointXYZ> queries,
+	            ArrayView<int> q_batches,
+	            vector<vector<pair<size_t, float>>>& all_inds_dists,
+	            float radius,
+	            int max_neighbors,
+	            int num_threads) const;
+
+	// Neighbors as a padded matrix, shadow neighbors point to n_supports
+	void query(ArrayView<PointXYZ> queries,
+	           ArrayView<int> q_batches,
+	           vector<int>& neighbors_indices,
+	           float radius,
+	           int max_neighbors = 0,
+	           int num_threads = 1) const;
+
+	// Neighbors in CSR format
+	void query_ragged(ArrayView<PointXYZ> queries,
+	                  ArrayView<int> q_batches,
+	                  vector<int64_t>& neighbors_offsets,
+	                  vector<int>& neighbors_indices,
+	                  float radius,
+	                  int max_neighbors = 0,
+	                  int num_threads = 1) const;
+};
+
+
+// Dataset adaptor reading the points in place (e.g. in a numpy buffer kept alive by the caller), without copy
+struct PointCloudView
+{
+	ArrayView<PointXYZ> pts;
+
+	inline size_t kdtree_get_point_count() const { return pts.size(); }
+
+	inline float kdtree_get_pt(const size_t idx, const size_t dim) const
+	{
+		if (dim == 0) return pts[idx].x;
+		else if (dim == 1) return pts[idx].y;
+		else return pts[idx].z;
+	}
+
+	template <class BBOX>
+	bool kdtree_get_bbox(BBOX& /* bb */) const { return false; }
+};
+
+// Dataset adaptor reading integer coordinates in place and dequantizing them on the fly: point i is
+// scale * (coords[3i], coords[3i + 1], coords[3i + 2]), e.g. from a memory mapped cache, without a float copy
+template <class T>
+struct QuantizedCloudView
+{
+	ArrayView<T> coords;
+	float scale;
+
+	QuantizedCloudView() : scale(1) {}
+	QuantizedCloudView(ArrayView<T> coords0, float scale0) : coords(coords0), scale(scale0) {}
+
+	inline size_t kdtree_get_point_count() const { return coords.size() / 3; }
+
+	inline float kdtree_get_pt(const size_t idx, const size_t dim) const
+	{
+		return scale * (float)coords[3 * idx + dim];
+	}
+
+	template <class BBOX>
+	bool kdtree_get_bbox(BBOX& /* bb */) const { return false; }
+};
+
+
+// KDTree on the points of a whole cloud, which are not copied: the tree only holds a permutation of the point
+// indices and its nodes. Answers the radius and k nearest neighbors queries of the datasets, whatever the storage of
+// the points (see ViewKDTree)
+class CloudKDTree
+{
+public:
+
+	virtual ~CloudKDTree() {}
+
+	// Number of points
+	virtual size_t size() const = 0;
+
+	// Neighbors of every query within the radius in CSR format, with their square distances (sorted by distance if
+	// sort_results, in tree order otherwise)
+	virtual void query_radius(ArrayView<PointXYZ> queries,
+	                          float radius,
+	                          vector<int64_t>& neighbors_offsets,
+	                          vector<int64_t>& neighbors_indices,
+	                          vector<float>& neighbors_sq_dists,
+	                          bool sort_results = false,
+	                          int num_threads = 1) const = 0;
+
+	// k nearest neighbors of every query as (Nq, k) matrices sorted by distance, with their square distances
+	virtual void query_knn(ArrayView<PointXYZ> queries,
+	                       size_t k,
+	                       vector<int64_t>& neighbors_indices,
+	                       vector<float>& neighbors_sq_dists,
+	                       int num_threads = 1) const = 0;
+};
+
+
+// CloudKDTree on points read in place by a dataset adaptor (PointCloudView for float32 points, QuantizedCloudView for
+// integer coordinates), with 32 bits indices. Instantiated in neighbors.cpp for the supported adaptors
+template <class Cloud>
+class ViewKDTree : public CloudKDTree
+{
+public:
+
+	typedef nanoflann::KDTreeSingleIndexAdaptor< nanoflann::L2_Simple_Adaptor<float, Cloud > ,
+	                                             Cloud,
+	                                             3,
+	                                             uint32_t > tree_t;
+
+	Cloud cloud;
+	tree_t* tree;
+
+	// The points must outlive the tree
+	ViewKDTree(Cloud cloud0, int leaf_size = 10);
+	~ViewKDTree();
+
+	ViewKDTree(const ViewKDTree&) = delete;
+	ViewKDTree& operator=(const ViewKDTree&) = delete;
+
+	size_t size() const { return cloud.kdtree_get_point_count(); }
+
+	void query_radius(ArrayView<PointXYZ> queries,
+	                  float radius,
+	                  vector<int64_t>& neighbors_offsets,
+	                  vector<int64_t>& neighbors_indices,
+	                  vector<float>& neighbors_sq_dists,
+	                  bool sort_results = false,
+	                  int num_threads = 1) const;
+
+	void query_knn(ArrayView<PointXYZ> queries,
+	               size_t k,
+	               vector<int64_t>& neighbors_indices,
+	               vector<float>& neighbors_sq_dists,
+	               int num_threads = 1) const;
+};
+
+
+void batch_nanoflann_neighbors(ArrayView<PointXYZ> queries,
+                                ArrayView<PointXYZ> supports,
+                                ArrayView<int> q_batches,
+                                ArrayView<int> s_batches,
                                 vector<int>& neighbors_indices,
-                                float radius);
+                                float radius,
+                                int max_neighbors = 0,
+                                int num_threads = 1);
+
+void batch_nanoflann_neighbors_ragged(ArrayView<PointXYZ> queries,
+                                       ArrayView<PointXYZ> supports,
+                                       ArrayView<int> q_batches,
+                                       ArrayView<int> s_batches,
+                                       vector<int64_t>& neighbors_offsets,
+                                       vector<int>& neighbors_indices,
+                                       float radius,
+                                       int max_neighbors = 0,
+                                       int num_threads = 1);
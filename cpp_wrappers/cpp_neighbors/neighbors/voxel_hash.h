@@ -0,0 +1,234 @@
+//
+//
+//		0==========================0
+//		|    Local feature test    |
+//		0==========================0
+//
+//		version 1.0 :
+//			>
+//
+//---------------------------------------------------
+//
+//		Voxel hash header
+//		Uniform grid of buckets for fixed radius neighbors queries
+//
+//----------------------------------------------------
+//
+
+
+# pragma once
+
+#include "../../cpp_utils/cloud/cloud.h"
+
+#include <cstdint>
+#include <unordered_map>
+
+
+// Voxel hash grid
+// ***************
+
+// Points are sorted by voxel and each occupied voxel stores the range of its points. A radius query scans the voxels
+// overlapping the ball and computes the same square distances as nanoflann (L2_Simple_Adaptor), so both engines
+// return the same neighbors. When the bounding box holds few enough voxels (always the case for the input spheres
+// and clouds of the datasets), the voxels are stored in a dense table filled by counting sort instead of a hash map,
+// and the voxels of a column along z are scanned as a single run of points.
+class VoxelHashGrid
+{
+public:
+
+	// Elements
+	// ********
+
+	float cell_size;
+	PointXYZ origin;
+
+	// Number of voxels along each axis of the bounding box
+	int64_t nx, ny, nz;
+
+	// Points sorted by voxel, with their original index
+	std::vector<PointXYZ> points;
+	std::vector<uint32_t> point_inds;
+
+	// Dense table: first point of each voxel of the bounding box (size nx * ny * nz + 1, empty if hashed)
+	std::vector<uint32_t> voxel_starts;
+
+	// Hash map: range [first, last) of the points of each occupied voxel
+	std::unordered_map<uint64_t, std::pair<uint32_t, uint32_t>> voxels;
+
+
+	// Methods
+	// *******
+
+	VoxelHashGrid() : cell_size(1), nx(0), ny(0), nz(0) {}
+
+	// 21 bits per voxel coordinate, relative to the origin
+	static inline uint64_t voxel_key(int64_t vx, int64_t vy, int64_t vz)
+	{
+		return ((uint64_t)vx << 42) | ((uint64_t)vy << 21) | (uint64_t)vz;
+	}
+
+	inline bool dense() const { return !voxel_starts.empty(); }
+
+	void build(const PointXYZ* pts, size_t n, float cell_size0)
+	{
+		cell_size = cell_size0;
+		points.clear();
+		point_inds.clear();
+		voxel_starts.clear();
+		voxels.clear();
+		nx = ny = nz = 0;
+		if (n == 0)
+			return;
+
+		// Bounding box of the points
+		origin = pts[0];
+		PointXYZ corner = pts[0];
+		for (size_t i = 1; i < n; i++)
+		{
+			origin.x = std::min(origin.x, pts[i].x);
+			origin.y = std::min(origin.y, pts[i].y);
+			origin.z = std::min(origin.z, pts[i].z);
+			corner.x = std::max(corner.x, pts[i].x);
+			corner.y = std::max(corner.y, pts[i].y);
+			corner.z = std::max(corner.z, pts[i].z);
+		}
+
+		// Voxel coordinates of every point
+		float inv_size = 1 / cell_size;
+		std::vector<int64_t> coords(3 * n);
+		for (size_t i = 0; i < n; i++)
+		{
+			coords[3 * i + 0] = (int64_t)std::floor((pts[i].x - origin.x) * inv_size);
+			coords[3 * i + 1] = (int64_t)std::floor((pts[i].y - origin.y) * inv_size);
+			coords[3 * i + 2] = (int64_t)std::floor((pts[i].z - origin.z) * inv_size);
+			nx = std::max(nx, coords[3 * i + 0] + 1);
+			ny = std::max(ny, coords[3 * i + 1] + 1);
+			nz = std::max(nz, coords[3 * i + 2] + 1);
+		}
+
+		points.resize(n);
+		point_inds.resize(n);
+
+		// Dense table if it is not much larger than the cloud
+		double n_voxels = (double)nx * (double)ny * (double)nz;
+		if (n_voxels <= std::max(8.0 * n, 65536.0))
+		{
+			// Counting sort of the points by voxel
+			voxel_starts = std::vector<uint32_t>((size_t)n_voxels + 1, 0);
+			std::vector<uint32_t> voxel_inds(n);
+			for (size_t i = 0; i < n; i++)
+			{
+				voxel_inds[i] = (uint32_t)((coords[3 * i] * ny + coords[3 * i + 1]) * nz + coords[3 * i + 2]);
+				voxel_starts[voxel_inds[i] + 1]++;
+			}
+			for (size_t v = 1; v < voxel_starts.size(); v++)
+				voxel_starts[v] += voxel_starts[v - 1];
+			std::vector<uint32_t> fill(voxel_starts.begin(), voxel_starts.end() - 1);
+			for (size_t i = 0; i < n; i++)
+			{
+				uint32_t j = fill[voxel_inds[i]]++;
+				points[j] = pts[i];
+				point_inds[j] = (uint32_t)i;
+			}
+			return;
+		}
+
+		// Otherwise, sort points by voxel key and hash the runs
+		std::vector<std::pair<uint64_t, uint32_t>> keys(n);
+		for (size_t i = 0; i < n; i++)
+			keys[i] = std::make_pair(voxel_key(coords[3 * i], coords[3 * i + 1], coords[3 * i + 2]), (uint32_t)i);
+		std::sort(keys.begin(), keys.end());
+		voxels.reserve(n / 4 + 1);
+		size_t first = 0;
+		for (size_t i = 0; i < n; i++)
+		{
+			points[i] = pts[keys[i].second];
+			point_inds[i] = keys[i].second;
+			if (i + 1 == n || keys[i + 1].first != keys[i].first)
+			{
+				voxels[keys[i].first] = std::make_pair((uint32_t)first, (uint32_t)(i + 1));
+				first = i + 1;
+			}
+		}
+	}
+
+	// Add all the points closer than sqrt(r2) to the result set (same interface as the nanoflann result sets)
+	template <class RESULTSET>
+	void find_neighbors(RESULTSET& result, const PointXYZ& q, float r2) const
+	{
+		if (points.empty())
+			return;
+
+		// Voxel of the query and number of voxels to scan around it
+		float inv_size = 1 / cell_size;
+		int64_t qx = (int64_t)std::floor((q.x - origin.x) * inv_size);
+		int64_t qy = (int64_t)std::floor((q.y - origin.y) * inv_size);
+		int64_t qz = (int64_t)std::floor((q.z - origin.z) * inv_size);
+		int64_t k = (int64_t)std::ceil(std::sqrt(r2) * inv_size);
+
+		// Only the voxels inside the bounding box can contain points
+		int64_t x0 = std::max(qx - k, (int64_t)0), x1 = std::min(qx + k, nx - 1);
+		int64_t y0 = std::max(qy - k, (int64_t)0), y1 = std::min(qy + k, ny - 1);
+		int64_t z0 = std::max(qz - k, (int64_t)0), z1 = std::min(qz + k, nz - 1);
+
+		for (int64_t vx = x0; vx <= x1; vx++)
+		{
+			float dx = voxel_gap(q.x, origin.x, vx);
+			for (int64_t vy = y0; vy <= y1; vy++)
+			{
+				// Skip the columns that cannot contain neighbors
+				float dy = voxel_gap(q.y, origin.y, vy);
+				if (dx * dx + dy * dy >= r2)
+					continue;
+
+				// The voxels of a column are contiguous in the dense table
+				if (dense())
+				{
+					int64_t column = (vx * ny + vy) * nz;
+					scan_points(result, q, r2, voxel_starts[column + z0], voxel_starts[column + z1 + 1]);
+					continue;
+				}
+
+				for (int64_t vz = z0; vz <= z1; vz++)
+				{
+					float dz = voxel_gap(q.z, origin.z, vz);
+					if (dx * dx + dy * dy + dz * dz >= r2)
+						continue;
+
+					auto it = voxels.find(voxel_key(vx, vy, vz));
+					if (it != voxels.end())
+						scan_points(result, q, r2, it->second.first, it->second.second);
+				}
+			}
+		}
+	}
+
+private:
+
+	// Scan a run of sorted points
+	template <class RESULTSET>
+	inline void scan_points(RESULTSET& result, const PointXYZ& q, float r2, uint32_t first, uint32_t last) const
+	{
+		for (uint32_t j = first; j < last; j++)
+		{
+			float d0 = q.x - points[j].x;
+			float d1 = q.y - points[j].y;
+			float d2 = q.z - points[j].z;
+			float dist = d0 * d0 + d1 * d1 + d2 * d2;
+			if (dist < result.worstDist())
+				result.addPoint(dist, (size_t)point_inds[j]);
+		}
+	}
+
+	// Distance between a coordinate and a voxel slab along one axis (0 inside)
+	inline float voxel_gap(float q, float o, int64_t v) const
+	{
+		float lo = o + v * cell_size;
+		float hi = lo + cell_size;
+		if (q < lo)
+			return lo - q;
+		if (q > hi)
+			return q - hi;
+		return 0;
+	}
+};
@@ -14,7 +14,9 @@ SOURCES = ["../cpp_utils/cloud/cloud.cpp",
 module = Extension(name="radius_neighbors",
                     sources=SOURCES,
                     extra_compile_args=['-std=c++11',
-                                        '-D_GLIBCXX_USE_CXX11_ABI=0'])
+                                        '-D_GLIBCXX_USE_CXX11_ABI=0',
+                                        '-pthread'],
+                    extra_link_args=['-pthread'])
 
 
 setup(ext_modules=[module], include_dirs=numpy.distutils.misc_util.get_numpy_include_dirs())
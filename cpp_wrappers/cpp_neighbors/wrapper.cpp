@@ -1,6 +1,7 @@
 #include <Python.h>
 #include <numpy/arrayobject.h>
 #include "neighbors/neighbors.h"
+#include "../cpp_utils/numpy/numpy_vector.h"
 #include <string>
 
 
@@ -8,9 +9,40 @@
 // docstrings for our module
 // *************************
 
-static char module_docstring[] = "This module provides two methods to compute radius neighbors from pointclouds or batch of pointclouds";
+static char module_docstring[] = "This module provides methods and persistent indices (batch index and float32 KDTree) to compute radius neighbors from pointclouds or batch of pointclouds";
 
-static char batch_query_docstring[] = "Method to get radius neighbors in a batch of stacked pointclouds";
+static char batch_index_docstring[] = "BatchIndex(supports, s_batches, num_threads=1, backend='kdtree', cell_size=0): KDTrees "
+									 "(or voxel hash grids of the given cell_size with backend='grid') built once on each batch "
+									 "element of stacked support points, reused by every query against these supports";
+
+static char batch_index_query_docstring[] = "Method to get radius neighbors of a batch of stacked queries in the indexed supports. "
+										   "Same keywords and outputs as batch_query";
+
+static char kdtree_docstring[] = "KDTree(points, leaf_size=10, scale=1.0): float32 nanoflann KDTree on the (N, 3) points of a cloud, "
+								"drop-in replacement of sklearn.neighbors.KDTree for the datasets. The points are kept as a numpy "
+								"array (the data attribute) and read in place, contiguous inputs (e.g. memory mapped arrays) are not "
+								"copied. Float points are used as float32, int16, uint16, int32 and uint32 points are quantized "
+								"coordinates, dequantized as scale * data on the fly by the tree (the queries and results are in "
+								"dequantized units). Pickled as its points and scale and rebuilt when unpickled";
+
+static char kdtree_query_radius_docstring[] = "query_radius(X, r, return_distance=False, sort_results=False, num_threads=1): "
+											 "neighbors of each point of X within the radius r, as an object array of int64 index "
+											 "arrays (and an object array of float32 distances with return_distance=True), like "
+											 "sklearn. With sort_results=True, the neighbors are sorted by distance. "
+											 "The queries are split over num_threads threads (0 for all the available cores)";
+
+static char kdtree_query_docstring[] = "query(X, k=1, return_distance=True, num_threads=1): k nearest neighbors of each point of X, "
+									  "sorted by distance. Returns (distances, indices) as (M, k) float32 and int64 matrices, or "
+									  "only the indices with return_distance=False, like sklearn";
+
+static char batch_query_docstring[] = "Method to get radius neighbors in a batch of stacked pointclouds. "
+									 "With max_neighbors > 0, only the max_neighbors closest neighbors within the radius are kept. "
+									 "The queries are split over num_threads threads (0 for all the available cores). "
+									 "backend='kdtree' uses nanoflann KDTrees, backend='grid' uses voxel hash grids with a cell size of "
+									 "radius, which return the same neighbors. "
+									 "By default, returns a (N, max_count) matrix padded with shadow indices. "
+									 "With ragged=True, returns a tuple (offsets, indices) in CSR format: the neighbors "
+									 "of query i are indices[offsets[i]:offsets[i + 1]]";
 
 
 // Declare the functions
@@ -19,6 +51,133 @@ static char batch_query_docstring[] = "Method to get radius neighbors in a batch
 static PyObject *batch_neighbors(PyObject *self, PyObject *args, PyObject *keywds);
 
 
+// Declare the BatchIndex type
+// ***************************
+
+typedef struct
+{
+	PyObject_HEAD
+	BatchNeighborsIndex* index;
+} BatchIndexObject;
+
+static void BatchIndex_dealloc(BatchIndexObject* self);
+static int BatchIndex_init(BatchIndexObject* self, PyObject* args, PyObject* keywds);
+static PyObject* BatchIndex_query(BatchIndexObject* self, PyObject* args, PyObject* keywds);
+
+static PyMethodDef BatchIndex_methods[] =
+{
+	{ "query", (PyCFunction)BatchIndex_query, METH_VARARGS | METH_KEYWORDS, batch_index_query_docstring },
+	{NULL, NULL, 0, NULL}
+};
+
+static PyTypeObject BatchIndexType =
+{
+	PyVarObject_HEAD_INIT(NULL, 0)
+	"radius_neighbors.BatchIndex",	// tp_name
+};
+
+
+// Declare the KDTree type
+// ************************
+
+typedef struct
+{
+	PyObject_HEAD
+	CloudKDTree* tree;
+	PyObject* data;
+	int leaf_size;
+	float scale;
+} KDTreeObject;
+
+static void KDTree_dealloc(KDTreeObject* self);
+static int KDTree_init(KDTreeObject* self, PyObject* args, PyObject* keywds);
+static PyObject* KDTree_query_radius(KDTreeObject* self, PyObject* args, PyObject* keywds);
+static PyObject* KDTree_query(KDTreeObject* self, PyObject* args, PyObject* keywds);
+static PyObject* KDTree_reduce(KDTreeObject* self, PyObject* unused);
+static PyObject* KDTree_get_data(KDTreeObject* self, void* closure);
+static PyObject* KDTree_get_scale(KDTreeObject* self, void* closure);
+
+static PyMethodDef KDTree_methods[] =
+{
+	{ "query_radius", (PyCFunction)KDTree_query_radius, METH_VARARGS | METH_KEYWORDS, kdtree_query_radius_docstring },
+	{ "query", (PyCFunction)KDTree_query, METH_VARARGS | METH_KEYWORDS, kdtree_query_docstring },
+	{ "__reduce__", (PyCFunction)KDTree_reduce, METH_NOARGS, NULL },
+	{NULL, NULL, 0, NULL}
+};
+
+static PyGetSetDef KDTree_getset[] =
+{
+	{ (char*)"data", (getter)KDTree_get_data, NULL, (char*)"(N, 3) points of the tree (float32 or quantized)", NULL },
+	{ (char*)"scale", (getter)KDTree_get_scale, NULL, (char*)"step of the quantized points (1.0 for float32 points)", NULL },
+	{NULL, NULL, NULL, NULL, NULL}
+};
+
+// Full module path in the name, so that pickle finds the type (the datasets import it from the repository root)
+static PyTypeObject KDTreeType =
+{
+	PyVarObject_HEAD_INIT(NULL, 0)
+	"cpp_wrappers.cpp_neighbors.radius_neighbors.KDTree",	// tp_name
+};
+
+
+// Search engine from its name
+// ***************************
+
+static bool parse_backend(const char* backend_name, int& backend)
+{
+	if (strcmp(backend_name, "kdtree") == 0)
+		backend = KDTREE_BACKEND;
+	else if (strcmp(backend_name, "grid") == 0)
+		backend = GRID_BACKEND;
+	else
+	{
+		PyErr_SetString(PyExc_ValueError, "Unknown neighbors backend, use 'kdtree' or 'grid'");
+		return false;
+	}
+	return true;
+}
+
+
+// Convert the neighbors to numpy: a padded (Nq, max_count) matrix or a tuple (offsets, indices)
+// ******************************
+
+static PyObject* neighbors_to_numpy(vector<int64_t>& neighbors_offsets, vector<int>& neighbors_indices, int Nq, int ragged)
+{
+	if (ragged)
+	{
+		// Dimension of output containers
+		npy_intp offsets_dims[1] = { (npy_intp)neighbors_offsets.size() };
+		npy_intp indices_dims[1] = { (npy_intp)neighbors_indices.size() };
+
+		// The output arrays take over the memory of the results (no copy)
+		PyObject* offsets_obj = vector_to_numpy(neighbors_offsets, 1, offsets_dims, NPY_INT64);
+		PyObject* indices_obj = vector_to_numpy(neighbors_indices, 1, indices_dims, NPY_INT);
+
+		// Merge results
+		return Py_BuildValue("NN", offsets_obj, indices_obj);
+	}
+
+	// Check result
+	if (neighbors_indices.size() < 1)
+	{
+		PyErr_SetString(PyExc_RuntimeError, "Error");
+		return NULL;
+	}
+
+	// Maximal number of neighbors
+	int max_count = neighbors_indices.size() / Nq;
+
+	// Dimension of output containers
+	npy_intp neighbors_dims[2] = { Nq, max_count };
+
+	// The output array takes over the memory of the results (no copy)
+	PyObject* res_obj = vector_to_numpy(neighbors_indices, 2, neighbors_dims, NPY_INT);
+
+	// Merge results
+	return Py_BuildValue("N", res_obj);
+}
+
+
 // Specify the members of the module
 // *********************************
 
@@ -48,7 +207,51 @@ static struct PyModuleDef moduledef =
 PyMODINIT_FUNC PyInit_radius_neighbors(void)
 {
     import_array();
-	return PyModule_Create(&moduledef);
+
+	// Finish the definition of the BatchIndex type
+	BatchIndexType.tp_basicsize = sizeof(BatchIndexObject);
+	BatchIndexType.tp_flags = Py_TPFLAGS_DEFAULT;
+	BatchIndexType.tp_doc = batch_index_docstring;
+	BatchIndexType.tp_new = PyType_GenericNew;
+	BatchIndexType.tp_init = (initproc)BatchIndex_init;
+	BatchIndexType.tp_dealloc = (destructor)BatchIndex_dealloc;
+	BatchIndexType.tp_methods = BatchIndex_methods;
+	if (PyType_Ready(&BatchIndexType) < 0)
+		return NULL;
+
+	// Finish the definition of the KDTree type
+	KDTreeType.tp_basicsize = sizeof(KDTreeObject);
+	KDTreeType.tp_flags = Py_TPFLAGS_DEFAULT;
+	KDTreeType.tp_doc = kdtree_docstring;
+	KDTreeType.tp_new = PyType_GenericNew;
+	KDTreeType.tp_init = (initproc)KDTree_init;
+	KDTreeType.tp_dealloc = (destructor)KDTree_dealloc;
+	KDTreeType.tp_methods = KDTree_methods;
+	KDTreeType.tp_getset = KDTree_getset;
+	if (PyType_Ready(&KDTreeType) < 0)
+		return NULL;
+
+	PyObject* module = PyModule_Create(&moduledef);
+	if (module == NULL)
+		return NULL;
+
+	Py_INCREF(&BatchIndexType);
+	if (PyModule_AddObject(module, "BatchIndex", (PyObject*)&BatchIndexType) < 0)
+	{
+		Py_DECREF(&BatchIndexType);
+		Py_DECREF(module);
+		return NULL;
+	}
+
+	Py_INCREF(&KDTreeType);
+	if (PyModule_AddObject(module, "KDTree", (PyObject*)&KDTreeType) < 0)
+	{
+		Py_DECREF(&KDTreeType);
+		Py_DECREF(module);
+		return NULL;
+	}
+
+	return module;
 }
 
 
@@ -68,15 +271,22 @@ static PyObject* batch_neighbors(PyObject* self, PyObject* args, PyObject* keywd
 	PyObject* s_batches_obj = NULL;
 
 	// Keywords containers
-	static char* kwlist[] = { "queries", "supports", "q_batches", "s_batches", "radius", NULL };
+	static char* kwlist[] = { "queries", "supports", "q_batches", "s_batches", "radius", "max_neighbors", "num_threads", "ragged", "backend", NULL };
 	float radius = 0.1;
+	int max_neighbors = 0;
+	int num_threads = 1;
+	int ragged = 0;
+	const char* backend_name = "kdtree";
+	int backend = KDTREE_BACKEND;
 
 	// Parse the input  
-	if (!PyArg_ParseTupleAndKeywords(args, keywds, "OOOO|$f", kwlist, &queries_obj, &supports_obj, &q_batches_obj, &s_batches_obj, &radius))
+	if (!PyArg_ParseTupleAndKeywords(args, keywds, "OOOO|$fiips", kwlist, &queries_obj, &supports_obj, &q_batches_obj, &s_batches_obj, &radius, &max_neighbors, &num_threads, &ragged, &backend_name))
 	{
 		PyErr_SetString(PyExc_RuntimeError, "Error parsing arguments");
 		return NULL;
 	}
+	if (!parse_backend(backend_name, backend))
+		return NULL;
 
 
 	// Interpret the input objects as numpy arrays.
@@ -180,51 +390,40 @@ static PyObject* batch_neighbors(PyObject* self, PyObject* args, PyObject* keywd
 	// Call the C++ function
 	// *********************
 
-	// Convert PyArray to Cloud C++ class
-	vector<PointXYZ> queries;
-	vector<PointXYZ> supports;
-	vector<int> q_batches;
-	vector<int> s_batches;
-	queries = vector<PointXYZ>((PointXYZ*)PyArray_DATA(queries_array), (PointXYZ*)PyArray_DATA(queries_array) + Nq);
-	supports = vector<PointXYZ>((PointXYZ*)PyArray_DATA(supports_array), (PointXYZ*)PyArray_DATA(supports_array) + Ns);
-	q_batches = vector<int>((int*)PyArray_DATA(q_batches_array), (int*)PyArray_DATA(q_batches_array) + Nb);
-	s_batches = vector<int>((int*)PyArray_DATA(s_batches_array), (int*)PyArray_DATA(s_batches_array) + Nb);
-
-	// Create result containers
+	// The inputs are read in place in the numpy buffers
+	ArrayView<PointXYZ> queries = numpy_view<PointXYZ>(queries_array, Nq);
+	ArrayView<PointXYZ> supports = numpy_view<PointXYZ>(supports_array, Ns);
+	ArrayView<int> q_batches = numpy_view<int>(q_batches_array, Nb);
+	ArrayView<int> s_batches = numpy_view<int>(s_batches_array, Nb);
+
+	// Containers for the C++ function
 	vector<int> neighbors_indices;
+	vector<int64_t> neighbors_offsets;
+
+	// Release the GIL during the heavy computation, the numpy arrays are kept alive by our references
+	Py_BEGIN_ALLOW_THREADS
 
 	// Compute results
 	//batch_ordered_neighbors(queries, supports, q_batches, s_batches, neighbors_indices, radius);
-	batch_nanoflann_neighbors(queries, supports, q_batches, s_batches, neighbors_indices, radius);
-
-	// Check result
-	if (neighbors_indices.size() < 1)
+	if (backend == GRID_BACKEND)
 	{
-		PyErr_SetString(PyExc_RuntimeError, "Error");
-		return NULL;
+		BatchNeighborsIndex index(supports, s_batches, num_threads, backend, radius);
+		if (ragged)
+			index.query_ragged(queries, q_batches, neighbors_offsets, neighbors_indices, radius, max_neighbors, num_threads);
+		else
+			index.query(queries, q_batches, neighbors_indices, radius, max_neighbors, num_threads);
 	}
+	else if (ragged)
+		batch_nanoflann_neighbors_ragged(queries, supports, q_batches, s_batches, neighbors_offsets, neighbors_indices, radius, max_neighbors, num_threads);
+	else
+		batch_nanoflann_neighbors(queries, supports, q_batches, s_batches, neighbors_indices, radius, max_neighbors, num_threads);
+
+	Py_END_ALLOW_THREADS
 
 	// Manage outputs
 	// **************
 
-	// Maximal number of neighbors
-	int max_neighbors = neighbors_indices.size() / Nq;
-
-	// Dimension of output containers
-	npy_intp* neighbors_dims = new npy_intp[2];
-	neighbors_dims[0] = Nq;
-	neighbors_dims[1] = max_neighbors;
-
-	// Create output array
-	PyObject* res_obj = PyArray_SimpleNew(2, neighbors_dims, NPY_INT);
-	PyObject* ret = NULL;
-
-	// Fill output array with values
-	size_t size_in_bytes = Nq * max_neighbors * sizeof(int);
-	memcpy(PyArray_DATA(res_obj), neighbors_indices.data(), size_in_bytes);
-
-	// Merge results
-	ret = Py_BuildValue("N", res_obj);
+	PyObject* ret = neighbors_to_numpy(neighbors_offsets, neighbors_indices, Nq, ragged);
 
 	// Clean up
 	// ********
@@ -236,3 +435,537 @@ static PyObject* batch_neighbors(PyObject* self, PyObject* args, PyObject* keywd
 
 	return ret;
 }
+
+
+// Definition of the BatchIndex type
+// *********************************
+
+static void BatchIndex_dealloc(BatchIndexObject* self)
+{
+	delete self->index;
+	Py_TYPE(self)->tp_free((PyObject*)self);
+}
+
+
+static int BatchIndex_init(BatchIndexObject* self, PyObject* args, PyObject* keywds)
+{
+
+	// Manage inputs
+	// *************
+
+	// Args containers
+	PyObject* supports_obj = NULL;
+	PyObject* s_batches_obj = NULL;
+
+	// Keywords containers
+	static char* kwlist[] = { "supports", "s_batches", "num_threads", "backend", "cell_size", NULL };
+	int num_threads = 1;
+	const char* backend_name = "kdtree";
+	int backend = KDTREE_BACKEND;
+	float cell_size = 0;
+
+	// Parse the input
+	if (!PyArg_ParseTupleAndKeywords(args, keywds, "OO|$isf", kwlist, &supports_obj, &s_batches_obj, &num_threads, &backend_name, &cell_size))
+	{
+		PyErr_SetString(PyExc_RuntimeError, "Error parsing arguments");
+		return -1;
+	}
+	if (!parse_backend(backend_name, backend))
+		return -1;
+	if (backend == GRID_BACKEND && cell_size <= 0)
+	{
+		PyErr_SetString(PyExc_ValueError, "The grid backend needs a positive cell_size");
+		return -1;
+	}
+
+	// Interpret the input objects as numpy arrays.
+	PyObject* supports_array = PyArray_FROM_OTF(supports_obj, NPY_FLOAT, NPY_IN_ARRAY);
+	PyObject* s_batches_array = PyArray_FROM_OTF(s_batches_obj, NPY_INT, NPY_IN_ARRAY);
+
+	// Verify data was load correctly.
+	if (supports_array == NULL || s_batches_array == NULL)
+	{
+		Py_XDECREF(supports_array);
+		Py_XDECREF(s_batches_array);
+		PyErr_SetString(PyExc_RuntimeError, "Error converting supports to numpy arrays of type float32 and int32");
+		return -1;
+	}
+
+	// Check that the input array respect the dims
+	if ((int)PyArray_NDIM(supports_array) != 2 || (int)PyArray_DIM(supports_array, 1) != 3)
+	{
+		Py_XDECREF(supports_array);
+		Py_XDECREF(s_batches_array);
+		PyErr_SetString(PyExc_RuntimeError, "Wrong dimensions : support.shape is not (N, 3)");
+		return -1;
+	}
+	if ((int)PyArray_NDIM(s_batches_array) > 1)
+	{
+		Py_XDECREF(supports_array);
+		Py_XDECREF(s_batches_array);
+		PyErr_SetString(PyExc_RuntimeError, "Wrong dimensions : supports_batches.shape is not (B,) ");
+		return -1;
+	}
+
+	// Number of points and batches
+	int Ns = (int)PyArray_DIM(supports_array, 0);
+	int Nb = (int)PyArray_DIM(s_batches_array, 0);
+
+	// Build the trees (or grids)
+	// *************************
+
+	BatchNeighborsIndex* index = NULL;
+
+	Py_BEGIN_ALLOW_THREADS
+
+	// The trees (or grids) keep their own copy of the supports, read in place here
+	index = new BatchNeighborsIndex(numpy_view<PointXYZ>(supports_array, Ns), numpy_view<int>(s_batches_array, Nb),
+	                                num_threads, backend, cell_size);
+
+	Py_END_ALLOW_THREADS
+
+	delete self->index;
+	self->index = index;
+
+	Py_XDECREF(supports_array);
+	Py_XDECREF(s_batches_array);
+
+	return 0;
+}
+
+
+static PyObject* BatchIndex_query(BatchIndexObject* self, PyObject* args, PyObject* keywds)
+{
+
+	// Manage inputs
+	// *************
+
+	if (self->index == NULL)
+	{
+		PyErr_SetString(PyExc_RuntimeError, "BatchIndex is not initialized");
+		return NULL;
+	}
+
+	// Args containers
+	PyObject* queries_obj = NULL;
+	PyObject* q_batches_obj = NULL;
+
+	// Keywords containers
+	static char* kwlist[] = { "queries", "q_batches", "radius", "max_neighbors", "num_threads", "ragged", NULL };
+	float radius = 0.1;
+	int max_neighbors = 0;
+	int num_threads = 1;
+	int ragged = 0;
+
+	// Parse the input
+	if (!PyArg_ParseTupleAndKeywords(args, keywds, "OO|$fiip", kwlist, &queries_obj, &q_batches_obj, &radius, &max_neighbors, &num_threads, &ragged))
+	{
+		PyErr_SetString(PyExc_RuntimeError, "Error parsing arguments");
+		return NULL;
+	}
+
+	// Interpret the input objects as numpy arrays.
+	PyObject* queries_array = PyArray_FROM_OTF(queries_obj, NPY_FLOAT, NPY_IN_ARRAY);
+	PyObject* q_batches_array = PyArray_FROM_OTF(q_batches_obj, NPY_INT, NPY_IN_ARRAY);
+
+	// Verify data was load correctly.
+	if (queries_array == NULL || q_batches_array == NULL)
+	{
+		Py_XDECREF(queries_array);
+		Py_XDECREF(q_batches_array);
+		PyErr_SetString(PyExc_RuntimeError, "Error converting queries to numpy arrays of type float32 and int32");
+		return NULL;
+	}
+
+	// Check that the input array respect the dims
+	if ((int)PyArray_NDIM(queries_array) != 2 || (int)PyArray_DIM(queries_array, 1) != 3)
+	{
+		Py_XDECREF(queries_array);
+		Py_XDECREF(q_batches_array);
+		PyErr_SetString(PyExc_RuntimeError, "Wrong dimensions : query.shape is not (N, 3)");
+		return NULL;
+	}
+	if ((int)PyArray_NDIM(q_batches_array) > 1)
+	{
+		Py_XDECREF(queries_array);
+		Py_XDECREF(q_batches_array);
+		PyErr_SetString(PyExc_RuntimeError, "Wrong dimensions : queries_batches.shape is not (B,) ");
+		return NULL;
+	}
+	if ((size_t)PyArray_DIM(q_batches_array, 0) != self->index->num_batches())
+	{
+		Py_XDECREF(queries_array);
+		Py_XDECREF(q_batches_array);
+		PyErr_SetString(PyExc_RuntimeError, "Wrong number of batch elements: different for queries and supports ");
+		return NULL;
+	}
+
+	// Number of points and batches
+	int Nq = (int)PyArray_DIM(queries_array, 0);
+	int Nb = (int)PyArray_DIM(q_batches_array, 0);
+
+	// Call the C++ function
+	// *********************
+
+	ArrayView<PointXYZ> queries = numpy_view<PointXYZ>(queries_array, Nq);
+	ArrayView<int> q_batches = numpy_view<int>(q_batches_array, Nb);
+	vector<int> neighbors_indices;
+	vector<int64_t> neighbors_offsets;
+
+	Py_BEGIN_ALLOW_THREADS
+
+	if (ragged)
+		self->index->query_ragged(queries, q_batches, neighbors_offsets, neighbors_indices, radius, max_neighbors, num_threads);
+	else
+		self->index->query(queries, q_batches, neighbors_indices, radius, max_neighbors, num_threads);
+
+	Py_END_ALLOW_THREADS
+
+	// Manage outputs
+	// **************
+
+	PyObject* ret = neighbors_to_numpy(neighbors_offsets, neighbors_indices, Nq, ragged);
+
+	Py_XDECREF(queries_array);
+	Py_XDECREF(q_batches_array);
+
+	return ret;
+}
+
+
+// Definition of the KDTree type
+// *****************************
+
+// Queries of the KDTree: any (M, 3) array, converted to float32 if needed
+static PyObject* kdtree_queries_array(PyObject* queries_obj)
+{
+	PyObject* queries_array = PyArray_FROM_OTF(queries_obj, NPY_FLOAT, NPY_IN_ARRAY | NPY_ARRAY_FORCECAST);
+	if (queries_array == NULL)
+	{
+		PyErr_SetString(PyExc_RuntimeError, "Error converting query points to numpy arrays of type float32");
+		return NULL;
+	}
+	if ((int)PyArray_NDIM(queries_array) != 2 || (int)PyArray_DIM(queries_array, 1) != 3)
+	{
+		Py_DECREF(queries_array);
+		PyErr_SetString(PyExc_ValueError, "Wrong dimensions : query.shape is not (M, 3)");
+		return NULL;
+	}
+	return queries_array;
+}
+
+
+// Tree on the (N, 3) integer coordinates of a numpy array, dequantized with scale
+template <class T>
+static CloudKDTree* new_quantized_tree(PyObject* points_array, size_t N, float scale, int leaf_size)
+{
+	QuantizedCloudView<T> cloud(numpy_view<T>(points_array, 3 * N), scale);
+	return new ViewKDTree<QuantizedCloudView<T>>(cloud, leaf_size);
+}
+
+
+static void KDTree_dealloc(KDTreeObject* self)
+{
+	delete self->tree;
+	Py_XDECREF(self->data);
+	Py_TYPE(self)->tp_free((PyObject*)self);
+}
+
+
+static int KDTree_init(KDTreeObject* self, PyObject* args, PyObject* keywds)
+{
+
+	// Manage inputs
+	// *************
+
+	PyObject* points_obj = NULL;
+	static char* kwlist[] = { "points", "leaf_size", "scale", NULL };
+	int leaf_size = 10;
+	float scale = 1;
+
+	if (!PyArg_ParseTupleAndKeywords(args, keywds, "O|if", kwlist, &points_obj, &leaf_size, &scale))
+	{
+		PyErr_SetString(PyExc_RuntimeError, "Error parsing arguments");
+		return -1;
+	}
+	if (leaf_size < 1)
+	{
+		PyErr_SetString(PyExc_ValueError, "leaf_size must be positive");
+		return -1;
+	}
+	if (!(scale > 0))
+	{
+		PyErr_SetString(PyExc_ValueError, "scale must be positive");
+		return -1;
+	}
+
+	// Integer points are quantized coordinates, any other type is converted to float32
+	int typenum = PyArray_Check(points_obj) ? PyArray_TYPE((PyArrayObject*)points_obj) : NPY_FLOAT;
+	if (typenum != NPY_SHORT && typenum != NPY_USHORT && typenum != NPY_INT && typenum != NPY_UINT)
+		typenum = NPY_FLOAT;
+	if (typenum == NPY_FLOAT && scale != 1)
+	{
+		PyErr_SetString(PyExc_ValueError, "scale is only used with quantized (integer) points");
+		return -1;
+	}
+
+	// The points are read in place: contiguous arrays are kept as they are, others are converted once
+	PyObject* points_array = PyArray_FROM_OTF(points_obj, typenum, NPY_IN_ARRAY | NPY_ARRAY_FORCECAST);
+	if (points_array == NULL)
+	{
+		PyErr_SetString(PyExc_RuntimeError, "Error converting points to numpy arrays");
+		return -1;
+	}
+	if ((int)PyArray_NDIM(points_array) != 2 || (int)PyArray_DIM(points_array, 1) != 3)
+	{
+		Py_DECREF(points_array);
+		PyErr_SetString(PyExc_ValueError, "Wrong dimensions : points.shape is not (N, 3)");
+		return -1;
+	}
+	if ((uint64_t)PyArray_DIM(points_array, 0) > (uint64_t)UINT32_MAX)
+	{
+		Py_DECREF(points_array);
+		PyErr_SetString(PyExc_ValueError, "Too many points for 32 bits tree indices");
+		return -1;
+	}
+
+	// Build the tree
+	// **************
+
+	size_t N = (size_t)PyArray_DIM(points_array, 0);
+	CloudKDTree* tree = NULL;
+
+	Py_BEGIN_ALLOW_THREADS
+	switch (typenum)
+	{
+	case NPY_SHORT:
+		tree = new_quantized_tree<int16_t>(points_array, N, scale, leaf_size);
+		break;
+	case NPY_USHORT:
+		tree = new_quantized_tree<uint16_t>(points_array, N, scale, leaf_size);
+		break;
+	case NPY_INT:
+		tree = new_quantized_tree<int32_t>(points_array, N, scale, leaf_size);
+		break;
+	case NPY_UINT:
+		tree = new_quantized_tree<uint32_t>(points_array, N, scale, leaf_size);
+		break;
+	default:
+		tree = new ViewKDTree<PointCloudView>(PointCloudView{ numpy_view<PointXYZ>(points_array, N) }, leaf_size);
+	}
+	Py_END_ALLOW_THREADS
+
+	// The tree keeps a reference on its points
+	delete self->tree;
+	Py_XDECREF(self->data);
+	self->tree = tree;
+	self->data = points_array;
+	self->leaf_size = leaf_size;
+	self->scale = scale;
+
+	return 0;
+}
+
+
+static PyObject* KDTree_get_data(KDTreeObject* self, void* closure)
+{
+	if (self->data == NULL)
+		Py_RETURN_NONE;
+	Py_INCREF(self->data);
+	return self->data;
+}
+
+
+static PyObject* KDTree_get_scale(KDTreeObject* self, void* closure)
+{
+	return PyFloat_FromDouble((double)self->scale);
+}
+
+
+static PyObject* KDTree_reduce(KDTreeObject* self, PyObject* unused)
+{
+	if (self->data == NULL)
+	{
+		PyErr_SetString(PyExc_RuntimeError, "KDTree is not initialized");
+		return NULL;
+	}
+
+	// Only the points and their scale are pickled, the tree is rebuilt from them
+	return Py_BuildValue("O(Oif)", (PyObject*)Py_TYPE(self), self->data, self->leaf_size, self->scale);
+}
+
+
+// Object array whose element i is the slice [offsets[i], offsets[i + 1]) of a flat array (views, no copy)
+static PyObject* split_ragged(PyObject* flat_obj, vector<int64_t>& offsets)
+{
+	if (flat_obj == NULL)
+		return NULL;
+
+	npy_intp dims[1] = { (npy_intp)offsets.size() - 1 };
+	PyObject* res_obj = PyArray_SimpleNew(1, dims, NPY_OBJECT);
+	if (res_obj == NULL)
+	{
+		Py_DECREF(flat_obj);
+		return NULL;
+	}
+
+	PyObject** items = (PyObject**)PyArray_DATA((PyArrayObject*)res_obj);
+	for (npy_intp i = 0; i < dims[0]; i++)
+	{
+		PyObject* item = PySequence_GetSlice(flat_obj, (Py_ssize_t)offsets[i], (Py_ssize_t)offsets[i + 1]);
+		if (item == NULL)
+		{
+			Py_DECREF(flat_obj);
+			Py_DECREF(res_obj);
+			return NULL;
+		}
+
+		// Object arrays are created filled with None
+		Py_XDECREF(items[i]);
+		items[i] = item;
+	}
+
+	Py_DECREF(flat_obj);
+	return res_obj;
+}
+
+
+static PyObject* KDTree_query_radius(KDTreeObject* self, PyObject* args, PyObject* keywds)
+{
+
+	// Manage inputs
+	// *************
+
+	if (self->tree == NULL)
+	{
+		PyErr_SetString(PyExc_RuntimeError, "KDTree is not initialized");
+		return NULL;
+	}
+
+	PyObject* queries_obj = NULL;
+	static char* kwlist[] = { "X", "r", "return_distance", "sort_results", "num_threads", NULL };
+	float radius = 0;
+	int return_distance = 0;
+	int sort_results = 0;
+	int num_threads = 1;
+
+	if (!PyArg_ParseTupleAndKeywords(args, keywds, "Of|ppi", kwlist, &queries_obj, &radius, &return_distance, &sort_results, &num_threads))
+	{
+		PyErr_SetString(PyExc_RuntimeError, "Error parsing arguments");
+		return NULL;
+	}
+
+	PyObject* queries_array = kdtree_queries_array(queries_obj);
+	if (queries_array == NULL)
+		return NULL;
+	ArrayView<PointXYZ> queries = numpy_view<PointXYZ>(queries_array, (size_t)PyArray_DIM(queries_array, 0));
+
+	// Call the C++ function
+	// *********************
+
+	vector<int64_t> neighbors_offsets;
+	vector<int64_t> neighbors_indices;
+	vector<float> neighbors_dists;
+
+	Py_BEGIN_ALLOW_THREADS
+
+	self->tree->query_radius(queries, radius, neighbors_offsets, neighbors_indices, neighbors_dists, sort_results, num_threads);
+	if (return_distance)
+	{
+		for (auto& d : neighbors_dists)
+			d = sqrt(d);
+	}
+
+	Py_END_ALLOW_THREADS
+
+	Py_DECREF(queries_array);
+
+	// Manage outputs
+	// **************
+
+	// The neighbors of each query are views of the flat results
+	npy_intp flat_dims[1] = { (npy_intp)neighbors_indices.size() };
+	PyObject* inds_obj = split_ragged(vector_to_numpy(neighbors_indices, 1, flat_dims, NPY_INT64), neighbors_offsets);
+	if (!return_distance || inds_obj == NULL)
+		return inds_obj;
+
+	PyObject* dists_obj = split_ragged(vector_to_numpy(neighbors_dists, 1, flat_dims, NPY_FLOAT), neighbors_offsets);
+	if (dists_obj == NULL)
+	{
+		Py_DECREF(inds_obj);
+		return NULL;
+	}
+	return Py_BuildValue("NN", inds_obj, dists_obj);
+}
+
+
+static PyObject* KDTree_query(KDTreeObject* self, PyObject* args, PyObject* keywds)
+{
+
+	// Manage inputs
+	// *************
+
+	if (self->tree == NULL)
+	{
+		PyErr_SetString(PyExc_RuntimeError, "KDTree is not initialized");
+		return NULL;
+	}
+
+	PyObject* queries_obj = NULL;
+	static char* kwlist[] = { "X", "k", "return_distance", "num_threads", NULL };
+	int k = 1;
+	int return_distance = 1;
+	int num_threads = 1;
+
+	if (!PyArg_ParseTupleAndKeywords(args, keywds, "O|ipi", kwlist, &queries_obj, &k, &return_distance, &num_threads))
+	{
+		PyErr_SetString(PyExc_RuntimeError, "Error parsing arguments");
+		return NULL;
+	}
+	if (k < 1 || (size_t)k > self->tree->size())
+	{
+		PyErr_SetString(PyExc_ValueError, "k must be between 1 and the number of points of the tree");
+		return NULL;
+	}
+
+	PyObject* queries_array = kdtree_queries_array(queries_obj);
+	if (queries_array == NULL)
+		return NULL;
+	size_t Nq = (size_t)PyArray_DIM(queries_array, 0);
+	ArrayView<PointXYZ> queries = numpy_view<PointXYZ>(queries_array, Nq);
+
+	// Call the C++ function
+	// *********************
+
+	vector<int64_t> neighbors_indices;
+	vector<float> neighbors_dists;
+
+	Py_BEGIN_ALLOW_THREADS
+
+	self->tree->query_knn(queries, (size_t)k, neighbors_indices, neighbors_dists, num_threads);
+	if (return_distance)
+	{
+		for (auto& d : neighbors_dists)
+			d = sqrt(d);
+	}
+
+	Py_END_ALLOW_THREADS
+
+	Py_DECREF(queries_array);
+
+	// Manage outputs
+	// **************
+
+	npy_intp dims[2] = { (npy_intp)Nq, (npy_intp)k };
+	PyObject* inds_obj = vector_to_numpy(neighbors_indices, 2, dims, NPY_INT64);
+	if (!return_distance || inds_obj == NULL)
+		return inds_obj;
+
+	PyObject* dists_obj = vector_to_numpy(neighbors_dists, 2, dims, NPY_FLOAT);
+	if (dists_obj == NULL)
+	{
+		Py_DECREF(inds_obj);
+		return NULL;
+	}
+	return Py_BuildValue("NN", dists_obj, inds_obj);
+}
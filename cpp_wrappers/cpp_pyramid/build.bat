@@ -0,0 +1,5 @@
+@echo off
+python setup.py build_ext --inplace
+
+
+pause
\ No newline at end of file
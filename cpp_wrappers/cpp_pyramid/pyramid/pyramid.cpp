@@ -0,0 +1,108 @@
+
+#include "pyramid.h"
+
+
+// Query neighbors in the padded or ragged format
+static void query_neighbors(const BatchNeighborsIndex& index,
+                            vector<PointXYZ>& queries,
+                            vector<int>& q_batches,
+                            float radius,
+                            int max_neighbors,
+                            bool ragged,
+                            int num_threads,
+                            PyramidNeighbors& result)
+{
+	result.n_queries = queries.size();
+	if (ragged)
+	{
+		index.query_ragged(queries, q_batches, result.offsets, result.indices, radius, max_neighbors, num_threads);
+	}
+	else
+	{
+		index.query(queries, q_batches, result.indices, radius, max_neighbors, num_threads);
+		result.max_count = queries.size() > 0 ? result.indices.size() / queries.size() : 0;
+	}
+}
+
+
+// Cell size of the voxel hash grids of layer l: the largest radius queried on its points
+static float index_cell_size(vector<PyramidLayerParams>& params, size_t l)
+{
+	float cell_size = max(params[l].conv_radius, params[l].pool_radius);
+	if (l > 0)
+		cell_size = max(cell_size, params[l - 1].up_radius);
+	return cell_size > 0 ? cell_size : 1;
+}
+
+
+void build_pyramid(ArrayView<PointXYZ> points,
+                   ArrayView<int> lengths,
+                   vector<PyramidLayerParams>& params,
+                   vector<PyramidLayer>& layers,
+                   bool ragged,
+                   int num_threads,
+                   int backend,
+                   int subsampling,
+                   uint64_t seed)
+{
+
+	// Initialize variables
+	// ******************
+
+	layers = vector<PyramidLayer>(params.size());
+	if (params.empty())
+		return;
+
+	layers[0].points = vector<PointXYZ>(points.begin(), points.end());
+	layers[0].lengths = vector<int>(lengths.begin(), lengths.end());
+
+	// Trees of the current layer points (built by the upsampling query of the previous layer)
+	BatchNeighborsIndex* index = NULL;
+
+
+	// Loop over the layers
+	// ********************
+
+	for (size_t l = 0; l < params.size(); l++)
+	{
+		PyramidLayer& layer = layers[l];
+		PyramidLayerParams& p = params[l];
+
+		// Trees are built once per layer and shared by all the queries on its points
+		if (index == NULL)
+			index = new BatchNeighborsIndex(layer.points, layer.lengths, num_threads, backend, index_cell_size(params, l));
+
+		// Convolution neighbors indices
+		if (p.conv_radius > 0)
+			query_neighbors(*index, layer.points, layer.lengths, p.conv_radius, p.conv_limit, ragged, num_threads, layer.neighbors);
+
+		// Pooling and upsampling neighbors indices
+		BatchNeighborsIndex* pool_index = NULL;
+		if (p.pool_dl > 0 && l + 1 < params.size())
+		{
+			PyramidLayer& next_layer = layers[l + 1];
+			vector<float> no_features;
+			vector<float> no_s_features;
+			vector<int> no_classes;
+			vector<int> no_s_classes;
+			batch_grid_subsampling(layer.points, next_layer.points, no_features, no_s_features, no_classes, no_s_classes,
+			                       layer.lengths, next_layer.lengths, p.pool_dl, 0, p.rotations, num_threads,
+			                       subsampling, seed + l * layer.lengths.size());
+
+			query_neighbors(*index, next_layer.points, next_layer.lengths, p.pool_radius, p.pool_limit, ragged, num_threads, layer.pools);
+
+			pool_index = new BatchNeighborsIndex(next_layer.points, next_layer.lengths, num_threads,
+			                                     backend, index_cell_size(params, l + 1));
+			if (p.up_radius > 0)
+				query_neighbors(*pool_index, layer.points, layer.lengths, p.up_radius, p.up_limit, ragged, num_threads, layer.upsamples);
+		}
+
+		// Trees of the pooled points are kept for the next layer
+		delete index;
+		index = pool_index;
+	}
+
+	delete index;
+
+	return;
+}
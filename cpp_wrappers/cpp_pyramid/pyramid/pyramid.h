@@ -0,0 +1,74 @@
+
+
+# pragma once
+
+#include "../../cpp_neighbors/neighbors/neighbors.h"
+#include "../../cpp_subsampling/grid_subsampling/grid_subsampling.h"
+
+#include <cstdint>
+
+using namespace std;
+
+
+// Parameters of one layer of the network inputs
+class PyramidLayerParams
+{
+public:
+
+	// Radius of the convolution neighbors (0 if the layer has no convolution)
+	float conv_radius;
+
+	// Grid size of the pooling subsampling (0 if the layer does not end with a pooling)
+	float pool_dl;
+
+	// Radius of the pooling and upsampling neighbors (upsampling is skipped if 0)
+	float pool_radius;
+	float up_radius;
+
+	// Maximal number of neighbors of each query (0 for no limit)
+	int conv_limit;
+	int pool_limit;
+	int up_limit;
+
+	// One row-major 3x3 rotation matrix per batch element applied before the pooling subsampling (or empty)
+	vector<float> rotations;
+};
+
+
+// Neighbors of one query type, padded matrix (offsets empty) or CSR format
+class PyramidNeighbors
+{
+public:
+
+	// Dense padded matrix [n_queries, max_count] or ragged indices
+	vector<int> indices;
+	vector<int64_t> offsets;
+	size_t n_queries;
+	size_t max_count;
+
+	PyramidNeighbors() : n_queries(0), max_count(0) {}
+};
+
+
+// Inputs of one layer of the network
+class PyramidLayer
+{
+public:
+
+	vector<PointXYZ> points;
+	vector<int> lengths;
+	PyramidNeighbors neighbors;
+	PyramidNeighbors pools;
+	PyramidNeighbors upsamples;
+};
+
+
+void build_pyramid(ArrayView<PointXYZ> points,
+                   ArrayView<int> lengths,
+                   vector<PyramidLayerParams>& params,
+                   vector<PyramidLayer>& layers,
+                   bool ragged,
+                   int num_threads = 1,
+                   int backend = KDTREE_BACKEND,
+                   int subsampling = SUBSAMPLING_BARYCENTERS,
+                   uint64_t seed = 0);
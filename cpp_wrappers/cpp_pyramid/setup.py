@@ -0,0 +1,32 @@
+from distutils.core import setup, Extension
+import numpy.distutils.misc_util
+
+# Adding OpenCV to project
+# ************************
+
+# Adding sources of the project
+# *****************************
+
+SOURCES = ["../cpp_utils/cloud/cloud.cpp",
+             "../cpp_subsampling/grid_subsampling/grid_subsampling.cpp",
+             "../cpp_neighbors/neighbors/neighbors.cpp",
+             "pyramid/pyramid.cpp",
+             "wrapper.cpp"]
+
+module = Extension(name="input_pyramid",
+                    sources=SOURCES,
+                    extra_compile_args=['-std=c++11',
+                                        '-D_GLIBCXX_USE_CXX11_ABI=0',
+                                        '-pthread'],
+                    extra_link_args=['-pthread'])
+
+
+setup(ext_modules=[module], include_dirs=numpy.distutils.misc_util.get_numpy_include_dirs())
+
+
+
+
+
+
+
+
@@ -0,0 +1,303 @@
+#include <Python.h>
+#include <numpy/arrayobject.h>
+#include "pyramid/pyramid.h"
+#include "../cpp_utils/numpy/numpy_vector.h"
+#include <string>
+
+
+
+// docstrings for our module
+// *************************
+
+static char module_docstring[] = "This module builds all the network inputs of a batch of stacked pointclouds in one call";
+
+static char build_pyramid_docstring[] = "Method computing the points, neighbors, pools, upsamples and lengths of every layer. "
+										"Layer l has a convolution if conv_radii[l] > 0 and ends with a pooling if pool_dls[l] > 0. "
+										"Neighbors are int64 padded matrices, or (offsets, indices) tuples with ragged=True. "
+										"With int64_indices=False, the indices are int32 (offsets stay int64). "
+										"Optional rotations (L, B, 3, 3) give the grid orientation of each pooling subsampling. "
+										"backend='kdtree' or 'grid' chooses the neighbors search engine (same neighbors). "
+										"subsampling='barycenters', 'first', 'random' (drawn from seed) or 'center' chooses the "
+										"pooled points (barycenters or one representative point per voxel)";
+
+
+// Declare the functions
+// *********************
+
+static PyObject *build_pyramid_inputs(PyObject *self, PyObject *args, PyObject *keywds);
+
+
+// Specify the members of the module
+// *********************************
+
+static PyMethodDef module_methods[] =
+{
+	{ "build_pyramid", (PyCFunction)build_pyramid_inputs, METH_VARARGS | METH_KEYWORDS, build_pyramid_docstring },
+	{NULL, NULL, 0, NULL}
+};
+
+
+// Initialize the module
+// *********************
+
+static struct PyModuleDef moduledef =
+{
+    PyModuleDef_HEAD_INIT,
+    "input_pyramid",        // m_name
+    module_docstring,       // m_doc
+    -1,                     // m_size
+    module_methods,         // m_methods
+    NULL,                   // m_reload
+    NULL,                   // m_traverse
+    NULL,                   // m_clear
+    NULL,                   // m_free
+};
+
+PyMODINIT_FUNC PyInit_input_pyramid(void)
+{
+    import_array();
+	return PyModule_Create(&moduledef);
+}
+
+
+// Conversion of the outputs to numpy
+// **********************************
+
+// Points, lengths and offsets arrays take over the memory of the layers (no copy)
+static PyObject* points_to_numpy(vector<PointXYZ>& points)
+{
+	npy_intp dims[2] = { (npy_intp)points.size(), 3 };
+	return vector_to_numpy(points, 2, dims, NPY_FLOAT);
+}
+
+static PyObject* lengths_to_numpy(vector<int>& lengths)
+{
+	npy_intp dims[1] = { (npy_intp)lengths.size() };
+	return vector_to_numpy(lengths, 1, dims, NPY_INT);
+}
+
+static PyObject* indices_to_numpy(vector<int>& indices, npy_intp n_rows, npy_intp n_cols, int ndim, int int64_indices)
+{
+	// int32 indices are handed over as they are
+	npy_intp dims[2] = { n_rows, n_cols };
+	if (!int64_indices)
+		return vector_to_numpy(indices, ndim, dims, NPY_INT);
+
+	// Otherwise they are directly widened to int64
+	PyObject* res_obj = PyArray_SimpleNew(ndim, dims, NPY_INT64);
+	int64_t* data = (int64_t*)PyArray_DATA(res_obj);
+	for (size_t i = 0; i < indices.size(); i++)
+		data[i] = (int64_t)indices[i];
+	return res_obj;
+}
+
+static PyObject* neighbors_to_numpy(PyramidNeighbors& neighbors, int ragged, int int64_indices)
+{
+	if (ragged)
+	{
+		// Layers without these neighbors get a single zero offset
+		if (neighbors.offsets.empty())
+			neighbors.offsets.push_back(0);
+
+		npy_intp offsets_dims[1] = { (npy_intp)neighbors.offsets.size() };
+		PyObject* offsets_obj = vector_to_numpy(neighbors.offsets, 1, offsets_dims, NPY_INT64);
+
+		PyObject* indices_obj = indices_to_numpy(neighbors.indices, (npy_intp)neighbors.indices.size(), 0, 1, int64_indices);
+
+		return Py_BuildValue("NN", offsets_obj, indices_obj);
+	}
+
+	// Layers without these neighbors get a (0, 1) matrix
+	if (neighbors.n_queries == 0)
+		return indices_to_numpy(neighbors.indices, 0, 1, 2, int64_indices);
+
+	return indices_to_numpy(neighbors.indices, (npy_intp)neighbors.n_queries, (npy_intp)neighbors.max_count, 2, int64_indices);
+}
+
+
+// Definition of the build_pyramid method
+// **************************************
+
+static PyObject* build_pyramid_inputs(PyObject* self, PyObject* args, PyObject* keywds)
+{
+
+	// Manage inputs
+	// *************
+
+	// Args containers
+	PyObject* points_obj = NULL;
+	PyObject* lengths_obj = NULL;
+	PyObject* conv_radii_obj = NULL;
+	PyObject* pool_dls_obj = NULL;
+	PyObject* pool_radii_obj = NULL;
+	PyObject* up_radii_obj = NULL;
+	PyObject* conv_limits_obj = NULL;
+	PyObject* pool_limits_obj = NULL;
+	PyObject* up_limits_obj = NULL;
+	PyObject* rotations_obj = NULL;
+
+	// Keywords containers
+	static char* kwlist[] = { "points", "lengths", "conv_radii", "pool_dls", "pool_radii", "up_radii",
+							  "conv_limits", "pool_limits", "up_limits", "rotations", "ragged", "num_threads", "backend",
+							  "subsampling", "seed", "int64_indices", NULL };
+	int ragged = 0;
+	int int64_indices = 1;
+	int num_threads = 1;
+	const char* backend_name = "kdtree";
+	int backend = KDTREE_BACKEND;
+	const char* subsampling_name = "barycenters";
+	int subsampling = SUBSAMPLING_BARYCENTERS;
+	unsigned long long seed = 0;
+
+	// Parse the input
+	if (!PyArg_ParseTupleAndKeywords(args, keywds, "OO|$OOOOOOOOpissKp", kwlist,
+									 &points_obj, &lengths_obj, &conv_radii_obj, &pool_dls_obj, &pool_radii_obj,
+									 &up_radii_obj, &conv_limits_obj, &pool_limits_obj, &up_limits_obj,
+									 &rotations_obj, &ragged, &num_threads, &backend_name,
+									 &subsampling_name, &seed, &int64_indices))
+	{
+		PyErr_SetString(PyExc_RuntimeError, "Error parsing arguments");
+		return NULL;
+	}
+	if (!conv_radii_obj || !pool_dls_obj || !pool_radii_obj || !up_radii_obj ||
+		!conv_limits_obj || !pool_limits_obj || !up_limits_obj)
+	{
+		PyErr_SetString(PyExc_RuntimeError, "Missing layer parameters (radii and limits of every layer are required)");
+		return NULL;
+	}
+	if (strcmp(backend_name, "kdtree") == 0)
+		backend = KDTREE_BACKEND;
+	else if (strcmp(backend_name, "grid") == 0)
+		backend = GRID_BACKEND;
+	else
+	{
+		PyErr_SetString(PyExc_ValueError, "Unknown neighbors backend, use 'kdtree' or 'grid'");
+		return NULL;
+	}
+	if (!subsampling_method_from_name(string(subsampling_name), subsampling))
+	{
+		PyErr_SetString(PyExc_ValueError, "Unknown subsampling method, use 'barycenters', 'first', 'random' or 'center'");
+		return NULL;
+	}
+
+	// Interpret the input objects as numpy arrays.
+	PyObject* points_array = PyArray_FROM_OTF(points_obj, NPY_FLOAT, NPY_IN_ARRAY);
+	PyObject* lengths_array = PyArray_FROM_OTF(lengths_obj, NPY_INT, NPY_IN_ARRAY);
+	PyObject* conv_radii_array = PyArray_FROM_OTF(conv_radii_obj, NPY_FLOAT, NPY_IN_ARRAY);
+	PyObject* pool_dls_array = PyArray_FROM_OTF(pool_dls_obj, NPY_FLOAT, NPY_IN_ARRAY);
+	PyObject* pool_radii_array = PyArray_FROM_OTF(pool_radii_obj, NPY_FLOAT, NPY_IN_ARRAY);
+	PyObject* up_radii_array = PyArray_FROM_OTF(up_radii_obj, NPY_FLOAT, NPY_IN_ARRAY);
+	PyObject* conv_limits_array = PyArray_FROM_OTF(conv_limits_obj, NPY_INT, NPY_IN_ARRAY);
+	PyObject* pool_limits_array = PyArray_FROM_OTF(pool_limits_obj, NPY_INT, NPY_IN_ARRAY);
+	PyObject* up_limits_array = PyArray_FROM_OTF(up_limits_obj, NPY_INT, NPY_IN_ARRAY);
+	PyObject* rotations_array = NULL;
+	if (rotations_obj != NULL && rotations_obj != Py_None)
+		rotations_array = PyArray_FROM_OTF(rotations_obj, NPY_FLOAT, NPY_IN_ARRAY);
+
+	PyObject* arrays[10] = { points_array, lengths_array, conv_radii_array, pool_dls_array, pool_radii_array,
+							 up_radii_array, conv_limits_array, pool_limits_array, up_limits_array, rotations_array };
+
+	// Verify data was load correctly.
+	bool ok = true;
+	for (int i = 0; i < 9; i++)
+		ok = ok && (arrays[i] != NULL);
+	if (rotations_obj != NULL && rotations_obj != Py_None)
+		ok = ok && (rotations_array != NULL);
+	if (!ok)
+	{
+		for (int i = 0; i < 10; i++)
+			Py_XDECREF(arrays[i]);
+		PyErr_SetString(PyExc_RuntimeError, "Error converting the inputs to numpy arrays of type float32 and int32");
+		return NULL;
+	}
+
+	// Number of points, batch elements and layers
+	int N = (int)PyArray_SIZE(points_array) / 3;
+	int Nb = (int)PyArray_SIZE(lengths_array);
+	int L = (int)PyArray_SIZE(conv_radii_array);
+
+	// Check that the input array respect the dims
+	const char* error = NULL;
+	if ((int)PyArray_NDIM(points_array) != 2 || (int)PyArray_DIM(points_array, 1) != 3)
+		error = "Wrong dimensions : points.shape is not (N, 3)";
+	else if ((int)PyArray_NDIM(lengths_array) > 1)
+		error = "Wrong dimensions : lengths.shape is not (B,) ";
+	for (int i = 3; i < 9; i++)
+	{
+		if ((int)PyArray_SIZE(arrays[i]) != L)
+			error = "Wrong dimensions : all the layer parameters should have the same length";
+	}
+	if (rotations_array != NULL && (int)PyArray_SIZE(rotations_array) != L * Nb * 9)
+		error = "Wrong dimensions : rotations.shape is not (L, B, 3, 3)";
+	if (error)
+	{
+		for (int i = 0; i < 10; i++)
+			Py_XDECREF(arrays[i]);
+		PyErr_SetString(PyExc_RuntimeError, error);
+		return NULL;
+	}
+
+	// Call the C++ function
+	// *********************
+
+	// The inputs are read in place in the numpy buffers
+	ArrayView<PointXYZ> points = numpy_view<PointXYZ>(points_array, N);
+	ArrayView<int> lengths = numpy_view<int>(lengths_array, Nb);
+
+	// Containers for the C++ function
+	vector<PyramidLayerParams> params(L);
+	vector<PyramidLayer> layers;
+
+	// Release the GIL during the heavy computation, the numpy arrays are kept alive by our references
+	Py_BEGIN_ALLOW_THREADS
+
+	// Layer parameters
+	for (int l = 0; l < L; l++)
+	{
+		params[l].conv_radius = ((float*)PyArray_DATA(conv_radii_array))[l];
+		params[l].pool_dl = ((float*)PyArray_DATA(pool_dls_array))[l];
+		params[l].pool_radius = ((float*)PyArray_DATA(pool_radii_array))[l];
+		params[l].up_radius = ((float*)PyArray_DATA(up_radii_array))[l];
+		params[l].conv_limit = ((int*)PyArray_DATA(conv_limits_array))[l];
+		params[l].pool_limit = ((int*)PyArray_DATA(pool_limits_array))[l];
+		params[l].up_limit = ((int*)PyArray_DATA(up_limits_array))[l];
+		if (rotations_array != NULL)
+		{
+			float* R = (float*)PyArray_DATA(rotations_array) + l * Nb * 9;
+			params[l].rotations = vector<float>(R, R + Nb * 9);
+		}
+	}
+
+	// Compute results
+	build_pyramid(points, lengths, params, layers, ragged != 0, num_threads, backend, subsampling, (uint64_t)seed);
+
+	Py_END_ALLOW_THREADS
+
+	// Manage outputs
+	// **************
+
+	PyObject* points_list = PyList_New(L);
+	PyObject* neighbors_list = PyList_New(L);
+	PyObject* pools_list = PyList_New(L);
+	PyObject* upsamples_list = PyList_New(L);
+	PyObject* lengths_list = PyList_New(L);
+	for (int l = 0; l < L; l++)
+	{
+		PyList_SET_ITEM(points_list, l, points_to_numpy(layers[l].points));
+		PyList_SET_ITEM(neighbors_list, l, neighbors_to_numpy(layers[l].neighbors, ragged, int64_indices));
+		PyList_SET_ITEM(pools_list, l, neighbors_to_numpy(layers[l].pools, ragged, int64_indices));
+		PyList_SET_ITEM(upsamples_list, l, neighbors_to_numpy(layers[l].upsamples, ragged, int64_indices));
+		PyList_SET_ITEM(lengths_list, l, lengths_to_numpy(layers[l].lengths));
+	}
+
+	// Merge results
+	PyObject* ret = Py_BuildValue("NNNNN", points_list, neighbors_list, pools_list, upsamples_list, lengths_list);
+
+	// Clean up
+	// ********
+
+	for (int i = 0; i < 10; i++)
+		Py_XDECREF(arrays[i]);
+
+	return ret;
+}
@@ -2,14 +2,211 @@
 #include "grid_subsampling.h"
 
 
-void grid_subsampling(vector<PointXYZ>& original_points,
-                      vector<PointXYZ>& subsampled_points,
-                      vector<float>& original_features,
-                      vector<float>& subsampled_features,
-                      vector<int>& original_classes,
-                      vector<int>& subsampled_classes,
-                      float sampleDl,
-                      int verbose) {
+void radix_sort_voxels(uint64_t* keys, uint32_t* order, size_t n)
+{
+	// 11 bits per pass, and only the passes covering the bits of the largest key
+	const int digit_bits = 11;
+	const size_t n_buckets = (size_t)1 << digit_bits;
+
+	uint64_t max_key = 0;
+	for (size_t i = 0; i < n; i++)
+		max_key = max(max_key, keys[i]);
+
+	vector<uint64_t> tmp_keys(n);
+	vector<uint32_t> tmp_order(n);
+	uint64_t* src_keys = keys;
+	uint32_t* src_order = order;
+	uint64_t* dst_keys = tmp_keys.data();
+	uint32_t* dst_order = tmp_order.data();
+	vector<size_t> offsets(n_buckets + 1);
+	for (int shift = 0; shift < 64 && (max_key >> shift) > 0; shift += digit_bits)
+	{
+		// Histogram of the current digit
+		fill(offsets.begin(), offsets.end(), 0);
+		for (size_t i = 0; i < n; i++)
+			offsets[((src_keys[i] >> shift) & (n_buckets - 1)) + 1]++;
+		for (size_t d = 0; d < n_buckets; d++)
+			offsets[d + 1] += offsets[d];
+
+		// Scatter (stable)
+		for (size_t i = 0; i < n; i++)
+		{
+			size_t j = offsets[(src_keys[i] >> shift) & (n_buckets - 1)]++;
+			dst_keys[j] = src_keys[i];
+			dst_order[j] = src_order[i];
+		}
+		swap(src_keys, dst_keys);
+		swap(src_order, dst_order);
+	}
+
+	// The result ends in the temporary buffers after an odd number of passes
+	if (src_keys != keys)
+	{
+		copy(src_keys, src_keys + n, keys);
+		copy(src_order, src_order + n, order);
+	}
+}
+
+
+// Barycenters, mean features and most frequent labels of the voxels of a sorted range of points
+static void reduce_voxels(const uint64_t* keys,
+                          const uint32_t* order,
+                          size_t n,
+                          ArrayView<PointXYZ> original_points,
+                          ArrayView<float> original_features,
+                          ArrayView<int> original_classes,
+                          size_t fdim,
+                          size_t ldim,
+                          vector<int>& label_mins,
+                          vector<size_t>& label_ranges,
+                          vector<PointXYZ>& subsampled_points,
+                          vector<float>& subsampled_features,
+                          vector<int>& subsampled_classes,
+                          vector<int>* inverse_indices)
+{
+	bool use_feature = fdim > 0;
+	bool use_classes = ldim > 0;
+
+	// First sorted point of each voxel
+	vector<size_t> voxel_starts;
+	voxel_starts.reserve(n / 4 + 2);
+	for (size_t i = 0; i < n; i++)
+	{
+		if (i == 0 || keys[i] != keys[i - 1])
+			voxel_starts.push_back(i);
+	}
+	voxel_starts.push_back(n);
+	size_t n_voxels = voxel_starts.size() - 1;
+
+	// Labels are voted in a flat count array over the range of each label dimension
+	vector<vector<int>> label_counts(ldim);
+	for (size_t l = 0; l < ldim; l++)
+		label_counts[l] = vector<int>(label_ranges[l], 0);
+
+	size_t s0 = subsampled_points.size();
+	subsampled_points.resize(s0 + n_voxels);
+	if (use_feature)
+		subsampled_features.reserve(subsampled_features.size() + n_voxels * fdim);
+	if (use_classes)
+		subsampled_classes.reserve(subsampled_classes.size() + n_voxels * ldim);
+
+	vector<float> features(fdim);
+	for (size_t v = 0; v < n_voxels; v++)
+	{
+		size_t first = voxel_starts[v];
+		size_t last = voxel_starts[v + 1];
+
+		// Barycenter
+		PointXYZ point;
+		for (size_t j = first; j < last; j++)
+			point += original_points[order[j]];
+		subsampled_points[s0 + v] = point * (1.0 / (last - first));
+
+		// Subsampled point of the original points
+		if (inverse_indices)
+		{
+			for (size_t j = first; j < last; j++)
+				(*inverse_indices)[order[j]] = (int)(s0 + v);
+		}
+
+		// Mean features
+		if (use_feature)
+		{
+			fill(features.begin(), features.end(), 0);
+			for (size_t j = first; j < last; j++)
+			{
+				auto f_begin = original_features.begin() + order[j] * fdim;
+				transform(features.begin(), features.end(), f_begin, features.begin(), plus<float>());
+			}
+			float count = (float)(last - first);
+			for (auto& f : features)
+				subsampled_features.push_back(f / count);
+		}
+
+		// Most frequent label (the smallest one in case of tie)
+		if (use_classes)
+		{
+			for (size_t l = 0; l < ldim; l++)
+			{
+				vector<int>& counts = label_counts[l];
+				int best_label = 0;
+				int best_count = 0;
+				for (size_t j = first; j < last; j++)
+				{
+					int label = original_classes[order[j] * ldim + l];
+					int count = ++counts[label - label_mins[l]];
+					if (count > best_count || (count == best_count && label < best_label))
+					{
+						best_label = label;
+						best_count = count;
+					}
+				}
+				subsampled_classes.push_back(best_label);
+
+				// Reset the counts for the next voxel
+				for (size_t j = first; j < last; j++)
+					counts[original_classes[order[j] * ldim + l] - label_mins[l]] = 0;
+			}
+		}
+	}
+}
+
+
+bool subsampling_method_from_name(const string& name, int& method)
+{
+	// "voxelcenters" was always computed as barycenters
+	if (name == "barycenters" || name == "voxelcenters")
+		method = SUBSAMPLING_BARYCENTERS;
+	else if (name == "first")
+		method = SUBSAMPLING_FIRST;
+	else if (name == "random")
+		method = SUBSAMPLING_RANDOM;
+	else if (name == "center")
+		method = SUBSAMPLING_CENTER;
+	else
+		return false;
+	return true;
+}
+
+
+// Points of a cloud sorted by voxel
+// *********************************
+
+class SortedVoxels
+{
+public:
+
+	// Grid
+	PointXYZ origin;
+	float dl;
+	size_t nx, ny, nz;
+
+	// Sorted voxel keys and the index of their point (points of a voxel keep their input order)
+	vector<uint64_t> keys;
+	vector<uint32_t> order;
+
+	// Tiles of whole z layers, which can be reduced independently
+	vector<size_t> tile_starts;
+
+	size_t num_tiles() const { return tile_starts.size() - 1; }
+
+	// Center of the voxel of a key
+	PointXYZ voxel_center(uint64_t key) const
+	{
+		size_t iX = key % nx;
+		size_t iY = (key / nx) % ny;
+		size_t iZ = key / (nx * ny);
+		return PointXYZ(origin.x + (iX + 0.5f) * dl, origin.y + (iY + 0.5f) * dl, origin.z + (iZ + 0.5f) * dl);
+	}
+};
+
+
+static void sort_by_voxel(ArrayView<PointXYZ> original_points,
+                          float sampleDl,
+                          int verbose,
+                          int num_threads,
+                          SortedVoxels& sorted)
+{
 
 	// Initialize variables
 	// ******************
@@ -17,10 +214,6 @@ void grid_subsampling(vector<PointXYZ>& original_points,
 	// Number of points in the cloud
 	size_t N = original_points.size();
 
-	// Dimension of the features
-	size_t fdim = original_features.size() / N;
-	size_t ldim = original_classes.size() / N;
-
 	// Limits of the cloud
 	PointXYZ minCorner = min_point(original_points);
 	PointXYZ maxCorner = max_point(original_points);
@@ -29,182 +222,483 @@ void grid_subsampling(vector<PointXYZ>& original_points,
 	// Dimensions of the grid
 	size_t sampleNX = (size_t)floor((maxCorner.x - originCorner.x) / sampleDl) + 1;
 	size_t sampleNY = (size_t)floor((maxCorner.y - originCorner.y) / sampleDl) + 1;
-	//size_t sampleNZ = (size_t)floor((maxCorner.z - originCorner.z) / sampleDl) + 1;
+	size_t sampleNZ = (size_t)floor((maxCorner.z - originCorner.z) / sampleDl) + 1;
+
+	sorted.origin = originCorner;
+	sorted.dl = sampleDl;
+	sorted.nx = sampleNX;
+	sorted.ny = sampleNY;
+	sorted.nz = sampleNZ;
 
-	// Check if features and classes need to be processed
-	bool use_feature = original_features.size() > 0;
-	bool use_classes = original_classes.size() > 0;
+	// Small clouds are not worth the threads, and tiles are z slabs of the grid
+	num_threads = resolve_num_threads(num_threads);
+	if (N < 65536 || sampleNZ > N)
+		num_threads = 1;
 
 
-	// Create the sampled map
-	// **********************
+	// Voxel keys
+	// **********
 
 	// Verbose parameters
-	int i = 0;
-	int nDisp = N / 100;
+	size_t nDisp = max(N / 100, (size_t)1);
+
+	// Voxel key of every point, and number of points in each z layer of the grid when using threads
+	vector<uint64_t> keys(N);
+	vector<vector<size_t>> chunk_layer_counts(num_threads);
+	parallel_for_chunks(N, num_threads, [&](int t, size_t i_begin, size_t i_end)
+	{
+		if (num_threads > 1)
+			chunk_layer_counts[t] = vector<size_t>(sampleNZ, 0);
+
+		size_t iX, iY, iZ;
+		for (size_t i = i_begin; i < i_end; i++)
+		{
+			// Position of point in sample map
+			PointXYZ& p = original_points[i];
+			iX = (size_t)floor((p.x - originCorner.x) / sampleDl);
+			iY = (size_t)floor((p.y - originCorner.y) / sampleDl);
+			iZ = (size_t)floor((p.z - originCorner.z) / sampleDl);
+			keys[i] = iX + sampleNX*iY + sampleNX*sampleNY*iZ;
+			if (num_threads > 1)
+				chunk_layer_counts[t][iZ]++;
+
+			// Display
+			if (verbose > 1 && t == 0 && (i + 1) % nDisp == 0)
+				std::cout << "\rSampled Map : " << std::setw(3) << (i + 1) * num_threads / nDisp << "%";
+		}
+	});
+
+
+	// Serial sort
+	// ***********
+
+	if (num_threads == 1)
+	{
+		sorted.keys.swap(keys);
+		sorted.order.resize(N);
+		for (size_t i = 0; i < N; i++)
+			sorted.order[i] = (uint32_t)i;
+		radix_sort_voxels(sorted.keys.data(), sorted.order.data(), N);
+		sorted.tile_starts = { 0, N };
+		return;
+	}
+
+
+	// Tiled sort
+	// **********
+
+	// Tiles are slabs of whole z layers: a voxel never spans two tiles, and the z index is the most significant part
+	// of the keys, so sorting the tiles independently gives exactly the serial order
+	size_t n_tiles = 4 * (size_t)num_threads;
+	vector<size_t> layer_tiles(sampleNZ);
+	size_t tile = 0;
+	size_t tile_count = 0;
+	for (size_t iZ = 0; iZ < sampleNZ; iZ++)
+	{
+		size_t layer_count = 0;
+		for (int t = 0; t < num_threads; t++)
+			layer_count += chunk_layer_counts[t][iZ];
+
+		// Start a new tile once the current one has its share of points
+		if (tile_count > 0 && tile_count + layer_count / 2 > N / n_tiles && tile + 1 < n_tiles)
+		{
+			tile++;
+			tile_count = 0;
+		}
+		layer_tiles[iZ] = tile;
+		tile_count += layer_count;
+	}
+	n_tiles = tile + 1;
+
+	// Offset of each chunk of points in each tile (stable partition, points keep their input order in a tile)
+	vector<size_t>& tile_starts = sorted.tile_starts;
+	tile_starts = vector<size_t>(n_tiles + 1, 0);
+	vector<vector<size_t>> chunk_offsets(num_threads, vector<size_t>(n_tiles, 0));
+	for (size_t iZ = 0; iZ < sampleNZ; iZ++)
+	{
+		for (int t = 0; t < num_threads; t++)
+			chunk_offsets[t][layer_tiles[iZ]] += chunk_layer_counts[t][iZ];
+	}
+	size_t offset = 0;
+	for (size_t k = 0; k < n_tiles; k++)
+	{
+		tile_starts[k] = offset;
+		for (int t = 0; t < num_threads; t++)
+		{
+			size_t count = chunk_offsets[t][k];
+			chunk_offsets[t][k] = offset;
+			offset += count;
+		}
+	}
+	tile_starts[n_tiles] = offset;
+
+	// Partition the keys and point indices by tile
+	sorted.keys.resize(N);
+	sorted.order.resize(N);
+	uint64_t layer_size = (uint64_t)sampleNX * sampleNY;
+	parallel_for_chunks(N, num_threads, [&](int t, size_t i_begin, size_t i_end)
+	{
+		vector<size_t>& offsets = chunk_offsets[t];
+		for (size_t i = i_begin; i < i_end; i++)
+		{
+			size_t j = offsets[layer_tiles[keys[i] / layer_size]]++;
+			sorted.keys[j] = keys[i];
+			sorted.order[j] = (uint32_t)i;
+		}
+	});
+	vector<uint64_t>().swap(keys);
+
+	// Sort the tiles independently
+	parallel_for_each(n_tiles, num_threads, [&](size_t k)
+	{
+		radix_sort_voxels(sorted.keys.data() + tile_starts[k],
+		                  sorted.order.data() + tile_starts[k],
+		                  tile_starts[k + 1] - tile_starts[k]);
+	});
+}
+
+
+// Shift the inverse indices of the points of each tile, computed relative to the first subsampled point of the tile
+static void offset_inverse_indices(SortedVoxels& sorted,
+                                   vector<size_t>& tile_offsets,
+                                   vector<int>& inverse_indices,
+                                   int num_threads)
+{
+	parallel_for_each(sorted.num_tiles(), num_threads, [&](size_t k)
+	{
+		for (size_t j = sorted.tile_starts[k]; j < sorted.tile_starts[k + 1]; j++)
+			inverse_indices[sorted.order[j]] += (int)tile_offsets[k];
+	});
+}
+
+
+// Subsampling methods
+// *******************
+
+void grid_subsampling(ArrayView<PointXYZ> original_points,
+                      vector<PointXYZ>& subsampled_points,
+                      ArrayView<float> original_features,
+                      vector<float>& subsampled_features,
+                      ArrayView<int> original_classes,
+                      vector<int>& subsampled_classes,
+                      float sampleDl,
+                      int verbose,
+                      int num_threads,
+                      vector<int>* inverse_indices) {
 
 	// Initialize variables
-	size_t iX, iY, iZ, mapIdx;
-	unordered_map<size_t, SampledData> data;
-
-	for (auto& p : original_points)
-	{
-		// Position of point in sample map
-		iX = (size_t)floor((p.x - originCorner.x) / sampleDl);
-		iY = (size_t)floor((p.y - originCorner.y) / sampleDl);
-		iZ = (size_t)floor((p.z - originCorner.z) / sampleDl);
-		mapIdx = iX + sampleNX*iY + sampleNX*sampleNY*iZ;
-
-		// If not already created, create key
-		if (data.count(mapIdx) < 1)
-			data.emplace(mapIdx, SampledData(fdim, ldim));
-
-		// Fill the sample map
-		if (use_feature && use_classes)
-			data[mapIdx].update_all(p, original_features.begin() + i * fdim, original_classes.begin() + i * ldim);
-		else if (use_feature)
-			data[mapIdx].update_features(p, original_features.begin() + i * fdim);
-		else if (use_classes)
-			data[mapIdx].update_classes(p, original_classes.begin() + i * ldim);
-		else
-			data[mapIdx].update_points(p);
-
-		// Display
-		i++;
-		if (verbose > 1 && i%nDisp == 0)
-			std::cout << "\rSampled Map : " << std::setw(3) << i / nDisp << "%";
+	// ******************
+
+	// Number of points in the cloud
+	size_t N = original_points.size();
+	if (N == 0)
+		return;
+
+	// Dimension of the features
+	size_t fdim = original_features.size() / N;
+	size_t ldim = original_classes.size() / N;
+
+	if (inverse_indices)
+		inverse_indices->resize(N);
 
+	// Points of a voxel are contiguous in the sorted order (and keep their input order)
+	SortedVoxels sorted;
+	sort_by_voxel(original_points, sampleDl, verbose, num_threads, sorted);
+	size_t n_tiles = sorted.num_tiles();
+
+	// Labels are voted over the range of each label dimension
+	vector<int> label_mins(ldim, 0);
+	vector<size_t> label_ranges(ldim, 0);
+	for (size_t l = 0; l < ldim; l++)
+	{
+		int l_min = original_classes[l];
+		int l_max = original_classes[l];
+		for (size_t i = 0; i < N; i++)
+		{
+			l_min = min(l_min, original_classes[i * ldim + l]);
+			l_max = max(l_max, original_classes[i * ldim + l]);
+		}
+		label_mins[l] = l_min;
+		label_ranges[l] = (size_t)((int64_t)l_max - (int64_t)l_min) + 1;
 	}
 
-	// Divide for barycentre and transfer to a vector
-	subsampled_points.reserve(data.size());
-	if (use_feature)
-		subsampled_features.reserve(data.size() * fdim);
-	if (use_classes)
-		subsampled_classes.reserve(data.size() * ldim);
-	for (auto& v : data)
+
+	// Serial subsampling
+	// ******************
+
+	if (n_tiles == 1)
 	{
-		subsampled_points.push_back(v.second.point * (1.0 / v.second.count));
-		if (use_feature)
+		reduce_voxels(sorted.keys.data(), sorted.order.data(), N, original_points, original_features, original_classes,
+		              fdim, ldim, label_mins, label_ranges, subsampled_points, subsampled_features, subsampled_classes,
+		              inverse_indices);
+		return;
+	}
+
+
+	// Tiled subsampling
+	// *****************
+
+	// Subsample the tiles independently
+	vector<vector<PointXYZ>> t_points(n_tiles);
+	vector<vector<float>> t_features(n_tiles);
+	vector<vector<int>> t_classes(n_tiles);
+	parallel_for_each(n_tiles, num_threads, [&](size_t k)
+	{
+		size_t t0 = sorted.tile_starts[k];
+		reduce_voxels(sorted.keys.data() + t0, sorted.order.data() + t0, sorted.tile_starts[k + 1] - t0,
+		              original_points, original_features, original_classes, fdim, ldim, label_mins, label_ranges,
+		              t_points[k], t_features[k], t_classes[k], inverse_indices);
+	});
+
+	// Merge the tiles
+	vector<size_t> tile_offsets(n_tiles);
+	for (size_t k = 0; k < n_tiles; k++)
+	{
+		tile_offsets[k] = subsampled_points.size();
+		subsampled_points.insert(subsampled_points.end(), t_points[k].begin(), t_points[k].end());
+		subsampled_features.insert(subsampled_features.end(), t_features[k].begin(), t_features[k].end());
+		subsampled_classes.insert(subsampled_classes.end(), t_classes[k].begin(), t_classes[k].end());
+	}
+	if (inverse_indices)
+		offset_inverse_indices(sorted, tile_offsets, *inverse_indices, num_threads);
+
+	return;
+}
+
+
+// Deterministic random number of a voxel (splitmix64), independent of the tiles and threads
+static inline uint64_t voxel_random(uint64_t seed, uint64_t key)
+{
+	uint64_t z = seed + key * 0x9E3779B97F4A7C15ULL;
+	z = (z ^ (z >> 30)) * 0xBF58476D1CE4E5B9ULL;
+	z = (z ^ (z >> 27)) * 0x94D049BB133111EBULL;
+	return z ^ (z >> 31);
+}
+
+
+// Representative point index of the voxels of a sorted range of points
+static void voxel_representatives(SortedVoxels& sorted,
+                                  size_t first_point,
+                                  size_t last_point,
+                                  ArrayView<PointXYZ> original_points,
+                                  int method,
+                                  uint64_t seed,
+                                  vector<int>& sampled_indices,
+                                  vector<int>* inverse_indices)
+{
+	size_t first = first_point;
+	for (size_t i = first_point; i < last_point; i++)
+	{
+		// Wait for the end of the voxel
+		uint64_t key = sorted.keys[i];
+		if (i + 1 < last_point && sorted.keys[i + 1] == key)
+			continue;
+		size_t last = i + 1;
+
+		// Choose the representative
+		size_t chosen = first;
+		if (method == SUBSAMPLING_RANDOM)
 		{
-		    float count = (float)v.second.count;
-		    transform(v.second.features.begin(),
-                      v.second.features.end(),
-                      v.second.features.begin(),
-                      [count](float f) { return f / count;});
-            subsampled_features.insert(subsampled_features.end(),v.second.features.begin(),v.second.features.end());
+			chosen = first + (size_t)(voxel_random(seed, key) % (last - first));
 		}
-		if (use_classes)
+		else if (method == SUBSAMPLING_CENTER)
+		{
+			// Closest point to the center (the first one in case of tie)
+			PointXYZ center = sorted.voxel_center(key);
+			float best_d2 = (original_points[sorted.order[first]] - center).sq_norm();
+			for (size_t j = first + 1; j < last; j++)
+			{
+				float d2 = (original_points[sorted.order[j]] - center).sq_norm();
+				if (d2 < best_d2)
+				{
+					best_d2 = d2;
+					chosen = j;
+				}
+			}
+		}
+
+		// Subsampled point of the original points
+		if (inverse_indices)
 		{
-		    for (int i = 0; i < ldim; i++)
-		        subsampled_classes.push_back(max_element(v.second.labels[i].begin(), v.second.labels[i].end(),
-		        [](const pair<int, int>&a, const pair<int, int>&b){return a.second < b.second;})->first);
+			for (size_t j = first; j < last; j++)
+				(*inverse_indices)[sorted.order[j]] = (int)sampled_indices.size();
 		}
+		sampled_indices.push_back((int)sorted.order[chosen]);
+		first = last;
+	}
+}
+
+
+void grid_subsampling_indices(ArrayView<PointXYZ> original_points,
+                              vector<int>& sampled_indices,
+                              float sampleDl,
+                              int method,
+                              uint64_t seed,
+                              int verbose,
+                              int num_threads,
+                              vector<int>* inverse_indices)
+{
+	// Number of points in the cloud
+	size_t N = original_points.size();
+	if (N == 0)
+		return;
+
+	if (inverse_indices)
+		inverse_indices->resize(N);
+
+	// Points of a voxel are contiguous in the sorted order (and keep their input order)
+	SortedVoxels sorted;
+	sort_by_voxel(original_points, sampleDl, verbose, num_threads, sorted);
+	size_t n_tiles = sorted.num_tiles();
+
+	// Representatives of each tile
+	vector<vector<int>> t_indices(n_tiles);
+	parallel_for_each(n_tiles, num_threads, [&](size_t k)
+	{
+		voxel_representatives(sorted, sorted.tile_starts[k], sorted.tile_starts[k + 1], original_points, method, seed,
+		                      t_indices[k], inverse_indices);
+	});
+
+	// Merge the tiles
+	vector<size_t> tile_offsets(n_tiles);
+	for (size_t k = 0; k < n_tiles; k++)
+	{
+		tile_offsets[k] = sampled_indices.size();
+		sampled_indices.insert(sampled_indices.end(), t_indices[k].begin(), t_indices[k].end());
 	}
+	if (inverse_indices)
+		offset_inverse_indices(sorted, tile_offsets, *inverse_indices, num_threads);
 
 	return;
 }
 
 
-void batch_grid_subsampling(vector<PointXYZ>& original_points,
+void batch_grid_subsampling(ArrayView<PointXYZ> original_points,
                               vector<PointXYZ>& subsampled_points,
-                              vector<float>& original_features,
+                              ArrayView<float> original_features,
                               vector<float>& subsampled_features,
-                              vector<int>& original_classes,
+                              ArrayView<int> original_classes,
                               vector<int>& subsampled_classes,
-                              vector<int>& original_batches,
+                              ArrayView<int> original_batches,
                               vector<int>& subsampled_batches,
                               float sampleDl,
-                              int max_p)
+                              int max_p,
+                              ArrayView<float> rotations,
+                              int num_threads,
+                              int method,
+                              uint64_t seed)
 {
 	// Initialize variables
 	// ******************
 
-	int b = 0;
-	int sum_b = 0;
-
-	// Number of points in the cloud
+	// Number of points in the cloud and of batch elements
 	size_t N = original_points.size();
+	size_t Nb = original_batches.size();
 
 	// Dimension of the features
-	size_t fdim = original_features.size() / N;
-	size_t ldim = original_classes.size() / N;
+	size_t fdim = N > 0 ? original_features.size() / N : 0;
+	size_t ldim = N > 0 ? original_classes.size() / N : 0;
 
 	// Handle max_p = 0
 	if (max_p < 1)
 	    max_p = N;
 
+	// First point of each batch element
+	vector<size_t> starts(Nb + 1, 0);
+	for (size_t b = 0; b < Nb; b++)
+		starts[b + 1] = starts[b] + original_batches[b];
+
+
 	// Loop over batches
 	// *****************
 
-	for (b = 0; b < original_batches.size(); b++)
+	// Batch elements are independent so they are subsampled in parallel
+	vector<vector<PointXYZ>> b_s_points(Nb);
+	vector<vector<float>> b_s_features(Nb);
+	vector<vector<int>> b_s_classes(Nb);
+	parallel_for_each(Nb, num_threads, [&](size_t b)
 	{
+		// Views on the batch points, features and labels (the points are only copied to be rotated)
+		size_t n = starts[b + 1] - starts[b];
+		ArrayView<PointXYZ> b_o_points(original_points.data() + starts[b], n);
+		ArrayView<float> b_o_features(original_features.data() + starts[b] * fdim, n * fdim);
+		ArrayView<int> b_o_classes(original_classes.data() + starts[b] * ldim, n * ldim);
+
+		// Rotate the points in the frame of the subsampling grid (p * R)
+		const float* R = rotations.empty() ? NULL : rotations.data() + 9 * b;
+		vector<PointXYZ> b_r_points;
+		if (R)
+		{
+			b_r_points.reserve(n);
+			for (auto& p : b_o_points)
+				b_r_points.push_back(PointXYZ(p.x * R[0] + p.y * R[3] + p.z * R[6],
+				                              p.x * R[1] + p.y * R[4] + p.z * R[7],
+				                              p.x * R[2] + p.y * R[5] + p.z * R[8]));
+			b_o_points = ArrayView<PointXYZ>(b_r_points);
+		}
 
-	    // Extract batch points features and labels
-	    vector<PointXYZ> b_o_points = vector<PointXYZ>(original_points.begin () + sum_b,
-	                                                   original_points.begin () + sum_b + original_batches[b]);
-
-        vector<float> b_o_features;
-        if (original_features.size() > 0)
-        {
-            b_o_features = vector<float>(original_features.begin () + sum_b * fdim,
-                                         original_features.begin () + (sum_b + original_batches[b]) * fdim);
-	    }
-
-	    vector<int> b_o_classes;
-        if (original_classes.size() > 0)
-        {
-            b_o_classes = vector<int>(original_classes.begin () + sum_b * ldim,
-                                      original_classes.begin () + sum_b + original_batches[b] * ldim);
-	    }
-
-
-        // Create result containers
-        vector<PointXYZ> b_s_points;
-        vector<float> b_s_features;
-        vector<int> b_s_classes;
+		// Representative points keep their original coordinates, features and labels
+		if (method != SUBSAMPLING_BARYCENTERS)
+		{
+			vector<int> b_s_inds;
+			grid_subsampling_indices(b_o_points, b_s_inds, sampleDl, method, seed + b, 0);
+			if (b_s_inds.size() > (size_t)max_p)
+				b_s_inds.resize(max_p);
+
+			b_s_points[b].reserve(b_s_inds.size());
+			b_s_features[b].reserve(b_s_inds.size() * fdim);
+			b_s_classes[b].reserve(b_s_inds.size() * ldim);
+			for (int i : b_s_inds)
+			{
+				size_t i0 = starts[b] + i;
+				b_s_points[b].push_back(original_points[i0]);
+				b_s_features[b].insert(b_s_features[b].end(),
+				                       original_features.begin() + i0 * fdim,
+				                       original_features.begin() + (i0 + 1) * fdim);
+				b_s_classes[b].insert(b_s_classes[b].end(),
+				                      original_classes.begin() + i0 * ldim,
+				                      original_classes.begin() + (i0 + 1) * ldim);
+			}
+			return;
+		}
 
         // Compute subsampling on current batch
         grid_subsampling(b_o_points,
-                         b_s_points,
+                         b_s_points[b],
                          b_o_features,
-                         b_s_features,
+                         b_s_features[b],
                          b_o_classes,
-                         b_s_classes,
+                         b_s_classes[b],
                          sampleDl,
 						 0);
 
-        // Stack batches points features and labels
-        // ****************************************
-
         // If too many points remove some
-        if (b_s_points.size() <= max_p)
+        if (b_s_points[b].size() > (size_t)max_p)
         {
-            subsampled_points.insert(subsampled_points.end(), b_s_points.begin(), b_s_points.end());
-
-            if (original_features.size() > 0)
-                subsampled_features.insert(subsampled_features.end(), b_s_features.begin(), b_s_features.end());
-
-            if (original_classes.size() > 0)
-                subsampled_classes.insert(subsampled_classes.end(), b_s_classes.begin(), b_s_classes.end());
-
-            subsampled_batches.push_back(b_s_points.size());
+            b_s_points[b].resize(max_p);
+            b_s_features[b].resize(max_p * fdim);
+            b_s_classes[b].resize(max_p * ldim);
         }
-        else
-        {
-            subsampled_points.insert(subsampled_points.end(), b_s_points.begin(), b_s_points.begin() + max_p);
 
-            if (original_features.size() > 0)
-                subsampled_features.insert(subsampled_features.end(), b_s_features.begin(), b_s_features.begin() + max_p * fdim);
+		// Rotate the subsampled points back (p * R^T)
+		if (R)
+		{
+			for (auto& p : b_s_points[b])
+				p = PointXYZ(p.x * R[0] + p.y * R[1] + p.z * R[2],
+				             p.x * R[3] + p.y * R[4] + p.z * R[5],
+				             p.x * R[6] + p.y * R[7] + p.z * R[8]);
+		}
+	});
 
-            if (original_classes.size() > 0)
-                subsampled_classes.insert(subsampled_classes.end(), b_s_classes.begin(), b_s_classes.begin() + max_p * ldim);
+    // Stack batches points features and labels
+    // ****************************************
 
-            subsampled_batches.push_back(max_p);
-        }
-
-        // Stack new batch lengths
-        sum_b += original_batches[b];
+	for (size_t b = 0; b < Nb; b++)
+	{
+		subsampled_points.insert(subsampled_points.end(), b_s_points[b].begin(), b_s_points[b].end());
+		subsampled_features.insert(subsampled_features.end(), b_s_features[b].begin(), b_s_features[b].end());
+		subsampled_classes.insert(subsampled_classes.end(), b_s_classes[b].begin(), b_s_classes[b].end());
+		subsampled_batches.push_back((int)b_s_points[b].size());
 	}
 
 	return;
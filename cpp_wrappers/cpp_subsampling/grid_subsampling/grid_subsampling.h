@@ -1,101 +1,72 @@
 
 
+# pragma once
+
 #include "../../cpp_utils/cloud/cloud.h"
+#include "../../cpp_utils/parallel/parallel.h"
 
 #include <set>
+#include <string>
 #include <cstdint>
 
 using namespace std;
 
-class SampledData
+// Subsampled point of each voxel of the grid: barycenter of its points, or the index of one of its points (the first
+// one in input order, a random one drawn from a seed, or the closest one to the center of the voxel)
+enum SubsamplingMethod
 {
-public:
-
-	// Elements
-	// ********
-
-	int count;
-	PointXYZ point;
-	vector<float> features;
-	vector<unordered_map<int, int>> labels;
-
-
-	// Methods
-	// *******
-
-	// Constructor
-	SampledData() 
-	{ 
-		count = 0; 
-		point = PointXYZ();
-	}
+	SUBSAMPLING_BARYCENTERS = 0,
+	SUBSAMPLING_FIRST = 1,
+	SUBSAMPLING_RANDOM = 2,
+	SUBSAMPLING_CENTER = 3
+};
 
-	SampledData(const size_t fdim, const size_t ldim)
-	{
-		count = 0;
-		point = PointXYZ();
-	    features = vector<float>(fdim);
-	    labels = vector<unordered_map<int, int>>(ldim);
-	}
+// Method of a name ("barycenters", "first", "random" or "center"), false if unknown
+bool subsampling_method_from_name(const string& name, int& method);
 
-	// Method Update
-	void update_all(const PointXYZ p, vector<float>::iterator f_begin, vector<int>::iterator l_begin)
-	{
-		count += 1;
-		point += p;
-		transform (features.begin(), features.end(), f_begin, features.begin(), plus<float>());
-		int i = 0;
-		for(vector<int>::iterator it = l_begin; it != l_begin + labels.size(); ++it)
-		{
-		    labels[i][*it] += 1;
-		    i++;
-		}
-		return;
-	}
-	void update_features(const PointXYZ p, vector<float>::iterator f_begin)
-	{
-		count += 1;
-		point += p;
-		transform (features.begin(), features.end(), f_begin, features.begin(), plus<float>());
-		return;
-	}
-	void update_classes(const PointXYZ p, vector<int>::iterator l_begin)
-	{
-		count += 1;
-		point += p;
-		int i = 0;
-		for(vector<int>::iterator it = l_begin; it != l_begin + labels.size(); ++it)
-		{
-		    labels[i][*it] += 1;
-		    i++;
-		}
-		return;
-	}
-	void update_points(const PointXYZ p)
-	{
-		count += 1;
-		point += p;
-		return;
-	}
-};
+// Stable LSD radix sort of n voxel keys, in place, along with their point indices (ties keep the input order)
+void radix_sort_voxels(uint64_t* keys, uint32_t* order, size_t n);
 
-void grid_subsampling(vector<PointXYZ>& original_points,
+// Barycenters of the points (with mean features and most frequent labels) in the voxels of a grid. If given,
+// inverse_indices receives the index of the subsampled point of the voxel containing each original point.
+void grid_subsampling(ArrayView<PointXYZ> original_points,
                       vector<PointXYZ>& subsampled_points,
-                      vector<float>& original_features,
+                      ArrayView<float> original_features,
                       vector<float>& subsampled_features,
-                      vector<int>& original_classes,
+                      ArrayView<int> original_classes,
                       vector<int>& subsampled_classes,
                       float sampleDl,
-                      int verbose);
+                      int verbose,
+                      int num_threads = 1,
+                      vector<int>* inverse_indices = NULL);
+
+// Index of a representative point in the voxels of a grid (in the same voxel order as grid_subsampling). The random
+// choice of a voxel only depends on the seed and on the voxel, not on the number of threads.
+void grid_subsampling_indices(ArrayView<PointXYZ> original_points,
+                              vector<int>& sampled_indices,
+                              float sampleDl,
+                              int method,
+                              uint64_t seed,
+                              int verbose,
+                              int num_threads = 1,
+                              vector<int>* inverse_indices = NULL);
 
-void batch_grid_subsampling(vector<PointXYZ>& original_points,
+// Grid subsampling of each element of a batch of stacked clouds (at most max_p points each if max_p > 0). If not
+// empty, rotations holds one row-major 3x3 matrix R per batch element: the grid is aligned with the frame p * R and
+// the subsampled points are rotated back. With an index method, the representative points are gathered with their
+// features and labels (element b uses the seed + b).
+void batch_grid_subsampling(ArrayView<PointXYZ> original_points,
                             vector<PointXYZ>& subsampled_points,
-                            vector<float>& original_features,
+                            ArrayView<float> original_features,
                             vector<float>& subsampled_features,
-                            vector<int>& original_classes,
+                            ArrayView<int> original_classes,
                             vector<int>& subsampled_classes,
-                            vector<int>& original_batches,
+                            ArrayView<int> original_batches,
                             vector<int>& subsampled_batches,
                             float sampleDl,
-                            int max_p);
+                            int max_p,
+                            ArrayView<float> rotations = ArrayView<float>(),
+                            int num_threads = 1,
+                            int method = SUBSAMPLING_BARYCENTERS,
+                            uint64_t seed = 0);
 
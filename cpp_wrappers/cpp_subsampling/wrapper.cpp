@@ -1,6 +1,7 @@
 #include <Python.h>
 #include <numpy/arrayobject.h>
 #include "grid_subsampling/grid_subsampling.h"
+#include "../cpp_utils/numpy/numpy_vector.h"
 #include <string>
 
 
@@ -10,9 +11,18 @@
 
 static char module_docstring[] = "This module provides an interface for the subsampling of a batch of stacked pointclouds";
 
-static char subsample_docstring[] = "function subsampling a pointcloud";
+static char subsample_docstring[] = "function subsampling a pointcloud. With num_threads > 1 (0 for all the available cores), "
+									"the grid is split in slabs subsampled in parallel, with exactly the same result. "
+									"With return_inverse=True, the index of the subsampled point of each original point is "
+									"returned last (int32 array of shape (N,)). The methods \"first\", \"random\" (drawn from seed) "
+									"and \"center\" (closest to the voxel center) return the int32 index of one representative "
+									"point per voxel instead of barycenters, features and classes are then gathered by the caller";
 
-static char subsample_batch_docstring[] = "function subsampling a batch of stacked pointclouds";
+static char subsample_batch_docstring[] = "function subsampling a batch of stacked pointclouds. Optional rotations (B, 3, 3) "
+										  "orient the grid of each batch element (points are subsampled in the frame p @ R and "
+										  "rotated back). Batch elements are split over num_threads threads. With the methods \"first\", "
+										  "\"random\" or \"center\", the representative points are returned with their original "
+										  "features and classes";
 
 
 // Declare the functions
@@ -72,26 +82,27 @@ static PyObject* batch_subsampling(PyObject* self, PyObject* args, PyObject* key
 	PyObject* batches_obj = NULL;
 
 	// Keywords containers
-	static char* kwlist[] = { "points", "batches", "features", "classes", "sampleDl", "method", "max_p", "verbose", NULL };
+	static char* kwlist[] = { "points", "batches", "features", "classes", "sampleDl", "method", "max_p", "verbose", "rotations", "num_threads", "seed", NULL };
 	float sampleDl = 0.1;
 	const char* method_buffer = "barycenters";
 	int verbose = 0;
 	int max_p = 0;
+	PyObject* rotations_obj = NULL;
+	int num_threads = 1;
+	unsigned long long seed = 0;
 
 	// Parse the input  
-	if (!PyArg_ParseTupleAndKeywords(args, keywds, "OO|$OOfsii", kwlist, &points_obj, &batches_obj, &features_obj, &classes_obj, &sampleDl, &method_buffer, &max_p, &verbose))
+	if (!PyArg_ParseTupleAndKeywords(args, keywds, "OO|$OOfsiiOiK", kwlist, &points_obj, &batches_obj, &features_obj, &classes_obj, &sampleDl, &method_buffer, &max_p, &verbose, &rotations_obj, &num_threads, &seed))
 	{
 		PyErr_SetString(PyExc_RuntimeError, "Error parsing arguments");
 		return NULL;
 	}
 
-	// Get the method argument
-	string method(method_buffer);
-
 	// Interpret method
-	if (method.compare("barycenters") && method.compare("voxelcenters"))
+	int method;
+	if (!subsampling_method_from_name(string(method_buffer), method))
 	{
-		PyErr_SetString(PyExc_RuntimeError, "Error parsing method. Valid method names are \"barycenters\" and \"voxelcenters\" ");
+		PyErr_SetString(PyExc_RuntimeError, "Error parsing method. Valid method names are \"barycenters\", \"first\", \"random\" and \"center\" ");
 		return NULL;
 	}
 
@@ -226,6 +237,24 @@ static PyObject* batch_subsampling(PyObject* self, PyObject* args, PyObject* key
 	}
 
 
+	// Interpret the optional rotations
+	PyObject* rotations_array = NULL;
+	if (rotations_obj != NULL && rotations_obj != Py_None)
+	{
+		rotations_array = PyArray_FROM_OTF(rotations_obj, NPY_FLOAT, NPY_IN_ARRAY);
+		if (rotations_array == NULL || (int)PyArray_SIZE(rotations_array) != Nb * 9)
+		{
+			Py_XDECREF(points_array);
+			Py_XDECREF(batches_array);
+			Py_XDECREF(classes_array);
+			Py_XDECREF(features_array);
+			Py_XDECREF(rotations_array);
+			PyErr_SetString(PyExc_RuntimeError, "Error converting rotations to a float32 array of shape (B, 3, 3)");
+			return NULL;
+		}
+	}
+
+
 	// Call the C++ function
 	// *********************
 
@@ -234,23 +263,29 @@ static PyObject* batch_subsampling(PyObject* self, PyObject* args, PyObject* key
 		cout << "Computing cloud pyramid with support points: " << endl;
 
 
-	// Convert PyArray to Cloud C++ class
-	vector<PointXYZ> original_points;
-	vector<int> original_batches;
-	vector<float> original_features;
-	vector<int> original_classes;
-	original_points = vector<PointXYZ>((PointXYZ*)PyArray_DATA(points_array), (PointXYZ*)PyArray_DATA(points_array) + N);
-	original_batches = vector<int>((int*)PyArray_DATA(batches_array), (int*)PyArray_DATA(batches_array) + Nb);
+	// The inputs are read in place in the numpy buffers
+	ArrayView<PointXYZ> original_points = numpy_view<PointXYZ>(points_array, N);
+	ArrayView<int> original_batches = numpy_view<int>(batches_array, Nb);
+	ArrayView<float> original_features;
+	ArrayView<int> original_classes;
+	ArrayView<float> rotations;
 	if (use_feature)
-		original_features = vector<float>((float*)PyArray_DATA(features_array), (float*)PyArray_DATA(features_array) + N * fdim);
+		original_features = numpy_view<float>(features_array, N * fdim);
 	if (use_classes)
-		original_classes = vector<int>((int*)PyArray_DATA(classes_array), (int*)PyArray_DATA(classes_array) + N * ldim);
+		original_classes = numpy_view<int>(classes_array, N * ldim);
+	if (rotations_array != NULL)
+		rotations = numpy_view<float>(rotations_array, Nb * 9);
 
-	// Subsample
+	// Containers for the C++ function
 	vector<PointXYZ> subsampled_points;
 	vector<float> subsampled_features;
 	vector<int> subsampled_classes;
 	vector<int> subsampled_batches;
+
+	// Release the GIL during the heavy computation, the numpy arrays are kept alive by our references
+	Py_BEGIN_ALLOW_THREADS
+
+	// Subsample
 	batch_grid_subsampling(original_points,
 							subsampled_points,
 							original_features,
@@ -260,7 +295,13 @@ static PyObject* batch_subsampling(PyObject* self, PyObject* args, PyObject* key
 							original_batches,
 							subsampled_batches,
 							sampleDl,
-							max_p);
+							max_p,
+							rotations,
+							num_threads,
+							method,
+							(uint64_t)seed);
+
+	Py_END_ALLOW_THREADS
 
 	// Check result
 	if (subsampled_points.size() < 1)
@@ -272,43 +313,22 @@ static PyObject* batch_subsampling(PyObject* self, PyObject* args, PyObject* key
 	// Manage outputs
 	// **************
 
-	// Dimension of input containers
-	npy_intp* point_dims = new npy_intp[2];
-	point_dims[0] = subsampled_points.size();
-	point_dims[1] = 3;
-	npy_intp* feature_dims = new npy_intp[2];
-	feature_dims[0] = subsampled_points.size();
-	feature_dims[1] = fdim;
-	npy_intp* classes_dims = new npy_intp[2];
-	classes_dims[0] = subsampled_points.size();
-	classes_dims[1] = ldim;
-	npy_intp* batches_dims = new npy_intp[1];
-	batches_dims[0] = Nb;
-
-	// Create output array
-	PyObject* res_points_obj = PyArray_SimpleNew(2, point_dims, NPY_FLOAT);
-	PyObject* res_batches_obj = PyArray_SimpleNew(1, batches_dims, NPY_INT);
+	// Dimension of output containers
+	npy_intp point_dims[2] = { (npy_intp)subsampled_points.size(), 3 };
+	npy_intp feature_dims[2] = { (npy_intp)subsampled_points.size(), fdim };
+	npy_intp classes_dims[2] = { (npy_intp)subsampled_points.size(), ldim };
+	npy_intp batches_dims[1] = { Nb };
+
+	// The output arrays take over the memory of the results (no copy)
+	PyObject* res_points_obj = vector_to_numpy(subsampled_points, 2, point_dims, NPY_FLOAT);
+	PyObject* res_batches_obj = vector_to_numpy(subsampled_batches, 1, batches_dims, NPY_INT);
 	PyObject* res_features_obj = NULL;
 	PyObject* res_classes_obj = NULL;
 	PyObject* ret = NULL;
-
-	// Fill output array with values
-	size_t size_in_bytes = subsampled_points.size() * 3 * sizeof(float);
-	memcpy(PyArray_DATA(res_points_obj), subsampled_points.data(), size_in_bytes);
-	size_in_bytes = Nb * sizeof(int);
-	memcpy(PyArray_DATA(res_batches_obj), subsampled_batches.data(), size_in_bytes);
 	if (use_feature)
-	{
-		size_in_bytes = subsampled_points.size() * fdim * sizeof(float);
-		res_features_obj = PyArray_SimpleNew(2, feature_dims, NPY_FLOAT);
-		memcpy(PyArray_DATA(res_features_obj), subsampled_features.data(), size_in_bytes);
-	}
+		res_features_obj = vector_to_numpy(subsampled_features, 2, feature_dims, NPY_FLOAT);
 	if (use_classes)
-	{
-		size_in_bytes = subsampled_points.size() * ldim * sizeof(int);
-		res_classes_obj = PyArray_SimpleNew(2, classes_dims, NPY_INT);
-		memcpy(PyArray_DATA(res_classes_obj), subsampled_classes.data(), size_in_bytes);
-	}
+		res_classes_obj = vector_to_numpy(subsampled_classes, 2, classes_dims, NPY_INT);
 
 
 	// Merge results
@@ -328,6 +348,7 @@ static PyObject* batch_subsampling(PyObject* self, PyObject* args, PyObject* key
 	Py_DECREF(batches_array);
 	Py_XDECREF(features_array);
 	Py_XDECREF(classes_array);
+	Py_XDECREF(rotations_array);
 
 	return ret;
 }
@@ -347,25 +368,26 @@ static PyObject* cloud_subsampling(PyObject* self, PyObject* args, PyObject* key
 	PyObject* classes_obj = NULL;
 
 	// Keywords containers
-	static char* kwlist[] = { "points", "features", "classes", "sampleDl", "method", "verbose", NULL };
+	static char* kwlist[] = { "points", "features", "classes", "sampleDl", "method", "verbose", "num_threads", "return_inverse", "seed", NULL };
 	float sampleDl = 0.1;
 	const char* method_buffer = "barycenters";
 	int verbose = 0;
+	int num_threads = 1;
+	int return_inverse = 0;
+	unsigned long long seed = 0;
 
 	// Parse the input  
-	if (!PyArg_ParseTupleAndKeywords(args, keywds, "O|$OOfsi", kwlist, &points_obj, &features_obj, &classes_obj, &sampleDl, &method_buffer, &verbose))
+	if (!PyArg_ParseTupleAndKeywords(args, keywds, "O|$OOfsiipK", kwlist, &points_obj, &features_obj, &classes_obj, &sampleDl, &method_buffer, &verbose, &num_threads, &return_inverse, &seed))
 	{
 		PyErr_SetString(PyExc_RuntimeError, "Error parsing arguments");
 		return NULL;
 	}
 
-	// Get the method argument
-	string method(method_buffer);
-
 	// Interpret method
-	if (method.compare("barycenters") && method.compare("voxelcenters"))
+	int method;
+	if (!subsampling_method_from_name(string(method_buffer), method))
 	{
-		PyErr_SetString(PyExc_RuntimeError, "Error parsing method. Valid method names are \"barycenters\" and \"voxelcenters\" ");
+		PyErr_SetString(PyExc_RuntimeError, "Error parsing method. Valid method names are \"barycenters\", \"first\", \"random\" and \"center\" ");
 		return NULL;
 	}
 
@@ -376,6 +398,13 @@ static PyObject* cloud_subsampling(PyObject* self, PyObject* args, PyObject* key
 	if (classes_obj == NULL)
 		use_classes = false;
 
+	// Index methods do not reduce features or classes
+	if (method != SUBSAMPLING_BARYCENTERS && (use_feature || use_classes))
+	{
+		PyErr_SetString(PyExc_RuntimeError, "Index methods only return indices, gather the features and classes with them");
+		return NULL;
+	}
+
 	// Interpret the input objects as numpy arrays.
 	PyObject* points_array = PyArray_FROM_OTF(points_obj, NPY_FLOAT, NPY_IN_ARRAY);
 	PyObject* features_array = NULL;
@@ -478,75 +507,109 @@ static PyObject* cloud_subsampling(PyObject* self, PyObject* args, PyObject* key
 		cout << "Computing cloud pyramid with support points: " << endl;
 
 
-	// Convert PyArray to Cloud C++ class
-	vector<PointXYZ> original_points;
-	vector<float> original_features;
-	vector<int> original_classes;
-	original_points = vector<PointXYZ>((PointXYZ*)PyArray_DATA(points_array), (PointXYZ*)PyArray_DATA(points_array) + N);
+	// The inputs are read in place in the numpy buffers
+	ArrayView<PointXYZ> original_points = numpy_view<PointXYZ>(points_array, N);
+	ArrayView<float> original_features;
+	ArrayView<int> original_classes;
 	if (use_feature)
-		original_features = vector<float>((float*)PyArray_DATA(features_array), (float*)PyArray_DATA(features_array) + N * fdim);
+		original_features = numpy_view<float>(features_array, N * fdim);
 	if (use_classes)
-		original_classes = vector<int>((int*)PyArray_DATA(classes_array), (int*)PyArray_DATA(classes_array) + N * ldim);
+		original_classes = numpy_view<int>(classes_array, N * ldim);
 
-	// Subsample
+	// Containers for the C++ function
 	vector<PointXYZ> subsampled_points;
 	vector<float> subsampled_features;
 	vector<int> subsampled_classes;
-	grid_subsampling(original_points,
-		subsampled_points,
-		original_features,
-		subsampled_features,
-		original_classes,
-		subsampled_classes,
-		sampleDl,
-		verbose);
+	vector<int> sampled_indices;
+	vector<int> inverse_indices;
+
+	// Release the GIL during the heavy computation, the numpy arrays are kept alive by our references
+	Py_BEGIN_ALLOW_THREADS
+
+	// Subsample
+	if (method == SUBSAMPLING_BARYCENTERS)
+	{
+		grid_subsampling(original_points,
+			subsampled_points,
+			original_features,
+			subsampled_features,
+			original_classes,
+			subsampled_classes,
+			sampleDl,
+			verbose,
+			num_threads,
+			return_inverse ? &inverse_indices : NULL);
+	}
+	else
+	{
+		grid_subsampling_indices(original_points,
+			sampled_indices,
+			sampleDl,
+			method,
+			(uint64_t)seed,
+			verbose,
+			num_threads,
+			return_inverse ? &inverse_indices : NULL);
+	}
+
+	Py_END_ALLOW_THREADS
 
 	// Check result
-	if (subsampled_points.size() < 1)
+	if (subsampled_points.size() < 1 && sampled_indices.size() < 1)
 	{
 		PyErr_SetString(PyExc_RuntimeError, "Error");
 		return NULL;
 	}
 
+	// Index methods return the representative points indices (and the inverse indices)
+	if (method != SUBSAMPLING_BARYCENTERS)
+	{
+		npy_intp indices_dims[1] = { (npy_intp)sampled_indices.size() };
+		PyObject* res_indices_obj = vector_to_numpy(sampled_indices, 1, indices_dims, NPY_INT);
+		Py_DECREF(points_array);
+		if (!return_inverse)
+			return res_indices_obj;
+
+		npy_intp inverse_dims[1] = { (npy_intp)inverse_indices.size() };
+		PyObject* res_inverse_obj = vector_to_numpy(inverse_indices, 1, inverse_dims, NPY_INT);
+		return Py_BuildValue("NN", res_indices_obj, res_inverse_obj);
+	}
+
 	// Manage outputs
 	// **************
 
-	// Dimension of input containers
-	npy_intp* point_dims = new npy_intp[2];
-	point_dims[0] = subsampled_points.size();
-	point_dims[1] = 3;
-	npy_intp* feature_dims = new npy_intp[2];
-	feature_dims[0] = subsampled_points.size();
-	feature_dims[1] = fdim;
-	npy_intp* classes_dims = new npy_intp[2];
-	classes_dims[0] = subsampled_points.size();
-	classes_dims[1] = ldim;
-
-	// Create output array
-	PyObject* res_points_obj = PyArray_SimpleNew(2, point_dims, NPY_FLOAT);
+	// Dimension of output containers
+	npy_intp point_dims[2] = { (npy_intp)subsampled_points.size(), 3 };
+	npy_intp feature_dims[2] = { (npy_intp)subsampled_points.size(), fdim };
+	npy_intp classes_dims[2] = { (npy_intp)subsampled_points.size(), ldim };
+
+	// The output arrays take over the memory of the results (no copy)
+	PyObject* res_points_obj = vector_to_numpy(subsampled_points, 2, point_dims, NPY_FLOAT);
 	PyObject* res_features_obj = NULL;
 	PyObject* res_classes_obj = NULL;
 	PyObject* ret = NULL;
-
-	// Fill output array with values
-	size_t size_in_bytes = subsampled_points.size() * 3 * sizeof(float);
-	memcpy(PyArray_DATA(res_points_obj), subsampled_points.data(), size_in_bytes);
 	if (use_feature)
-	{
-		size_in_bytes = subsampled_points.size() * fdim * sizeof(float);
-		res_features_obj = PyArray_SimpleNew(2, feature_dims, NPY_FLOAT);
-		memcpy(PyArray_DATA(res_features_obj), subsampled_features.data(), size_in_bytes);
-	}
+		res_features_obj = vector_to_numpy(subsampled_features, 2, feature_dims, NPY_FLOAT);
 	if (use_classes)
-	{
-		size_in_bytes = subsampled_points.size() * ldim * sizeof(int);
-		res_classes_obj = PyArray_SimpleNew(2, classes_dims, NPY_INT);
-		memcpy(PyArray_DATA(res_classes_obj), subsampled_classes.data(), size_in_bytes);
-	}
+		res_classes_obj = vector_to_numpy(subsampled_classes, 2, classes_dims, NPY_INT);
 
 
 	// Merge results
-	if (use_feature && use_classes)
+	if (return_inverse)
+	{
+		npy_intp inverse_dims[1] = { (npy_intp)inverse_indices.size() };
+		PyObject* res_inverse_obj = vector_to_numpy(inverse_indices, 1, inverse_dims, NPY_INT);
+
+		if (use_feature && use_classes)
+			ret = Py_BuildValue("NNNN", res_points_obj, res_features_obj, res_classes_obj, res_inverse_obj);
+		else if (use_feature)
+			ret = Py_BuildValue("NNN", res_points_obj, res_features_obj, res_inverse_obj);
+		else if (use_classes)
+			ret = Py_BuildValue("NNN", res_points_obj, res_classes_obj, res_inverse_obj);
+		else
+			ret = Py_BuildValue("NN", res_points_obj, res_inverse_obj);
+	}
+	else if (use_feature && use_classes)
 		ret = Py_BuildValue("NNN", res_points_obj, res_features_obj, res_classes_obj);
 	else if (use_feature)
 		ret = Py_BuildValue("NN", res_points_obj, res_features_obj);
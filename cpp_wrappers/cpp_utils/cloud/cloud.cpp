@@ -24,13 +24,13 @@
 // Getters
 // *******
 
-PointXYZ max_point(std::vector<PointXYZ> points)
+PointXYZ max_point(ArrayView<PointXYZ> points)
 {
 	// Initialize limits
 	PointXYZ maxP(points[0]);
 
 	// Loop over all points
-	for (auto p : points)
+	for (auto& p : points)
 	{
 		if (p.x > maxP.x)
 			maxP.x = p.x;
@@ -45,13 +45,13 @@ PointXYZ max_point(std::vector<PointXYZ> points)
 	return maxP;
 }
 
-PointXYZ min_point(std::vector<PointXYZ> points)
+PointXYZ min_point(ArrayView<PointXYZ> points)
 {
 	// Initialize limits
 	PointXYZ minP(points[0]);
 
 	// Loop over all points
-	for (auto p : points)
+	for (auto& p : points)
 	{
 		if (p.x < minP.x)
 			minP.x = p.x;
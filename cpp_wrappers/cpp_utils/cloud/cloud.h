@@ -143,8 +143,33 @@ inline PointXYZ floor(const PointXYZ P)
 }
 
 
-PointXYZ max_point(std::vector<PointXYZ> points);
-PointXYZ min_point(std::vector<PointXYZ> points);
+// Array view
+// **********
+
+// Non-owning view of contiguous elements: a vector, or a numpy buffer read in place by the wrappers
+template <class T>
+class ArrayView
+{
+public:
+
+	T* ptr;
+	size_t n;
+
+	ArrayView() : ptr(NULL), n(0) {}
+	ArrayView(T* ptr0, size_t n0) : ptr(ptr0), n(n0) {}
+	ArrayView(std::vector<T>& v) : ptr(v.data()), n(v.size()) {}
+
+	inline size_t size() const { return n; }
+	inline bool empty() const { return n == 0; }
+	inline T* data() const { return ptr; }
+	inline T* begin() const { return ptr; }
+	inline T* end() const { return ptr + n; }
+	inline T& operator [] (size_t i) const { return ptr[i]; }
+};
+
+
+PointXYZ max_point(ArrayView<PointXYZ> points);
+PointXYZ min_point(ArrayView<PointXYZ> points);
 
 
 struct PointCloud
@@ -0,0 +1,83 @@
+//
+//
+//		0==========================0
+//		|    Local feature test    |
+//		0==========================0
+//
+//		version 1.0 :
+//			>
+//
+//---------------------------------------------------
+//
+//		Numpy vector header
+//		Zero-copy conversions between numpy arrays and the C++ containers of the wrappers
+//
+//----------------------------------------------------
+//
+//		Must be included after <numpy/arrayobject.h>
+//
+
+
+# pragma once
+
+#include "../cloud/cloud.h"
+
+#include <vector>
+
+
+// Inputs
+// ******
+
+// View of the data of a contiguous numpy array (converted with PyArray_FROM_OTF), read in place
+template <class T>
+inline ArrayView<T> numpy_view(PyObject* array, size_t n)
+{
+	return ArrayView<T>((T*)PyArray_DATA((PyArrayObject*)array), n);
+}
+
+
+// Outputs
+// *******
+
+template <class T>
+static void delete_vector_capsule(PyObject* capsule)
+{
+	delete (std::vector<T>*)PyCapsule_GetPointer(capsule, "numpy_vector");
+}
+
+// Numpy array taking over the memory of a vector, which is left empty. The data is not copied: the array keeps the
+// vector alive through its base object and frees it with the array.
+template <class T>
+static PyObject* vector_to_numpy(std::vector<T>& data, int nd, npy_intp* dims, int typenum)
+{
+	// Empty arrays own their (empty) data
+	if (data.empty())
+		return PyArray_SimpleNew(nd, dims, typenum);
+
+	std::vector<T>* owner = new std::vector<T>();
+	owner->swap(data);
+
+	PyObject* array = PyArray_SimpleNewFromData(nd, dims, typenum, (void*)owner->data());
+	if (array == NULL)
+	{
+		delete owner;
+		return NULL;
+	}
+
+	PyObject* capsule = PyCapsule_New((void*)owner, "numpy_vector", delete_vector_capsule<T>);
+	if (capsule == NULL)
+	{
+		delete owner;
+		Py_DECREF(array);
+		return NULL;
+	}
+
+	// The base object reference is stolen, even on failure (the capsule then frees the vector)
+	if (PyArray_SetBaseObject((PyArrayObject*)array, capsule) < 0)
+	{
+		Py_DECREF(array);
+		return NULL;
+	}
+
+	return array;
+}
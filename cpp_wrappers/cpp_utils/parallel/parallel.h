@@ -0,0 +1,103 @@
+//
+//
+//		0==========================0
+//		|    Local feature test    |
+//		0==========================0
+//
+//		version 1.0 : 
+//			> 
+//
+//---------------------------------------------------
+//
+//		Parallel header
+//		Minimal helpers to split a loop over a pool of std::thread
+//
+//----------------------------------------------------
+//
+
+
+# pragma once
+
+#include <vector>
+#include <thread>
+#include <atomic>
+#include <algorithm>
+
+
+// Number of threads
+// *****************
+
+// Interpret a user given number of threads (0 or negative means all the available cores)
+inline int resolve_num_threads(int num_threads)
+{
+	if (num_threads < 1)
+	{
+		num_threads = (int)std::thread::hardware_concurrency();
+		if (num_threads < 1)
+			num_threads = 1;
+	}
+	return num_threads;
+}
+
+
+// Parallel loops
+// **************
+
+// Split [0, n) in contiguous chunks and call func(thread_id, begin, end) for each of them. The calling thread
+// processes the first chunk, so that num_threads = 1 does not spawn any thread.
+template <typename Func>
+void parallel_for_chunks(size_t n, int num_threads, Func func)
+{
+	num_threads = resolve_num_threads(num_threads);
+	if ((size_t)num_threads > n)
+		num_threads = (int)std::max(n, (size_t)1);
+
+	size_t chunk = (n + num_threads - 1) / num_threads;
+
+	std::vector<std::thread> workers;
+	workers.reserve(num_threads - 1);
+	for (int t = 1; t < num_threads; t++)
+	{
+		size_t begin = std::min(n, t * chunk);
+		size_t end = std::min(n, begin + chunk);
+		workers.emplace_back(func, t, begin, end);
+	}
+	func(0, (size_t)0, std::min(n, chunk));
+
+	for (auto& w : workers)
+		w.join();
+}
+
+// Call func(i) for every i in [0, n), dynamically distributing the indices to the threads. Better suited than
+// contiguous chunks when the work per index is very uneven (e.g. one index per batch element).
+template <typename Func>
+void parallel_for_each(size_t n, int num_threads, Func func)
+{
+	num_threads = resolve_num_threads(num_threads);
+	if ((size_t)num_threads > n)
+		num_threads = (int)std::max(n, (size_t)1);
+
+	if (num_threads == 1)
+	{
+		for (size_t i = 0; i < n; i++)
+			func(i);
+		return;
+	}
+
+	std::atomic<size_t> next(0);
+	auto worker = [&]()
+	{
+		size_t i;
+		while ((i = next.fetch_add(1)) < n)
+			func(i);
+	};
+
+	std::vector<std::thread> workers;
+	workers.reserve(num_threads - 1);
+	for (int t = 1; t < num_threads; t++)
+		workers.emplace_back(worker);
+	worker();
+
+	for (auto& w : workers)
+		w.join();
+}
@@ -10,13 +10,21 @@ import numpy as np
 import torch
 import laspy
 
-from datasets.common import PointCloudDataset, grid_subsampling
+from datasets.common import PointCloudDataset, grid_subsampling, save_cloud_arrays, load_cloud_arrays
+from datasets.common import RaggedNeighbors, neighbors_from_numpy, neighbors_counts
 from utils.config import Config, bcolors
+from utils.cache import CacheManifest
 from utils.mayavi_visu import *
+from datasets.common import KDTree, PotentialTree, ShardedPotentials, GridAccumulator, tree_points
+from datasets.common import prepare_clouds, input_worker_id
 
 class LASDataset(PointCloudDataset):
     """Class to handle LAS-format dataset"""
 
+    # Coarsest step of the 16 bits quantized coordinates, in fractions of first_subsampling_dl (wider clouds are
+    # quantized on 32 bits)
+    quantization_steps = 16
+
     def __init__(self, config:Config, set:str="training", 
                  use_potentials:bool=True, load_data:bool=True, 
                  path:str=r"..\..\Data\small_dataset"):
@@ -106,6 +114,7 @@ class LASDataset(PointCloudDataset):
         
         # Initiate containers
         self.input_trees: List[KDTree] = []
+        self.input_origins = []
         self.input_intensity = []
         self.input_labels = []
         self.pot_trees: List[KDTree] = []
@@ -123,17 +132,17 @@ class LASDataset(PointCloudDataset):
         # Initialize potentials
         if use_potentials:
             self.potentials = []
+            self.potential_trees = []
             self.min_potentials = []
             self.argmin_potentials = []
             for i, tree in enumerate(self.pot_trees):
-                self.potentials += [
-                    torch.from_numpy(np.random.rand(tree.data.shape[0]) * 1e-3)
-                ]
-                min_ind = int(torch.argmin(self.potentials[-1]))
+                self.potential_trees += [PotentialTree(np.random.rand(tree.data.shape[0]) * 1e-3)]
+                self.potentials += [self.potential_trees[-1].potentials]
+                min_ind, min_pot = self.potential_trees[-1].argmin()
                 self.argmin_potentials += [min_ind]
-                self.min_potentials += [float(self.potentials[-1][min_ind])]
+                self.min_potentials += [min_pot]
 
-            # Share potential memory
+            # Share potential memory (the potential trees are created in shared memory)
             self.argmin_potentials = torch.from_numpy(
                 np.array(self.argmin_potentials, dtype=np.int64)
             )
@@ -142,8 +151,21 @@ class LASDataset(PointCloudDataset):
             )
             self.argmin_potentials.share_memory_()
             self.min_potentials.share_memory_()
-            for i, _ in enumerate(self.pot_trees):
-                self.potentials[i].share_memory_()
+
+            # Potentials partitioned across the input workers, each one drawing its spheres in its own shard
+            if config.sharded_potentials:
+                self.sharded_potentials = ShardedPotentials(
+                    [tree.data for tree in self.pot_trees],
+                    self.potentials,
+                    config.input_threads,
+                    2 * config.in_radius,
+                )
+                self.potentials = self.sharded_potentials.potentials
+                self.min_potentials = self.sharded_potentials.min_potentials
+                self.potential_trees = None
+                self.argmin_potentials = None
+            else:
+                self.sharded_potentials = None
 
             self.worker_waiting = torch.tensor(
                 [0 for _ in range(config.input_threads)], dtype=torch.int32
@@ -154,6 +176,8 @@ class LASDataset(PointCloudDataset):
 
         else:
             self.potentials = None
+            self.potential_trees = None
+            self.sharded_potentials = None
             self.min_potentials = None
             self.argmin_potentials = None
             self.epoch_inds = torch.from_numpy(
@@ -199,35 +223,26 @@ class LASDataset(PointCloudDataset):
         batch_n = 0
         failed_attempts = 0
 
-        info = torch.utils.data.get_worker_info()
-        if info is not None:
-            wid = info.id
-        else:
-            wid = None
+        wid = input_worker_id()
+
+        # Worker states are only displayed from the input workers (not when
+        # loading from the main process)
+        debug_workers = debug_workers and wid is not None
+
+        pending = []
 
         while True:
             t += [time.time()]
 
-            if debug_workers:
-                message = ""
-                for wi in range(info.num_workers):
-                    if wi == wid:
-                        message += f" {bcolors.FAIL}X{bcolors.ENDC} "
-                    elif self.worker_waiting[wi] == 0:
-                        message += "   "
-                    elif self.worker_waiting[wi] == 1:
-                        message += " | "
-                    elif self.worker_waiting[wi] == 2:
-                        message += " o "
-                print(message)
-                self.worker_waiting[wid] = 0
+            # Draw new sphere centers once the previous ones are used (the centers left when the batch is full are
+            # dropped, their potentials stay updated)
+            if not pending:
 
-            with self.worker_lock:
                 if debug_workers:
                     message = ""
-                    for wi in range(info.num_workers):
+                    for wi in range(len(self.worker_waiting)):
                         if wi == wid:
-                            message += f" {bcolors.FAIL}v{bcolors.ENDC} "
+                            message += f" {bcolors.FAIL}X{bcolors.ENDC} "
                         elif self.worker_waiting[wi] == 0:
                             message += "   "
                         elif self.worker_waiting[wi] == 1:
@@ -235,62 +250,44 @@ class LASDataset(PointCloudDataset):
                         elif self.worker_waiting[wi] == 2:
                             message += " o "
                     print(message)
-                    self.worker_waiting[wid] = 1
+                    self.worker_waiting[wid] = 0
 
-                # Get potential minimum
-                cloud_ind = int(torch.argmin(self.min_potentials))
-                point_ind = int(self.argmin_potentials[cloud_ind])
-
-                # Get potential points from tree structure
-                pot_points = np.array(self.pot_trees[cloud_ind].data, 
-                                      copy=False)
-
-                # Center point of input region
-                center_point = np.copy(pot_points[point_ind, :].reshape(1, -1))
-
-                # Add small noise to center point
-                if self.set != "ERF":
-                    center_point += np.clip(
-                        np.random.normal(
-                            scale = self.config.in_radius / 10,
-                            size=center_point.shape
-                        ),
-                        -self.config.in_radius / 2,
-                        self.config.in_radius / 2,
-                    )
-
-                # Indices of points in input region
-                pot_inds, dists = self.pot_trees[cloud_ind].query_radius(
-                    center_point,
-                    r=self.config.in_radius,
-                    return_distance=True
-                )
-
-                d2s = np.square(dists[0])
-                pot_inds = pot_inds[0]
-
-                # Update potentials (Tukey weights)
-                if self.set != "ERF":
-                    tukeys = np.square(
-                        1 - d2s / np.square(self.config.in_radius)
-                    )
-                    tukeys[d2s > np.square(self.config.in_radius)] = 0
-                    self.potentials[cloud_ind][pot_inds] += tukeys
-                    min_ind = torch.argmin(self.potentials[cloud_ind])
-                    self.min_potentials[[cloud_ind]] = \
-                        self.potentials[cloud_ind][min_ind]
-                    self.argmin_potentials[[cloud_ind]] = min_ind
+                # Lock of the shard of this worker in sharded mode, only taken by the others to help a late shard
+                if self.sharded_potentials is not None:
+                    shard = self.sharded_potentials.shard(wid)
+                    lock = self.sharded_potentials.locks[shard]
+                else:
+                    lock = self.worker_lock
+                    shard = None
+
+                with lock:
+                    if debug_workers:
+                        message = ""
+                        for wi in range(len(self.worker_waiting)):
+                            if wi == wid:
+                                message += f" {bcolors.FAIL}v{bcolors.ENDC} "
+                            elif self.worker_waiting[wi] == 0:
+                                message += "   "
+                            elif self.worker_waiting[wi] == 1:
+                                message += " | "
+                            elif self.worker_waiting[wi] == 2:
+                                message += " o "
+                        print(message)
+                        self.worker_waiting[wid] = 1
+
+                    # Get potential minima
+                    num_centers = self.num_centers_to_draw(batch_n, len(p_list))
+                    centers = self.draw_potential_centers(num_centers, shard)
+
+                # Indices of the points in all the input regions
+                pending = list(zip(centers, self.gather_input_spheres(centers)))
+
+            (cloud_ind, point_ind, center_point), input_inds = pending.pop(0)
 
             t += [time.time()]
 
-            # Get points from tree structure
-            points = np.array(self.input_trees[cloud_ind].data, copy=False)
-
-            # Indices of points in input region
-            input_inds = self.input_trees[cloud_ind].query_radius(
-                center_point,
-                r=self.config.in_radius
-            )[0]
+            # Get tree structure (its points are only dequantized for the input region)
+            tree = self.input_trees[cloud_ind]
 
             t += [time.time()]
 
@@ -307,15 +304,15 @@ class LASDataset(PointCloudDataset):
                 continue
 
             # Collect labels and intensity
-            input_points = (points[input_inds] - center_point)
+            input_points = (tree_points(tree, input_inds) - center_point)
             input_points = input_points.astype(np.float32)
-            input_intensity = self.input_intensity[cloud_ind][input_inds]
+            input_intensity = self.input_intensity[cloud_ind][input_inds] / np.float32(0xFFFF)
             if len(input_intensity.shape) == 1:
                 input_intensity = np.expand_dims(input_intensity, axis=1)
             if self.set in ["test", "ERF"]:
                 input_labels = np.zeros(input_points.shape[0])
             else:
-                input_labels = self.input_labels[cloud_ind][input_inds]
+                input_labels = self.input_labels[cloud_ind][input_inds].astype(np.int32)
 
             t += [time.time()]
 
@@ -330,7 +327,8 @@ class LASDataset(PointCloudDataset):
 
             # Get original height as additional feature
             input_features = np.hstack(
-                (input_intensity, input_points[:, 2:] + center_point[:, 2:])
+                (input_intensity, input_points[:, 2:] + center_point[:, 2:]
+                 + self.input_origins[cloud_ind][2])
             ).astype(np.float32)
 
             t += [time.time()]
@@ -399,7 +397,7 @@ class LASDataset(PointCloudDataset):
 
         if debug_workers:
             message = ""
-            for wi in range(info.num_workers):
+            for wi in range(len(self.worker_waiting)):
                 if wi == wid:
                     message += " {:}0{:} ".format(bcolors.OKBLUE, bcolors.ENDC)
                 elif self.worker_waiting[wi] == 0:
@@ -498,11 +496,11 @@ class LASDataset(PointCloudDataset):
                 if self.epoch_i >= int(self.epoch_inds.shape[1]):
                     self.epoch_i -= int(self.epoch_inds.shape[1])
 
-            # Get points from tree structure
-            points = np.array(self.input_trees[cloud_ind].data, copy=False)
+            # Get tree structure (its points are only dequantized for the input region)
+            tree = self.input_trees[cloud_ind]
 
             # Center point of input region
-            center_point = np.copy(points[point_ind, :].reshape(1, -1))
+            center_point = tree_points(tree, [point_ind])
 
             # Add a small noise to center point
             if self.set != "ERF":
@@ -516,7 +514,7 @@ class LASDataset(PointCloudDataset):
                 )
 
             # Indices of points in input region
-            input_inds = self.input_trees[cloud_ind].query_radius(
+            input_inds = tree.query_radius(
                 center_point, r=self.config.in_radius
             )[0]
 
@@ -531,13 +529,13 @@ class LASDataset(PointCloudDataset):
                 continue
 
             # Collect labels and intensity
-            input_points = (points[input_inds] - center_point)
+            input_points = (tree_points(tree, input_inds) - center_point)
             input_points = input_points.astype(np.float32)
-            input_intensity = self.input_intensity[cloud_ind][input_inds]
+            input_intensity = self.input_intensity[cloud_ind][input_inds] / np.float32(0xFFFF)
             if self.set in ["test", "ERF"]:
                 input_labels = np.zeros(input_points.shape[0])
             else:
-                input_labels = self.input_labels[cloud_ind][input_inds]
+                input_labels = self.input_labels[cloud_ind][input_inds].astype(np.int32)
 
             # Data augmentation
             input_points, scale, R = self.augmentation_transform(input_points)
@@ -548,7 +546,8 @@ class LASDataset(PointCloudDataset):
 
             # Get original height as additional feature
             input_features = np.hstack(
-                (input_intensity, input_points[:, 2:] + center_point[:, 2:])
+                (input_intensity, input_points[:, 2:] + center_point[:, 2:]
+                 + self.input_origins[cloud_ind][2])
             ).astype(np.float32)
 
             # Stack batch
@@ -611,12 +610,100 @@ class LASDataset(PointCloudDataset):
 
         return input_list
 
+    @staticmethod
+    def prepare_cloud(file_path, cloud_prefix, config, split, pot_dl=None,
+                      num_threads=1):
+        """Subsamples a cloud and saves its arrays in the cache (called by
+        prepare_clouds, possibly in another process)
+        """
+        dl = config.first_subsampling_dl
+        method = config.subsampling_method
+
+        # Double precision origin of the cloud, the points are handled in float32 relative to it so that large
+        # (e.g. UTM) coordinates do not lose their precision
+        with laspy.open(file_path) as f:
+            origin = np.floor(f.header.mins)
+
+        # Subsample cloud (validation and test clouds also get the voxel of each original point)
+        reproject = split in ["validation", "test"]
+        if config.ingest_chunk_points > 0:
+
+            # Read las file by chunks, each one subsampled into the accumulator
+            with laspy.open(file_path) as f:
+                accumulator = GridAccumulator(
+                    f.header.mins - origin, f.header.maxs - origin, dl,
+                    method=method, return_inverse=reproject
+                )
+                labels = []
+                for points, intensity, chunk_labels in LASDataset.read_las_chunks(
+                    f, config.ingest_chunk_points, origin
+                ):
+                    accumulator.add(points, intensity, chunk_labels)
+                    if reproject:
+                        labels += [chunk_labels]
+            sub_points, sub_intensity, sub_labels, *proj_inds = accumulator.result()
+            labels = np.concatenate(labels) if reproject else None
+
+        else:
+
+            # Read las file
+            with laspy.open(file_path) as f:
+                points, intensity, labels = next(
+                    LASDataset.read_las_chunks(f, 0, origin)
+                )
+            sub_points, sub_intensity, sub_labels, *proj_inds = grid_subsampling(
+                points, features=intensity, labels=labels, sampleDl=dl,
+                num_threads=num_threads, return_inverse=reproject,
+                method=method
+            )
+
+        # Reprojection indices come for free, no nearest neighbor query on the original points
+        if reproject:
+            proj_file = f"{cloud_prefix}_proj.pkl"
+            with open(proj_file, "wb") as f:
+                pickle.dump([proj_inds[0], labels], f)
+
+        # Keep intensity as the 16-bit unsigned integer of the las format and labels as the 8-bit classification,
+        # they are only converted for the input spheres
+        sub_intensity = np.clip(np.round(sub_intensity), 0, 0xFFFF).astype(np.uint16)
+        sub_labels = np.squeeze(sub_labels).astype(np.uint8)
+
+        # Quantize the points (positive relative to the origin) with the finest step covering the extent of the
+        # cloud: on 16 bits if this step is fine enough, on 32 bits otherwise (only 24 bits are used, so that float32
+        # dequantizes them exactly)
+        extent = max(float(np.max(sub_points, initial=0)), dl)
+        if extent / 0xFFFF <= dl / LASDataset.quantization_steps:
+            dtype, max_steps = np.uint16, 0xFFFF
+        else:
+            dtype, max_steps = np.uint32, (1 << 24) - 1
+        scale = np.array([extent / max_steps], dtype=np.float32)
+        quantized = np.round(sub_points / scale[0])
+        quantized = np.clip(quantized, 0, max_steps).astype(dtype)
+
+        # Save the raw arrays, memory mapped at the next start
+        save_cloud_arrays(cloud_prefix, points=quantized, origin=origin,
+                          scale=scale, intensity=sub_intensity,
+                          labels=sub_labels)
+
+        # Coarse potential locations
+        if pot_dl is not None:
+            coarse_points = grid_subsampling(
+                sub_points.astype(np.float32), sampleDl=pot_dl,
+                num_threads=num_threads
+            )
+            save_cloud_arrays(cloud_prefix, coarse_points=coarse_points)
+
+        return
+
     def load_subsampled_clouds(self):
         # Parameter
         dl = self.config.first_subsampling_dl
 
-        # Create path for files
+        # Create path for files (representative point methods are cached apart from the barycenters)
+        method = self.config.subsampling_method
         tree_path = os.path.join(self.path, "input_{:.3f}".format(dl))
+        if method != "barycenters":
+            tree_path += "_" + method
         if not os.path.isdir(tree_path):
             os.makedirs(tree_path)
 
@@ -624,6 +711,33 @@ class LASDataset(PointCloudDataset):
         # Load KDTrees
         ##############
 
+        # Prepare the clouds missing from the cache, or whose source file or preparation parameters changed,
+        # in parallel processes
+        manifest = CacheManifest(tree_path, content_hash=self.config.cache_content_hash)
+        params = {"first_subsampling_dl": dl, "subsampling_method": method,
+                  "streamed": self.config.ingest_chunk_points > 0}
+        pot_dl = self.config.in_radius / 10 if self.use_potentials else None
+        tasks = []
+        for file_path, cloud_name in zip(self.files, self.cloud_names):
+            cloud_prefix = os.path.join(tree_path, cloud_name)
+            names = ["points", "origin", "scale", "intensity", "labels"]
+            cached = load_cloud_arrays(cloud_prefix, names)
+            if cached is None or not manifest.is_valid(cloud_name, file_path, params):
+                args = (file_path, cloud_prefix, self.config, self.set, pot_dl)
+                tasks += [(cloud_name, args)]
+        prepare_clouds(LASDataset.prepare_cloud, tasks,
+                       self.config.preprocessing_workers,
+                       self.config.subsampling_threads)
+
+        # Record the prepared clouds and their coarse potential points
+        for cloud_name, (file_path, *_) in tasks:
+            manifest.record(cloud_name, file_path, params)
+            if pot_dl is not None:
+                manifest.record(cloud_name + "_coarse", file_path, dict(params, pot_dl=pot_dl))
+            if self.set in ["validation", "test"]:
+                manifest.record(cloud_name + "_proj", file_path, params)
+        manifest.save()
+
         for i, file_path in enumerate(self.files):
 
             # Restart timer
@@ -632,71 +746,26 @@ class LASDataset(PointCloudDataset):
             # Get cloud name
             cloud_name = self.cloud_names[i]
 
-            # Name of the input files
-            KDTree_file = os.path.join(tree_path, f"{cloud_name:s}_KDTree.pkl")
-            sub_las_file = os.path.join(tree_path, f"{cloud_name:s}.las")
+            # Prefix of the cached arrays
+            cloud_prefix = os.path.join(tree_path, cloud_name)
 
-            # Check if inputs have already been computed
-            if os.path.isfile(KDTree_file):
-                print(f"\nFound KDTree for cloud {cloud_name:s}, subsampled at "
-                      f"{dl:.3f}")
-
-                # Read las into data
-                with laspy.open(sub_las_file) as f:
-                    data = f.read()
-                    sub_intensity = data["intensity"]
-                    sub_labels = np.array(data["classification"], dtype=np.int32)
-
-                # Read pkl into search_tree
-                with open(KDTree_file, "rb") as f:
-                    search_tree = pickle.load(f)
-
-            else:
-                print(f"\nPreparing KDTree for cloud {cloud_name:s}, "
-                      f"subsampled at {dl:.3f}")
-
-                # Read las file
-                with laspy.open(file_path) as f:
-                    data = f.read()
-                    points = data.xyz.astype(np.float32)
-                    intensity = data["intensity"]
-                # "unsqueeze" intensity
-                intensity = np.expand_dims(intensity, axis=1)
-                labels = np.array(data["classification"], dtype=np.int32)
-
-                # Subsample cloud
-                sub_points, sub_intensity, sub_labels = grid_subsampling(
-                    points, features=intensity, labels=labels, sampleDl=dl
-                )
-
-                # Normalize intensity and squeeze label
-                # Intensity is 16-bit unisgned integer so divide by max value
-                sub_intensity = sub_intensity / 0xFFFF
-                sub_labels = np.squeeze(sub_labels)
-
-                # Get chosen neighborhoods
-                search_tree = KDTree(sub_points, leaf_size=10) 
-
-                # Save KDTree
-                with open(KDTree_file, "wb") as f:
-                    pickle.dump(search_tree, f)
+            # Load the cached arrays (memory mapped)
+            print(f"\nLoading cloud {cloud_name:s}, subsampled at {dl:.3f}")
+            quantized, origin, scale, sub_intensity, sub_labels = load_cloud_arrays(
+                cloud_prefix, ["points", "origin", "scale", "intensity", "labels"]
+            )
 
-                # Save las
-                sub_data = laspy.create(point_format=6, file_version="1.4")
-                sub_data["x"] = sub_points[:,0]
-                sub_data["y"] = sub_points[:,1]
-                sub_data["z"] = sub_points[:,2]
-                sub_data["intensity"] = np.squeeze(sub_intensity)
-                sub_data["classification"] = sub_labels
-                sub_data.write(sub_las_file)
+            # Get chosen neighborhoods (rebuilt at each start on the memory mapped quantized points, read in place)
+            search_tree = KDTree(quantized, leaf_size=10, scale=float(scale[0]))
 
             # Fill data containers
             self.input_trees += [search_tree]
+            self.input_origins += [np.array(origin)]
             self.input_intensity += [sub_intensity]
             self.input_labels += [sub_labels]
 
-            # Number of points x 30 bytes per point record
-            size = sub_intensity.shape[0] * 30 / (1024 ** 2)
+            # Size of the cached arrays (quantized xyz, uint16 intensity and uint8 labels)
+            size = sum(a.nbytes for a in (quantized, sub_intensity, sub_labels)) / (1024 ** 2)
             t1 = time.time() - t0
             print(f"{size:.1f} MB loaded in {t1:.1f}s")
 
@@ -718,36 +787,36 @@ class LASDataset(PointCloudDataset):
                 # Get cloud name
                 cloud_name = self.cloud_names[i]
 
-                # Name of the input files
-                coarse_KDTree_file = os.path.join(
-                    tree_path, f"{cloud_name}_coarse_KDTree.pkl"
-                )
+                # Prefix of the cached arrays
+                cloud_prefix = os.path.join(tree_path, cloud_name)
 
                 # Check if inputs have already been computed
-                if os.path.isfile(coarse_KDTree_file):
-                    # Read pkl to search_tree
-                    with open(coarse_KDTree_file, "rb") as f:
-                        search_tree = pickle.load(f)
+                cached = load_cloud_arrays(cloud_prefix, ["coarse_points"])
+                coarse_params = dict(params, pot_dl=pot_dl)
+                if cached is not None and manifest.is_valid(cloud_name + "_coarse", file_path, coarse_params):
+                    coarse_points = cached[0]
 
                 else:
                     # Subsample cloud
-                    sub_points = np.array(self.input_trees[cloud_ind].data,
-                                          copy=False)
+                    sub_points = tree_points(self.input_trees[cloud_ind])
                     coarse_points = grid_subsampling(
-                        sub_points.astype(np.float32), sampleDl=pot_dl
+                        sub_points.astype(np.float32), sampleDl=pot_dl,
+                        num_threads=self.config.subsampling_threads
                     )
 
-                    # Get chosen neighborhoods
-                    search_tree = KDTree(coarse_points, leaf_size=10)
+                    # Save coarse points
+                    save_cloud_arrays(cloud_prefix, coarse_points=coarse_points)
+                    manifest.record(cloud_name + "_coarse", file_path, coarse_params)
 
-                    # Save KDTree
-                    with open(coarse_KDTree_file, "wb") as f:
-                        pickle.dump(search_tree, f)
+                # Get chosen neighborhoods
+                search_tree = KDTree(coarse_points, leaf_size=10)
 
                 # Fill data containers
                 self.pot_trees += [search_tree]
                 cloud_ind += 1
 
+            manifest.save()
+
             t1 = time.time() - t0
             print(f"Done in {t1:.1f}s")
 
@@ -774,32 +843,63 @@ class LASDataset(PointCloudDataset):
                 proj_file = os.path.join(tree_path, f"{cloud_name}_proj.pkl")
 
                 # Try to load previous indices
-                if os.path.isfile(proj_file):
+                if os.path.isfile(proj_file) and manifest.is_valid(cloud_name + "_proj", file_path, params):
                     with open(proj_file, "rb") as f:
                         proj_inds, labels = pickle.load(f)
                 else:
+                    # Compute projection inds, chunk by chunk
+                    proj_inds = []
+                    labels = []
                     with laspy.open(file_path) as f:
-                        data = f.read()
-                        points = data.xyz
-                        labels = np.array(data["classification"], dtype=np.int32)
-
-                    # Compute projection inds
-                    idxs = self.input_trees[i].query(points, 
-                                                     return_distance=False)
-                    proj_inds = np.squeeze(idxs).astype(np.int32)
+                        for points, _, chunk_labels in self.read_las_chunks(
+                            f, self.config.ingest_chunk_points,
+                            self.input_origins[i]
+                        ):
+                            idxs = self.input_trees[i].query(
+                                points, return_distance=False
+                            )
+                            proj_inds += [np.squeeze(idxs, axis=1).astype(np.int32)]
+                            labels += [chunk_labels]
+                    proj_inds = np.concatenate(proj_inds)
+                    labels = np.concatenate(labels)
 
                     # Save
                     with open(proj_file, "wb") as f:
                         pickle.dump([proj_inds, labels], f)
+                    manifest.record(cloud_name + "_proj", file_path, params)
 
                 self.test_proj += [proj_inds]
                 self.validation_labels += [labels]
                 t1 = time.time() - t0
                 print(f"{cloud_name} done in {t1:.1f}s")
 
+            manifest.save()
+
         print()
         return
     
+    def cloud_origin(self, cloud_ind):
+        return self.input_origins[cloud_ind]
+
+    @staticmethod
+    def read_las_chunks(f, chunk_points, origin=None):
+        """Reads the points (float32, relative to origin if given), intensity
+        (n, 1) and labels (int32) of an opened LAS/LAZ file, by chunks of
+        chunk_points points (0 for the whole file)
+        """
+        if chunk_points <= 0:
+            chunk_points = max(f.header.point_count, 1)
+
+        # Only the dimensions used by the dataset are decoded
+        for chunk in f.chunk_iterator(chunk_points):
+            points = np.stack((chunk.x, chunk.y, chunk.z), axis=1)
+            if origin is not None:
+                points -= origin
+            points = points.astype(np.float32)
+            intensity = np.expand_dims(np.asarray(chunk.intensity), axis=1)
+            labels = np.array(chunk.classification, dtype=np.int32)
+            yield points, intensity, labels
+
     def load_evaluation_points(self, file_path):
         """Load points (from test or validation split) on which the
         metrics should be evaluated
@@ -1035,6 +1135,13 @@ class LASSampler(torch.utils.data.Sampler):
 
         redo = force_redo
 
+        # Calibrations are reused only if the files of the set and the
+        # parameters they were computed with are unchanged
+        manifest = CacheManifest(
+            self.dataset.path,
+            content_hash=self.dataset.config.cache_content_hash
+        )
+
         # Batch limit
         # ***********
 
@@ -1051,10 +1158,18 @@ class LASSampler(torch.utils.data.Sampler):
             sampler_method = "potentials"
         else:
             sampler_method = "random"
-        key = (f"{sampler_method}_{self.dataset.config.in_radius:.3f}_"
+        key = (f"{self.dataset.set}_{sampler_method}_"
+               f"{self.dataset.config.in_radius:.3f}_"
                f"{self.dataset.config.first_subsampling_dl:.3f}_"
                f"{self.dataset.config.batch_num:d}")
-        if not redo and key in batch_lim_dict:
+        batch_params = {"sampler": sampler_method,
+                        "in_radius": self.dataset.config.in_radius,
+                        "first_subsampling_dl":
+                            self.dataset.config.first_subsampling_dl,
+                        "batch_num": self.dataset.config.batch_num}
+        if (not redo and key in batch_lim_dict
+                and manifest.is_valid("batch_limits_" + key,
+                                      self.dataset.files, batch_params)):
             self.dataset.batch_limit[0] = batch_lim_dict[key]
         else:
             redo = True
@@ -1091,8 +1206,11 @@ class LASSampler(torch.utils.data.Sampler):
             else:
                 r = dl * self.dataset.config.conv_radius
 
-            key = f"{dl:.3f}_{r:.3f}"
-            if key in neighb_lim_dict:
+            key = f"{self.dataset.set}_{dl:.3f}_{r:.3f}"
+            if key in neighb_lim_dict and manifest.is_valid(
+                "neighbors_limits_" + key, self.dataset.files,
+                {"dl": dl, "radius": r}
+            ):
                 neighb_limits += [neighb_lim_dict[key]]
 
         if not redo and len(neighb_limits) == self.dataset.config.num_layers:
@@ -1108,7 +1226,7 @@ class LASSampler(torch.utils.data.Sampler):
                     r = dl * self.dataset.config.deform_radius
                 else:
                     r = dl * self.dataset.config.conv_radius
-                key = f"{dl:.3f}_{r:.3f}"
+                key = f"{self.dataset.set}_{dl:.3f}_{r:.3f}"
 
                 if key in neighb_lim_dict:
                     color = bcolors.OKGREEN
@@ -1186,10 +1304,7 @@ class LASSampler(torch.utils.data.Sampler):
                 for batch_i, batch in enumerate(dataloader):
                     batch:LASCustomBatch
                     # Update neighborhood histogram
-                    counts = [
-                        np.sum(neighb_mat.numpy() < neighb_mat.shape[0], axis=1)
-                        for neighb_mat in batch.neighbors
-                    ]
+                    counts = [neighbors_counts(neighb) for neighb in batch.neighbors]
                     hists = [np.bincount(c, minlength=hist_n)[:hist_n] 
                              for c in counts]
                     neighb_hists += np.vstack(hists)
@@ -1318,10 +1433,13 @@ class LASSampler(torch.utils.data.Sampler):
                 sampler_method = "potentials"
             else:
                 sampler_method = "random"
-            key = (f"{sampler_method}_{self.dataset.config.in_radius:.3f}_"
+            key = (f"{self.dataset.set}_{sampler_method}_"
+                   f"{self.dataset.config.in_radius:.3f}_"
                    f"{self.dataset.config.first_subsampling_dl:.3f}_"
                    f"{self.dataset.config.batch_num:d}")
             batch_lim_dict[key] = float(self.dataset.batch_limit)
+            manifest.record("batch_limits_" + key, self.dataset.files,
+                            batch_params)
             with open(batch_lim_file, "wb") as file:
                 pickle.dump(batch_lim_dict, file)
 
@@ -1332,11 +1450,15 @@ class LASSampler(torch.utils.data.Sampler):
                     r = dl * self.dataset.config.deform_radius
                 else:
                     r = dl * self.dataset.config.conv_radius
-                key = f"{dl:.3f}_{r:.3f}"
+                key = f"{self.dataset.set}_{dl:.3f}_{r:.3f}"
                 neighb_lim_dict[key] = \
                     self.dataset.neighborhood_limits[layer_ind]
+                manifest.record("neighbors_limits_" + key,
+                                self.dataset.files,
+                                {"dl": dl, "radius": r})
             with open(neighb_lim_file, "wb") as file:
                 pickle.dump(neighb_lim_dict, file)
+            manifest.save()
 
         t1 = time.time() - t0
         print(f"Calibration done in {t1:.1f}s\n")
@@ -1358,15 +1480,15 @@ class LASCustomBatch:
         ]
         ind += L
         self.neighbors = [
-            torch.from_numpy(nparray) for nparray in input_list[ind : ind + L]
+            neighbors_from_numpy(nparray) for nparray in input_list[ind : ind + L]
         ]
         ind += L
         self.pools = [
-            torch.from_numpy(nparray) for nparray in input_list[ind : ind + L]
+            neighbors_from_numpy(nparray) for nparray in input_list[ind : ind + L]
         ]
         ind += L
         self.upsamples = [
-            torch.from_numpy(nparray) for nparray in input_list[ind : ind + L]
+            neighbors_from_numpy(nparray) for nparray in input_list[ind : ind + L]
         ]
         ind += L
         self.lengths = [
@@ -1456,6 +1578,10 @@ class LASCustomBatch:
 
             if layer is None or layer == layer_i:
 
+                # Ragged neighbors are unstacked as padded matrices
+                if isinstance(layer_elems, RaggedNeighbors):
+                    layer_elems = layer_elems.to_dense(self.points[layer_i].shape[0])
+
                 i0 = 0
                 p_list = []
                 if element_name == "pools":
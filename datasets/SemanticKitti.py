@@ -1125,7 +1125,7 @@ class SemanticKittiSampler(Sampler):
                     all_n += int(batch.lengths[0].shape[0])
 
                     # Update neighborhood histogram
-                    counts = [np.sum(neighb_mat.numpy() < neighb_mat.shape[0], axis=1) for neighb_mat in batch.neighbors]
+                    counts = [neighbors_counts(neighb) for neighb in batch.neighbors]
                     hists = [np.bincount(c, minlength=hist_n)[:hist_n] for c in counts]
                     neighb_hists += np.vstack(hists)
 
@@ -1259,11 +1259,11 @@ class SemanticKittiCustomBatch:
         ind = 1
         self.points = [torch.from_numpy(nparray) for nparray in input_list[ind:ind+L]]
         ind += L
-        self.neighbors = [torch.from_numpy(nparray) for nparray in input_list[ind:ind+L]]
+        self.neighbors = [neighbors_from_numpy(nparray) for nparray in input_list[ind:ind+L]]
         ind += L
-        self.pools = [torch.from_numpy(nparray) for nparray in input_list[ind:ind+L]]
+        self.pools = [neighbors_from_numpy(nparray) for nparray in input_list[ind:ind+L]]
         ind += L
-        self.upsamples = [torch.from_numpy(nparray) for nparray in input_list[ind:ind+L]]
+        self.upsamples = [neighbors_from_numpy(nparray) for nparray in input_list[ind:ind+L]]
         ind += L
         self.lengths = [torch.from_numpy(nparray) for nparray in input_list[ind:ind+L]]
         ind += L
@@ -1354,6 +1354,10 @@ class SemanticKittiCustomBatch:
 
             if layer is None or layer == layer_i:
 
+                # Ragged neighbors are unstacked as padded matrices
+                if isinstance(layer_elems, RaggedNeighbors):
+                    layer_elems = layer_elems.to_dense(self.points[layer_i].shape[0])
+
                 i0 = 0
                 p_list = []
                 if element_name == 'pools':
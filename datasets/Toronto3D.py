@@ -38,12 +38,14 @@ from os import listdir
 from os.path import exists, join, isdir
 
 # Dataset parent class
-from datasets.common import PointCloudDataset
+from datasets.common import PointCloudDataset, RaggedNeighbors, neighbors_from_numpy, neighbors_counts
 from torch.utils.data import Sampler, get_worker_info
 from utils.mayavi_visu import *
 
-from datasets.common import grid_subsampling
+from datasets.common import grid_subsampling, save_cloud_arrays, load_cloud_arrays, KDTree, PotentialTree
+from datasets.common import ShardedPotentials, prepare_clouds, input_worker_id
 from utils.config import bcolors
+from utils.cache import CacheManifest
 
 
 # ----------------------------------------------------------------------------------------------------------------------
@@ -188,21 +190,32 @@ class Toronto3DDataset(PointCloudDataset):
         # Initialize potentials
         if use_potentials:
             self.potentials = []
+            self.potential_trees = []
             self.min_potentials = []
             self.argmin_potentials = []
             for i, tree in enumerate(self.pot_trees):
-                self.potentials += [torch.from_numpy(np.random.rand(tree.data.shape[0]) * 1e-3)]
-                min_ind = int(torch.argmin(self.potentials[-1]))
+                self.potential_trees += [PotentialTree(np.random.rand(tree.data.shape[0]) * 1e-3)]
+                self.potentials += [self.potential_trees[-1].potentials]
+                min_ind, min_pot = self.potential_trees[-1].argmin()
                 self.argmin_potentials += [min_ind]
-                self.min_potentials += [float(self.potentials[-1][min_ind])]
+                self.min_potentials += [min_pot]
 
-            # Share potential memory
+            # Share potential memory (the potential trees are created in shared memory)
             self.argmin_potentials = torch.from_numpy(np.array(self.argmin_potentials, dtype=np.int64))
             self.min_potentials = torch.from_numpy(np.array(self.min_potentials, dtype=np.float64))
             self.argmin_potentials.share_memory_()
             self.min_potentials.share_memory_()
-            for i, _ in enumerate(self.pot_trees):
-                self.potentials[i].share_memory_()
+
+            # Potentials partitioned across the input workers, each one drawing its spheres in its own shard
+            if config.sharded_potentials:
+                self.sharded_potentials = ShardedPotentials([tree.data for tree in self.pot_trees], self.potentials,
+                                                            config.input_threads, 2 * config.in_radius)
+                self.potentials = self.sharded_potentials.potentials
+                self.min_potentials = self.sharded_potentials.min_potentials
+                self.potential_trees = None
+                self.argmin_potentials = None
+            else:
+                self.sharded_potentials = None
 
             self.worker_waiting = torch.tensor([0 for _ in range(config.input_threads)], dtype=torch.int32)
             self.worker_waiting.share_memory_()
@@ -211,6 +224,8 @@ class Toronto3DDataset(PointCloudDataset):
 
         else:
             self.potentials = None
+            self.potential_trees = None
+            self.sharded_potentials = None
             self.min_potentials = None
             self.argmin_potentials = None
             self.epoch_inds = torch.from_numpy(np.zeros((2, self.epoch_n), dtype=np.int64))
@@ -261,37 +276,26 @@ class Toronto3DDataset(PointCloudDataset):
         batch_n = 0
         failed_attempts = 0
 
-        info = get_worker_info()
-        if info is not None:
-            wid = info.id
-        else:
-            wid = None
+        wid = input_worker_id()
+
+        # Worker states are only displayed from the input workers (not when loading from the main process)
+        debug_workers = debug_workers and wid is not None
+
+        pending = []
 
         while True:
 
             t += [time.time()]
 
-            if debug_workers:
-                message = ''
-                for wi in range(info.num_workers):
-                    if wi == wid:
-                        message += ' {:}X{:} '.format(bcolors.FAIL, bcolors.ENDC)
-                    elif self.worker_waiting[wi] == 0:
-                        message += '   '
-                    elif self.worker_waiting[wi] == 1:
-                        message += ' | '
-                    elif self.worker_waiting[wi] == 2:
-                        message += ' o '
-                print(message)
-                self.worker_waiting[wid] = 0
-
-            with self.worker_lock:
+            # Draw new sphere centers once the previous ones are used (the centers left when the batch is full are
+            # dropped, their potentials stay updated)
+            if not pending:
 
                 if debug_workers:
                     message = ''
-                    for wi in range(info.num_workers):
+                    for wi in range(len(self.worker_waiting)):
                         if wi == wid:
-                            message += ' {:}v{:} '.format(bcolors.OKGREEN, bcolors.ENDC)
+                            message += ' {:}X{:} '.format(bcolors.FAIL, bcolors.ENDC)
                         elif self.worker_waiting[wi] == 0:
                             message += '   '
                         elif self.worker_waiting[wi] == 1:
@@ -299,51 +303,46 @@ class Toronto3DDataset(PointCloudDataset):
                         elif self.worker_waiting[wi] == 2:
                             message += ' o '
                     print(message)
-                    self.worker_waiting[wid] = 1
+                    self.worker_waiting[wid] = 0
 
-                # Get potential minimum
-                cloud_ind = int(torch.argmin(self.min_potentials))
-                point_ind = int(self.argmin_potentials[cloud_ind])
-
-                # Get potential points from tree structure
-                pot_points = np.array(self.pot_trees[cloud_ind].data, copy=False)
-
-                # Center point of input region
-                center_point = np.copy(pot_points[point_ind, :].reshape(1, -1))
-
-                # Add a small noise to center point
-                if self.set != 'ERF':
-                    center_point += np.clip(np.random.normal(scale=self.config.in_radius / 10, size=center_point.shape),
-                                            -self.config.in_radius / 2,
-                                            self.config.in_radius / 2)
-
-                # Indices of points in input region
-                pot_inds, dists = self.pot_trees[cloud_ind].query_radius(center_point,
-                                                                         r=self.config.in_radius,
-                                                                         return_distance=True)
-
-                d2s = np.square(dists[0])
-                pot_inds = pot_inds[0]
-
-                # Update potentials (Tukey weights)
-                if self.set != 'ERF':
-                    tukeys = np.square(1 - d2s / np.square(self.config.in_radius))
-                    tukeys[d2s > np.square(self.config.in_radius)] = 0
-                    self.potentials[cloud_ind][pot_inds] += tukeys
-                    min_ind = torch.argmin(self.potentials[cloud_ind])
-                    self.min_potentials[[cloud_ind]] = self.potentials[cloud_ind][min_ind]
-                    self.argmin_potentials[[cloud_ind]] = min_ind
+                # Lock of the shard of this worker in sharded mode, only taken by the others to help a late shard
+                if self.sharded_potentials is not None:
+                    shard = self.sharded_potentials.shard(wid)
+                    lock = self.sharded_potentials.locks[shard]
+                else:
+                    lock = self.worker_lock
+                    shard = None
+
+                with lock:
+
+                    if debug_workers:
+                        message = ''
+                        for wi in range(len(self.worker_waiting)):
+                            if wi == wid:
+                                message += ' {:}v{:} '.format(bcolors.OKGREEN, bcolors.ENDC)
+                            elif self.worker_waiting[wi] == 0:
+                                message += '   '
+                            elif self.worker_waiting[wi] == 1:
+                                message += ' | '
+                            elif self.worker_waiting[wi] == 2:
+                                message += ' o '
+                        print(message)
+                        self.worker_waiting[wid] = 1
+
+                    # Get potential minima
+                    num_centers = self.num_centers_to_draw(batch_n, len(p_list))
+                    centers = self.draw_potential_centers(num_centers, shard)
+
+                # Indices of the points in all the input regions
+                pending = list(zip(centers, self.gather_input_spheres(centers)))
+
+            (cloud_ind, point_ind, center_point), input_inds = pending.pop(0)
 
             t += [time.time()]
 
             # Get points from tree structure
             points = np.array(self.input_trees[cloud_ind].data, copy=False)
 
-
-            # Indices of points in input region
-            input_inds = self.input_trees[cloud_ind].query_radius(center_point,
-                                                                  r=self.config.in_radius)[0]
-
             t += [time.time()]
 
             # Number collected
@@ -450,7 +449,7 @@ class Toronto3DDataset(PointCloudDataset):
 
         if debug_workers:
             message = ''
-            for wi in range(info.num_workers):
+            for wi in range(len(self.worker_waiting)):
                 if wi == wid:
                     message += ' {:}0{:} '.format(bcolors.OKBLUE, bcolors.ENDC)
                 elif self.worker_waiting[wi] == 0:
@@ -682,6 +681,50 @@ class Toronto3DDataset(PointCloudDataset):
         print('Done in {:.1f}s'.format(time.time() - t0))
         return
 
+    @staticmethod
+    def prepare_cloud(file_path, cloud_prefix, config, split, pot_dl=None, num_threads=1):
+        """
+        Subsamples a cloud and saves its arrays in the cache (called by prepare_clouds, possibly in another process)
+        """
+
+        # Read ply file
+        data = read_ply(file_path)
+        points = np.vstack((data['x'], data['y'], data['z'])).T
+        points = np.asarray(points, dtype=np.float32)
+        colors = np.vstack((data['red'], data['green'], data['blue'], data['scalar_Intensity'])).T
+        colors = np.asarray(colors, dtype=np.float32)
+        labels = np.array(data['scalar_Label'], dtype=np.int32)
+
+        # Subsample cloud (validation and test clouds also get the voxel of each original point)
+        reproject = split in ['validation', 'test']
+        sub_points, sub_colors, sub_labels, *proj_inds = grid_subsampling(
+            points,
+            features=colors,
+            labels=labels,
+            sampleDl=config.first_subsampling_dl,
+            num_threads=num_threads,
+            return_inverse=reproject)
+
+        # Reprojection indices come for free, no nearest neighbor query on the original points
+        if reproject:
+            proj_file = '{:s}_proj.pkl'.format(cloud_prefix)
+            with open(proj_file, 'wb') as f:
+                pickle.dump([proj_inds[0], labels], f)
+
+        # Rescale float color and squeeze label
+        sub_colors = sub_colors / 255.0
+        sub_labels = np.squeeze(sub_labels)
+
+        # Save the raw arrays, memory mapped at the next start
+        save_cloud_arrays(cloud_prefix, points=sub_points, colors=sub_colors, labels=sub_labels)
+
+        # Coarse potential locations
+        if pot_dl is not None:
+            coarse_points = grid_subsampling(sub_points.astype(np.float32), sampleDl=pot_dl, num_threads=num_threads)
+            save_cloud_arrays(cloud_prefix, coarse_points=coarse_points)
+
+        return
+
     def load_subsampled_clouds(self):
 
         # Parameter
@@ -696,6 +739,29 @@ class Toronto3DDataset(PointCloudDataset):
         # Load KDTrees
         ##############
 
+        # Prepare the clouds missing from the cache, or whose source file or preparation parameters changed,
+        # in parallel processes
+        manifest = CacheManifest(tree_path, content_hash=self.config.cache_content_hash)
+        params = {'first_subsampling_dl': dl}
+        pot_dl = self.config.in_radius / 10 if self.use_potentials else None
+        tasks = []
+        for file_path, cloud_name in zip(self.files, self.cloud_names):
+            cloud_prefix = join(tree_path, cloud_name)
+            cached = load_cloud_arrays(cloud_prefix, ['points', 'colors', 'labels'])
+            if cached is None or not manifest.is_valid(cloud_name, file_path, params):
+                tasks += [(cloud_name, (file_path, cloud_prefix, self.config, self.set, pot_dl))]
+        prepare_clouds(Toronto3DDataset.prepare_cloud, tasks, self.config.preprocessing_workers,
+                       self.config.subsampling_threads)
+
+        # Record the prepared clouds and their coarse potential points
+        for cloud_name, (file_path, *_) in tasks:
+            manifest.record(cloud_name, file_path, params)
+            if pot_dl is not None:
+                manifest.record(cloud_name + '_coarse', file_path, dict(params, pot_dl=pot_dl))
+            if self.set in ['validation', 'test']:
+                manifest.record(cloud_name + '_proj', file_path, params)
+        manifest.save()
+
         for i, file_path in enumerate(self.files):
 
             # Restart timer
@@ -704,57 +770,15 @@ class Toronto3DDataset(PointCloudDataset):
             # Get cloud name
             cloud_name = self.cloud_names[i]
 
-            # Name of the input files
-            KDTree_file = join(tree_path, '{:s}_KDTree.pkl'.format(cloud_name))
-            sub_ply_file = join(tree_path, '{:s}.ply'.format(cloud_name))
-
-            # Check if inputs have already been computed
-            if exists(KDTree_file):
-                print('\nFound KDTree for cloud {:s}, subsampled at {:.3f}'.format(cloud_name, dl))
-
-                # read ply with data
-                data = read_ply(sub_ply_file)
-                sub_colors = np.vstack((data['red'], data['green'], data['blue'], data['scalar_Intensity'])).T
-                sub_labels = data['scalar_Label']
-
-                # Read pkl with search tree
-                with open(KDTree_file, 'rb') as f:
-                    search_tree = pickle.load(f)
+            # Prefix of the cached arrays
+            cloud_prefix = join(tree_path, cloud_name)
 
-            else:
-                print('\nPreparing KDTree for cloud {:s}, subsampled at {:.3f}'.format(cloud_name, dl))
-
-                # Read ply file
-                data = read_ply(file_path)
-                points = np.vstack((data['x'], data['y'], data['z'])).T
-                points = np.asarray(points, dtype=np.float32)
-                colors = np.vstack((data['red'], data['green'], data['blue'], data['scalar_Intensity'])).T
-                colors = np.asarray(colors, dtype=np.float32)
-                labels = np.array(data['scalar_Label'], dtype=np.int32)
-
-                # Subsample cloud
-                sub_points, sub_colors, sub_labels = grid_subsampling(points,
-                                                                      features=colors,
-                                                                      labels=labels,
-                                                                      sampleDl=dl)
-
-                # Rescale float color and squeeze label
-                sub_colors = sub_colors / 255.0
-                sub_labels = np.squeeze(sub_labels)
-
-                # Get chosen neighborhoods
-                search_tree = KDTree(sub_points, leaf_size=10)
-                #search_tree = nnfln.KDTree(n_neighbors=1, metric='L2', leaf_size=10)
-                #search_tree.fit(sub_points)
+            # Load the cached arrays (memory mapped)
+            print('\nLoading cloud {:s}, subsampled at {:.3f}'.format(cloud_name, dl))
+            sub_points, sub_colors, sub_labels = load_cloud_arrays(cloud_prefix, ['points', 'colors', 'labels'])
 
-                # Save KDTree
-                with open(KDTree_file, 'wb') as f:
-                    pickle.dump(search_tree, f)
-
-                # Save ply
-                write_ply(sub_ply_file,
-                          [sub_points, sub_colors, sub_labels],
-                          ['x', 'y', 'z', 'red', 'green', 'blue', 'scalar_Intensity', 'scalar_Label'])
+            # Get chosen neighborhoods (rebuilt from the points at each start)
+            search_tree = KDTree(sub_points, leaf_size=10)
 
             # Fill data containers
             self.input_trees += [search_tree]
@@ -783,31 +807,34 @@ class Toronto3DDataset(PointCloudDataset):
                 # Get cloud name
                 cloud_name = self.cloud_names[i]
 
-                # Name of the input files
-                coarse_KDTree_file = join(tree_path, '{:s}_coarse_KDTree.pkl'.format(cloud_name))
+                # Prefix of the cached arrays
+                cloud_prefix = join(tree_path, cloud_name)
 
                 # Check if inputs have already been computed
-                if exists(coarse_KDTree_file):
-                    # Read pkl with search tree
-                    with open(coarse_KDTree_file, 'rb') as f:
-                        search_tree = pickle.load(f)
+                cached = load_cloud_arrays(cloud_prefix, ['coarse_points'])
+                coarse_params = dict(params, pot_dl=pot_dl)
+                if cached is not None and manifest.is_valid(cloud_name + '_coarse', file_path, coarse_params):
+                    coarse_points = cached[0]
 
                 else:
                     # Subsample cloud
                     sub_points = np.array(self.input_trees[cloud_ind].data, copy=False)
-                    coarse_points = grid_subsampling(sub_points.astype(np.float32), sampleDl=pot_dl)
+                    coarse_points = grid_subsampling(sub_points.astype(np.float32), sampleDl=pot_dl,
+                                                     num_threads=self.config.subsampling_threads)
 
-                    # Get chosen neighborhoods
-                    search_tree = KDTree(coarse_points, leaf_size=10)
+                    # Save coarse points
+                    save_cloud_arrays(cloud_prefix, coarse_points=coarse_points)
+                    manifest.record(cloud_name + '_coarse', file_path, coarse_params)
 
-                    # Save KDTree
-                    with open(coarse_KDTree_file, 'wb') as f:
-                        pickle.dump(search_tree, f)
+                # Get chosen neighborhoods
+                search_tree = KDTree(coarse_points, leaf_size=10)
 
                 # Fill data containers
                 self.pot_trees += [search_tree]
                 cloud_ind += 1
 
+            manifest.save()
+
             print('Done in {:.1f}s'.format(time.time() - t0))
 
         ######################
@@ -835,7 +862,7 @@ class Toronto3DDataset(PointCloudDataset):
                 proj_file = join(tree_path, '{:s}_proj.pkl'.format(cloud_name))
 
                 # Try to load previous indices
-                if exists(proj_file):
+                if exists(proj_file) and manifest.is_valid(cloud_name + '_proj', file_path, params):
                     with open(proj_file, 'rb') as f:
                         proj_inds, labels = pickle.load(f)
                 else:
@@ -851,11 +878,14 @@ class Toronto3DDataset(PointCloudDataset):
                     # Save
                     with open(proj_file, 'wb') as f:
                         pickle.dump([proj_inds, labels], f)
+                    manifest.record(cloud_name + '_proj', file_path, params)
 
                 self.test_proj += [proj_inds]
                 self.validation_labels += [labels]
                 print('{:s} done in {:.1f}s'.format(cloud_name, time.time() - t0))
 
+            manifest.save()
+
         print()
         return
 
@@ -1064,6 +1094,9 @@ class Toronto3DSampler(Sampler):
 
         redo = force_redo
 
+        # Calibrations are reused only if the files of the set and the parameters they were computed with are unchanged
+        manifest = CacheManifest(self.dataset.path, content_hash=self.dataset.config.cache_content_hash)
+
         # Batch limit
         # ***********
 
@@ -1080,11 +1113,16 @@ class Toronto3DSampler(Sampler):
             sampler_method = 'potentials'
         else:
             sampler_method = 'random'
-        key = '{:s}_{:.3f}_{:.3f}_{:d}'.format(sampler_method,
-                                               self.dataset.config.in_radius,
-                                               self.dataset.config.first_subsampling_dl,
-                                               self.dataset.config.batch_num)
-        if not redo and key in batch_lim_dict:
+        key = '{:s}_{:s}_{:.3f}_{:.3f}_{:d}'.format(self.dataset.set, sampler_method,
+                                                    self.dataset.config.in_radius,
+                                                    self.dataset.config.first_subsampling_dl,
+                                                    self.dataset.config.batch_num)
+        batch_params = {'sampler': sampler_method,
+                        'in_radius': self.dataset.config.in_radius,
+                        'first_subsampling_dl': self.dataset.config.first_subsampling_dl,
+                        'batch_num': self.dataset.config.batch_num}
+        if not redo and key in batch_lim_dict and manifest.is_valid('batch_limits_' + key, self.dataset.files,
+                                                                    batch_params):
             self.dataset.batch_limit[0] = batch_lim_dict[key]
         else:
             redo = True
@@ -1121,8 +1159,9 @@ class Toronto3DSampler(Sampler):
             else:
                 r = dl * self.dataset.config.conv_radius
 
-            key = '{:.3f}_{:.3f}'.format(dl, r)
-            if key in neighb_lim_dict:
+            key = '{:s}_{:.3f}_{:.3f}'.format(self.dataset.set, dl, r)
+            if key in neighb_lim_dict and manifest.is_valid('neighbors_limits_' + key, self.dataset.files,
+                                                            {'dl': dl, 'radius': r}):
                 neighb_limits += [neighb_lim_dict[key]]
 
         if not redo and len(neighb_limits) == self.dataset.config.num_layers:
@@ -1138,7 +1177,7 @@ class Toronto3DSampler(Sampler):
                     r = dl * self.dataset.config.deform_radius
                 else:
                     r = dl * self.dataset.config.conv_radius
-                key = '{:.3f}_{:.3f}'.format(dl, r)
+                key = '{:s}_{:.3f}_{:.3f}'.format(self.dataset.set, dl, r)
 
                 if key in neighb_lim_dict:
                     color = bcolors.OKGREEN
@@ -1207,7 +1246,7 @@ class Toronto3DSampler(Sampler):
                 for batch_i, batch in enumerate(dataloader):
 
                     # Update neighborhood histogram
-                    counts = [np.sum(neighb_mat.numpy() < neighb_mat.shape[0], axis=1) for neighb_mat in batch.neighbors]
+                    counts = [neighbors_counts(neighb) for neighb in batch.neighbors]
                     hists = [np.bincount(c, minlength=hist_n)[:hist_n] for c in counts]
                     neighb_hists += np.vstack(hists)
 
@@ -1330,11 +1369,12 @@ class Toronto3DSampler(Sampler):
                 sampler_method = 'potentials'
             else:
                 sampler_method = 'random'
-            key = '{:s}_{:.3f}_{:.3f}_{:d}'.format(sampler_method,
-                                                   self.dataset.config.in_radius,
-                                                   self.dataset.config.first_subsampling_dl,
-                                                   self.dataset.config.batch_num)
+            key = '{:s}_{:s}_{:.3f}_{:.3f}_{:d}'.format(self.dataset.set, sampler_method,
+                                                        self.dataset.config.in_radius,
+                                                        self.dataset.config.first_subsampling_dl,
+                                                        self.dataset.config.batch_num)
             batch_lim_dict[key] = float(self.dataset.batch_limit)
+            manifest.record('batch_limits_' + key, self.dataset.files, batch_params)
             with open(batch_lim_file, 'wb') as file:
                 pickle.dump(batch_lim_dict, file)
 
@@ -1345,10 +1385,12 @@ class Toronto3DSampler(Sampler):
                     r = dl * self.dataset.config.deform_radius
                 else:
                     r = dl * self.dataset.config.conv_radius
-                key = '{:.3f}_{:.3f}'.format(dl, r)
+                key = '{:s}_{:.3f}_{:.3f}'.format(self.dataset.set, dl, r)
                 neighb_lim_dict[key] = self.dataset.neighborhood_limits[layer_ind]
+                manifest.record('neighbors_limits_' + key, self.dataset.files, {'dl': dl, 'radius': r})
             with open(neighb_lim_file, 'wb') as file:
                 pickle.dump(neighb_lim_dict, file)
+            manifest.save()
 
 
         print('Calibration done in {:.1f}s\n'.format(time.time() - t0))
@@ -1369,11 +1411,11 @@ class Toronto3DCustomBatch:
         ind = 0
         self.points = [torch.from_numpy(nparray) for nparray in input_list[ind:ind+L]]
         ind += L
-        self.neighbors = [torch.from_numpy(nparray) for nparray in input_list[ind:ind+L]]
+        self.neighbors = [neighbors_from_numpy(nparray) for nparray in input_list[ind:ind+L]]
         ind += L
-        self.pools = [torch.from_numpy(nparray) for nparray in input_list[ind:ind+L]]
+        self.pools = [neighbors_from_numpy(nparray) for nparray in input_list[ind:ind+L]]
         ind += L
-        self.upsamples = [torch.from_numpy(nparray) for nparray in input_list[ind:ind+L]]
+        self.upsamples = [neighbors_from_numpy(nparray) for nparray in input_list[ind:ind+L]]
         ind += L
         self.lengths = [torch.from_numpy(nparray) for nparray in input_list[ind:ind+L]]
         ind += L
@@ -1462,6 +1504,10 @@ class Toronto3DCustomBatch:
 
             if layer is None or layer == layer_i:
 
+                # Ragged neighbors are unstacked as padded matrices
+                if isinstance(layer_elems, RaggedNeighbors):
+                    layer_elems = layer_elems.to_dense(self.points[layer_i].shape[0])
+
                 i0 = 0
                 p_list = []
                 if element_name == 'pools':
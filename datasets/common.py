@@ -23,9 +23,14 @@
 # Common libs
 import time
 import os
+import multiprocessing
 import numpy as np
 import sys
 import torch
+import itertools
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
 from torch.utils.data import DataLoader, Dataset
 from utils.config import Config
 from utils.mayavi_visu import *
@@ -34,6 +39,11 @@ from kernels.kernel_points import create_3D_rotations
 # Subsampling extension
 import cpp_wrappers.cpp_subsampling.grid_subsampling as cpp_subsampling
 import cpp_wrappers.cpp_neighbors.radius_neighbors as cpp_neighbors
+import cpp_wrappers.cpp_pyramid.input_pyramid as cpp_pyramid
+
+# Float32 KDTree on the points of the dataset clouds (used instead of sklearn.neighbors.KDTree), possibly on quantized
+# coordinates
+from cpp_wrappers.cpp_neighbors.radius_neighbors import KDTree
 
 # ----------------------------------------------------------------------------------------------------------------------
 #
@@ -41,41 +51,96 @@ import cpp_wrappers.cpp_neighbors.radius_neighbors as cpp_neighbors
 #       \***********************/
 #
 
-def grid_subsampling(points, features=None, labels=None, sampleDl=0.1, verbose=0):
+def grid_subsampling(points, features=None, labels=None, sampleDl=0.1, verbose=0, num_threads=1, return_inverse=False,
+                     method='barycenters', seed=0):
     """
-    CPP wrapper for a grid subsampling (method = barycenter for points and features)
+    CPP wrapper for a grid subsampling (method = barycenter for points and features, or one point per voxel)
     :param points: (N, 3) matrix of input points
     :param features: optional (N, d) matrix of features (floating number)
     :param labels: optional (N,) matrix of integer labels
     :param sampleDl: parameter defining the size of grid voxels
     :param verbose: 1 to display
-    :return: subsampled points, with features and/or labels depending of the input
+    :param num_threads: number of threads subsampling slabs of the grid (0 for all the available cores), same result
+    :param return_inverse: if True, also return the (N,) int32 index of the subsampled point of each input point
+    :param method: 'barycenters', or the representative point of each voxel: 'first' (in input order), 'random' (drawn
+                   from seed) or 'center' (closest to the voxel center). Representatives keep their original features
+                   and labels (no averaging or voting)
+    :param seed: seed of the 'random' method
+    :return: subsampled points, with features and/or labels depending of the input, and the inverse indices last
     """
 
+    # Gather the representative points with their features and labels
+    if method != 'barycenters':
+        inds = cpp_subsampling.subsample(points,
+                                         sampleDl=sampleDl,
+                                         method=method,
+                                         seed=seed,
+                                         verbose=verbose,
+                                         num_threads=num_threads,
+                                         return_inverse=return_inverse)
+        inds, *inverse = inds if return_inverse else (inds,)
+        outputs = [np.asarray(points, dtype=np.float32)[inds]]
+        if features is not None:
+            outputs += [features[inds]]
+        if labels is not None:
+            outputs += [np.asarray(labels, dtype=np.int32).reshape(len(points), -1)[inds]]
+        outputs += inverse
+        return tuple(outputs) if len(outputs) > 1 else outputs[0]
+
     if (features is None) and (labels is None):
         return cpp_subsampling.subsample(points,
                                          sampleDl=sampleDl,
-                                         verbose=verbose)
+                                         verbose=verbose,
+                                         num_threads=num_threads,
+                                         return_inverse=return_inverse)
     elif (labels is None):
         return cpp_subsampling.subsample(points,
                                          features=features,
                                          sampleDl=sampleDl,
-                                         verbose=verbose)
+                                         verbose=verbose,
+                                         num_threads=num_threads,
+                                         return_inverse=return_inverse)
     elif (features is None):
         return cpp_subsampling.subsample(points,
                                          classes=labels,
                                          sampleDl=sampleDl,
-                                         verbose=verbose)
+                                         verbose=verbose,
+                                         num_threads=num_threads,
+                                         return_inverse=return_inverse)
     else:
         return cpp_subsampling.subsample(points,
                                          features=features,
                                          classes=labels,
                                          sampleDl=sampleDl,
-                                         verbose=verbose)
+                                         verbose=verbose,
+                                         num_threads=num_threads,
+                                         return_inverse=return_inverse)
+
+
+def random_grid_rotations(B):
+    """
+    Creates a random rotation matrix for each batch element, used to randomly orient the subsampling grids
+    :param B: number of batch elements
+    :return: (B, 3, 3) float32 rotation matrices
+    """
+
+    # Choose two random angles for the first vector in polar coordinates
+    theta = np.random.rand(B) * 2 * np.pi
+    phi = (np.random.rand(B) - 0.5) * np.pi
+
+    # Create the first vector in carthesian coordinates
+    u = np.vstack([np.cos(theta) * np.cos(phi), np.sin(theta) * np.cos(phi), np.sin(phi)])
+
+    # Choose a random rotation angle
+    alpha = np.random.rand(B) * 2 * np.pi
+
+    # Create the rotation matrix with this vector and angle
+    return create_3D_rotations(u.T, alpha).astype(np.float32)
 
 
 def batch_grid_subsampling(points, batches_len, features=None, labels=None,
-                           sampleDl=0.1, max_p=0, verbose=0, random_grid_orient=True):
+                           sampleDl=0.1, max_p=0, verbose=0, random_grid_orient=True, num_threads=1,
+                           method='barycenters', seed=0):
     """
     CPP wrapper for a grid subsampling (method = barycenter for points and features)
     :param points: (N, 3) matrix of input points
@@ -83,117 +148,163 @@ def batch_grid_subsampling(points, batches_len, features=None, labels=None,
     :param labels: optional (N,) matrix of integer labels
     :param sampleDl: parameter defining the size of grid voxels
     :param verbose: 1 to display
+    :param random_grid_orient: randomly orient the grid of each batch element (rotated natively)
+    :param num_threads: number of threads subsampling the batch elements (0 for all the available cores)
+    :param method: 'barycenters', 'first', 'random' or 'center' (see grid_subsampling)
+    :param seed: seed of the 'random' method (batch element b uses seed + b)
     :return: subsampled points, with features and/or labels depending of the input
     """
 
-    R = None
-    B = len(batches_len)
-    if random_grid_orient:
+    # Create a random rotation matrix for each batch element
+    R = random_grid_rotations(len(batches_len)) if random_grid_orient else None
+
+    # Subsample in the rotated frames and realign natively
+    kwargs = {}
+    if features is not None:
+        kwargs['features'] = features
+    if labels is not None:
+        kwargs['classes'] = labels
+    return cpp_subsampling.subsample_batch(points,
+                                           batches_len,
+                                           sampleDl=sampleDl,
+                                           max_p=max_p,
+                                           verbose=verbose,
+                                           rotations=R,
+                                           num_threads=num_threads,
+                                           method=method,
+                                           seed=seed,
+                                           **kwargs)
+
+
+def batch_neighbors(queries, supports, q_batches, s_batches, radius, max_neighbors=0, num_threads=1, ragged=False,
+                    backend='kdtree'):
+    """
+    Computes neighbors for a batch of queries and supports
+    :param queries: (N1, 3) the query points
+    :param supports: (N2, 3) the support points
+    :param q_batches: (B) the list of lengths of batch elements in queries
+    :param s_batches: (B)the list of lengths of batch elements in supports
+    :param radius: float32
+    :param max_neighbors: only keep the max_neighbors closest neighbors of each query (0 for no limit)
+    :param num_threads: number of threads used for the queries (0 for all the available cores)
+    :param ragged: if True, return a tuple (offsets, indices) in CSR format instead of a padded matrix
+    :param backend: search engine, 'kdtree' (nanoflann) or 'grid' (voxel hash grid with a cell size of radius)
+    :return: neighbors indices
+    """
 
-        ########################################################
-        # Create a random rotation matrix for each batch element
-        ########################################################
+    return cpp_neighbors.batch_query(queries, supports, q_batches, s_batches,
+                                     radius=radius,
+                                     max_neighbors=max_neighbors,
+                                     num_threads=num_threads,
+                                     ragged=ragged,
+                                     backend=backend)
 
-        # Choose two random angles for the first vector in polar coordinates
-        theta = np.random.rand(B) * 2 * np.pi
-        phi = (np.random.rand(B) - 0.5) * np.pi
 
-        # Create the first vector in carthesian coordinates
-        u = np.vstack([np.cos(theta) * np.cos(phi), np.sin(theta) * np.cos(phi), np.sin(phi)])
+def neighbors_from_numpy(neighbors):
+    """
+    Converts the neighbors of one layer to torch: padded matrices become tensors and CSR tuples become RaggedNeighbors
+    """
 
-        # Choose a random rotation angle
-        alpha = np.random.rand(B) * 2 * np.pi
+    if isinstance(neighbors, tuple):
+        return RaggedNeighbors.from_numpy(neighbors)
+    return torch.from_numpy(neighbors)
 
-        # Create the rotation matrix with this vector and angle
-        R = create_3D_rotations(u.T, alpha).astype(np.float32)
 
-        #################
-        # Apply rotations
-        #################
+def neighbors_counts(neighbors):
+    """
+    Returns the number of neighbors of each query as a numpy array (used for neighborhood calibration)
+    """
 
-        i0 = 0
-        points = points.copy()
-        for bi, length in enumerate(batches_len):
-            # Apply the rotation
-            points[i0:i0 + length, :] = np.sum(np.expand_dims(points[i0:i0 + length, :], 2) * R[bi], axis=1)
-            i0 += length
+    if isinstance(neighbors, RaggedNeighbors):
+        return neighbors.counts().numpy()
+    neighb_mat = neighbors.numpy()
+    return np.sum(neighb_mat < neighb_mat.shape[0], axis=1)
 
-    #######################
-    # Sunsample and realign
-    #######################
 
-    if (features is None) and (labels is None):
-        s_points, s_len = cpp_subsampling.subsample_batch(points,
-                                                          batches_len,
-                                                          sampleDl=sampleDl,
-                                                          max_p=max_p,
-                                                          verbose=verbose)
-        if random_grid_orient:
-            i0 = 0
-            for bi, length in enumerate(s_len):
-                s_points[i0:i0 + length, :] = np.sum(np.expand_dims(s_points[i0:i0 + length, :], 2) * R[bi].T, axis=1)
-                i0 += length
-        return s_points, s_len
+def tree_points(tree, inds=None):
+    """
+    Float32 points of a KDTree (only the points inds if given). The points of a tree on quantized coordinates are
+    dequantized as the tree does, so that only the extracted points are ever converted
+    """
+    points = tree.data if inds is None else tree.data[inds]
+    if points.dtype == np.float32:
+        return points
+    return points.astype(np.float32) * np.float32(tree.scale)
 
-    elif (labels is None):
-        s_points, s_len, s_features = cpp_subsampling.subsample_batch(points,
-                                                                      batches_len,
-                                                                      features=features,
-                                                                      sampleDl=sampleDl,
-                                                                      max_p=max_p,
-                                                                      verbose=verbose)
-        if random_grid_orient:
-            i0 = 0
-            for bi, length in enumerate(s_len):
-                # Apply the rotation
-                s_points[i0:i0 + length, :] = np.sum(np.expand_dims(s_points[i0:i0 + length, :], 2) * R[bi].T, axis=1)
-                i0 += length
-        return s_points, s_len, s_features
 
-    elif (features is None):
-        s_points, s_len, s_labels = cpp_subsampling.subsample_batch(points,
-                                                                    batches_len,
-                                                                    classes=labels,
-                                                                    sampleDl=sampleDl,
-                                                                    max_p=max_p,
-                                                                    verbose=verbose)
-        if random_grid_orient:
-            i0 = 0
-            for bi, length in enumerate(s_len):
-                # Apply the rotation
-                s_points[i0:i0 + length, :] = np.sum(np.expand_dims(s_points[i0:i0 + length, :], 2) * R[bi].T, axis=1)
-                i0 += length
-        return s_points, s_len, s_labels
+def save_cloud_arrays(prefix, **arrays):
+    """
+    Saves the arrays of a subsampled cloud as raw .npy files named <prefix>_<name>.npy. Each file is written under a
+    temporary name and then renamed, so that an interrupted preparation never leaves a truncated array in the cache
+    """
 
-    else:
-        s_points, s_len, s_features, s_labels = cpp_subsampling.subsample_batch(points,
-                                                                              batches_len,
-                                                                              features=features,
-                                                                              classes=labels,
-                                                                              sampleDl=sampleDl,
-                                                                              max_p=max_p,
-                                                                              verbose=verbose)
-        if random_grid_orient:
-            i0 = 0
-            for bi, length in enumerate(s_len):
-                # Apply the rotation
-                s_points[i0:i0 + length, :] = np.sum(np.expand_dims(s_points[i0:i0 + length, :], 2) * R[bi].T, axis=1)
-                i0 += length
-        return s_points, s_len, s_features, s_labels
-
-
-def batch_neighbors(queries, supports, q_batches, s_batches, radius):
+    for name, array in arrays.items():
+        file_path = '{:s}_{:s}.npy'.format(prefix, name)
+        tmp_path = '{:s}_{:s}.tmp.npy'.format(prefix, name)
+        np.save(tmp_path, np.ascontiguousarray(array))
+        os.replace(tmp_path, file_path)
+
+
+def load_cloud_arrays(prefix, names):
     """
-    Computes neighbors for a batch of queries and supports
-    :param queries: (N1, 3) the query points
-    :param supports: (N2, 3) the support points
-    :param q_batches: (B) the list of lengths of batch elements in queries
-    :param s_batches: (B)the list of lengths of batch elements in supports
-    :param radius: float32
-    :return: neighbors indices
+    Opens the arrays saved by save_cloud_arrays as read-only memory maps, in the order of names (None if one of them
+    is missing). Nothing is read at opening: pages are loaded on access and shared through the OS page cache by all
+    the processes mapping the same files, e.g. the DataLoader workers
+    """
+
+    file_paths = ['{:s}_{:s}.npy'.format(prefix, name) for name in names]
+    if not all(os.path.isfile(file_path) for file_path in file_paths):
+        return None
+    return [np.load(file_path, mmap_mode='r') for file_path in file_paths]
+
+
+def timed_call(fn, *args, **kwargs):
+    """Calls fn and returns its duration (module level to be sent to the processes of a pool)"""
+    t0 = time.time()
+    fn(*args, **kwargs)
+    return time.time() - t0
+
+
+def prepare_clouds(prepare_fn, tasks, num_workers=1, num_threads=0):
     """
+    Prepares the clouds missing from the cache of a dataset, in a pool of processes. The clouds are independent and
+    prepare_fn saves its results in the cache, nothing is sent back to the calling process.
+    :param prepare_fn: picklable function preparing one cloud, called as prepare_fn(*args, num_threads=...)
+    :param tasks: list of (cloud_name, args) of the clouds to prepare
+    :param num_workers: number of processes (0 for all the available cores, 1 to prepare the clouds in this process)
+    :param num_threads: threads of the subsampling of each cloud (0 for all the available cores, which are then shared
+                        by the processes)
+    """
+
+    if len(tasks) == 0:
+        return
+
+    num_cores = os.cpu_count() or 1
+    if num_workers <= 0:
+        num_workers = num_cores
+    num_workers = min(num_workers, len(tasks))
+    if num_threads <= 0 and num_workers > 1:
+        num_threads = max(1, num_cores // num_workers)
 
-    return cpp_neighbors.batch_query(queries, supports, q_batches, s_batches, radius=radius)
+    t0 = time.time()
+    print('\nPreparing {:d} clouds with {:d} processes'.format(len(tasks), num_workers))
+
+    # Clouds prepared in this process, one after the other
+    if num_workers == 1:
+        for i, (cloud_name, args) in enumerate(tasks):
+            duration = timed_call(prepare_fn, *args, num_threads=num_threads)
+            print('[{:d}/{:d}] {:s} prepared in {:.1f}s'.format(i + 1, len(tasks), cloud_name, duration))
+
+    # Clouds prepared by the pool, reported as they are done
+    else:
+        with ProcessPoolExecutor(num_workers) as pool:
+            futures = {pool.submit(timed_call, prepare_fn, *args, num_threads=num_threads): cloud_name
+                       for cloud_name, args in tasks}
+            for i, future in enumerate(as_completed(futures)):
+                print('[{:d}/{:d}] {:s} prepared in {:.1f}s'.format(i + 1, len(tasks), futures[future],
+                                                                    future.result()))
+
+    print('Done in {:.1f}s'.format(time.time() - t0))
 
 
 # ----------------------------------------------------------------------------------------------------------------------
@@ -236,6 +347,13 @@ class PointCloudDataset(Dataset):
 
         return 0
 
+    def cloud_origin(self, cloud_ind):
+        """
+        Double precision origin of the coordinates of a cloud, added back to the points of the dataset (e.g. the
+        potential locations) when they are saved next to the original points
+        """
+        return np.zeros(3)
+
     def init_labels(self):
 
         # Initialize all label parameters given the label_to_names dict
@@ -329,23 +447,107 @@ class PointCloudDataset(Dataset):
 
             return augmented_points, augmented_normals, scale, R
 
-    def big_neighborhood_filter(self, neighbors, layer):
+    def num_centers_to_draw(self, batch_n, num_spheres):
+        """
+        Number of sphere centers to draw from the potentials at once: the number of spheres still needed to fill the
+        batch, estimated from the spheres already collected, and at most config.centers_per_draw
+        """
+
+        if self.set == 'ERF' or self.config.centers_per_draw <= 1 or num_spheres == 0:
+            return 1
+        remaining = int(np.ceil((int(self.batch_limit) - batch_n) * num_spheres / batch_n))
+        return int(np.clip(remaining, 1, self.config.centers_per_draw))
+
+    def draw_potential_centers(self, num_centers, shard=None):
+        """
+        Draws input sphere centers at the minimum of the potentials (of a shard in sharded mode). The potentials are
+        updated after each center, which moves the next minimum away from it. Call with the lock of the potentials.
+        :return: list of (cloud_ind, point_ind, center_point) with center_point of shape [1, 3]
+        """
+
+        centers = []
+        for _ in range(num_centers):
+
+            # Get potential minimum
+            if self.sharded_potentials is not None:
+                cloud_ind, point_ind = self.sharded_potentials.argmin(shard)
+            else:
+                cloud_ind = int(torch.argmin(self.min_potentials))
+                point_ind = int(self.argmin_potentials[cloud_ind])
+
+            # Get potential points from tree structure
+            pot_points = np.array(self.pot_trees[cloud_ind].data, copy=False)
+
+            # Center point of input region
+            center_point = np.copy(pot_points[point_ind, :].reshape(1, -1))
+
+            # Add a small noise to center point
+            if self.set != 'ERF':
+                center_point += np.clip(np.random.normal(scale=self.config.in_radius / 10, size=center_point.shape),
+                                        -self.config.in_radius / 2,
+                                        self.config.in_radius / 2)
+
+            # Indices of points in input region
+            pot_inds, dists = self.pot_trees[cloud_ind].query_radius(center_point,
+                                                                     r=self.config.in_radius,
+                                                                     return_distance=True)
+
+            d2s = np.square(dists[0])
+            pot_inds = pot_inds[0]
+
+            # Update potentials (Tukey weights)
+            if self.set != 'ERF':
+                tukeys = np.square(1 - d2s / np.square(self.config.in_radius))
+                tukeys[d2s > np.square(self.config.in_radius)] = 0
+                if self.sharded_potentials is not None:
+                    self.sharded_potentials.add(shard, cloud_ind, pot_inds, tukeys)
+                else:
+                    self.potential_trees[cloud_ind].add(pot_inds, tukeys)
+                    min_ind, min_pot = self.potential_trees[cloud_ind].argmin()
+                    self.min_potentials[[cloud_ind]] = min_pot
+                    self.argmin_potentials[[cloud_ind]] = min_ind
+
+            centers += [(cloud_ind, point_ind, center_point)]
+
+        return centers
+
+    def gather_input_spheres(self, centers):
+        """
+        Indices of the input points in the spheres of the given centers, with one radius query per cloud for all its
+        centers
+        :param centers: list of (cloud_ind, point_ind, center_point) as returned by draw_potential_centers
+        :return: list of input indices arrays, in the order of the centers
+        """
+
+        input_inds = [None] * len(centers)
+        for cloud_ind in sorted(set(c[0] for c in centers)):
+            sphere_inds = [i for i, c in enumerate(centers) if c[0] == cloud_ind]
+            queries = np.vstack([centers[i][2] for i in sphere_inds])
+            cloud_inds = self.input_trees[cloud_ind].query_radius(queries,
+                                                                 r=self.config.in_radius,
+                                                                 num_threads=self.config.neighbors_threads)
+            for i, inds in zip(sphere_inds, cloud_inds):
+                input_inds[i] = inds
+
+        return input_inds
+
+    def neighborhood_limit(self, layer):
         """
-        Filter neighborhoods with max number of neighbors. Limit is set to keep XX% of the neighborhoods untouched.
-        Limit is computed at initialization
+        Max number of neighbors kept by the queries of a layer. Limit is set to keep XX% of the neighborhoods
+        untouched. Limit is computed at initialization (no limit before calibration)
         """
 
-        # crop neighbors matrix
         if len(self.neighborhood_limits) > 0:
-            return neighbors[:, :self.neighborhood_limits[layer]]
+            return int(self.neighborhood_limits[layer])
         else:
-            return neighbors
+            return 0
 
-    def classification_inputs(self,
-                              stacked_points,
-                              stacked_features,
-                              labels,
-                              stack_lengths):
+    def pyramid_parameters(self, upsample=True):
+        """
+        Radii and neighborhood limits of every layer of the network inputs, given by the architecture blocks
+        :param upsample: compute the upsampling neighbors (segmentation networks)
+        :return: dict of (L,) arrays with the keywords of cpp_pyramid.build_pyramid
+        """
 
         # Starting radius of convolutions
         r_normal = self.config.first_subsampling_dl * self.config.conv_radius
@@ -353,12 +555,9 @@ class PointCloudDataset(Dataset):
         # Starting layer
         layer_blocks = []
 
-        # Lists of inputs
-        input_points = []
-        input_neighbors = []
-        input_pools = []
-        input_stack_lengths = []
-        deform_layers = []
+        # Parameters of each layer
+        params = {key: [] for key in ['conv_radii', 'pool_dls', 'pool_radii', 'up_radii',
+                                      'conv_limits', 'pool_limits', 'up_limits']}
 
         ######################
         # Loop over the blocks
@@ -373,65 +572,41 @@ class PointCloudDataset(Dataset):
                 layer_blocks += [block]
                 continue
 
-            # Convolution neighbors indices
-            # *****************************
+            layer = len(params['conv_radii'])
 
-            deform_layer = False
+            # Convolution neighbors radius (none if this layer only perform pooling)
+            conv_r = 0
             if layer_blocks:
-                # Convolutions are done in this layer, compute the neighbors with the good radius
                 if np.any(['deformable' in blck for blck in layer_blocks]):
-                    r = r_normal * self.config.deform_radius / self.config.conv_radius
-                    deform_layer = True
+                    conv_r = r_normal * self.config.deform_radius / self.config.conv_radius
                 else:
-                    r = r_normal
-                conv_i = batch_neighbors(stacked_points, stacked_points, stack_lengths, stack_lengths, r)
-
-            else:
-                # This layer only perform pooling, no neighbors required
-                conv_i = np.zeros((0, 1), dtype=np.int32)
-
-            # Pooling neighbors indices
-            # *************************
+                    conv_r = r_normal
 
-            # If end of layer is a pooling operation
+            # Pooling and upsampling parameters (if end of layer is a pooling operation)
+            pool_dl, pool_r, up_r, up_limit = 0, 0, 0, 0
             if 'pool' in block or 'strided' in block:
 
                 # New subsampling length
-                dl = 2 * r_normal / self.config.conv_radius
-
-                # Subsampled points
-                pool_p, pool_b = batch_grid_subsampling(stacked_points, stack_lengths, sampleDl=dl)
+                pool_dl = 2 * r_normal / self.config.conv_radius
 
                 # Radius of pooled neighbors
                 if 'deformable' in block:
-                    r = r_normal * self.config.deform_radius / self.config.conv_radius
-                    deform_layer = True
+                    pool_r = r_normal * self.config.deform_radius / self.config.conv_radius
                 else:
-                    r = r_normal
+                    pool_r = r_normal
 
-                # Subsample indices
-                pool_i = batch_neighbors(pool_p, stacked_points, pool_b, stack_lengths, r)
+                # Upsample radius (the one of the next layer to keep wanted density)
+                if upsample:
+                    up_r = 2 * pool_r
+                    up_limit = self.neighborhood_limit(layer + 1)
 
-            else:
-                # No pooling in the end of this layer, no pooling indices required
-                pool_i = np.zeros((0, 1), dtype=np.int32)
-                pool_p = np.zeros((0, 1), dtype=np.float32)
-                pool_b = np.zeros((0,), dtype=np.int32)
-
-            # Reduce size of neighbors matrices by eliminating furthest point
-            conv_i = self.big_neighborhood_filter(conv_i, len(input_points))
-            pool_i = self.big_neighborhood_filter(pool_i, len(input_points))
-
-            # Updating input lists
-            input_points += [stacked_points]
-            input_neighbors += [conv_i.astype(np.int64)]
-            input_pools += [pool_i.astype(np.int64)]
-            input_stack_lengths += [stack_lengths]
-            deform_layers += [deform_layer]
-
-            # New points for next layer
-            stacked_points = pool_p
-            stack_lengths = pool_b
+            params['conv_radii'] += [conv_r]
+            params['pool_dls'] += [pool_dl]
+            params['pool_radii'] += [pool_r]
+            params['up_radii'] += [up_r]
+            params['conv_limits'] += [self.neighborhood_limit(layer)]
+            params['pool_limits'] += [self.neighborhood_limit(layer)]
+            params['up_limits'] += [up_limit]
 
             # Update radius and reset blocks
             r_normal *= 2
@@ -441,12 +616,54 @@ class PointCloudDataset(Dataset):
             if 'global' in block or 'upsample' in block:
                 break
 
+        params = {key: np.array(value, dtype=np.int32 if 'limits' in key else np.float32)
+                  for key, value in params.items()}
+
+        return params
+
+    def pyramid_inputs(self, stacked_points, stack_lengths, upsample=True, ragged=False):
+        """
+        Computes the points, neighbors, pools, upsamples and lengths of every layer in a single native call
+        """
+
+        params = self.pyramid_parameters(upsample)
+
+        # Random orientation of the subsampling grid of each pooling layer
+        L = len(params['conv_radii'])
+        B = len(stack_lengths)
+        rotations = np.tile(np.eye(3, dtype=np.float32), (L, B, 1, 1))
+        for layer in range(L):
+            if params['pool_dls'][layer] > 0:
+                rotations[layer] = random_grid_rotations(B)
+
+        # Representative points of the pooling voxels are only drawn with the 'random' method
+        seed = np.random.randint(2 ** 31) if self.config.pooling_method == 'random' else 0
+
+        return cpp_pyramid.build_pyramid(stacked_points,
+                                         stack_lengths,
+                                         rotations=rotations,
+                                         ragged=ragged,
+                                         num_threads=self.config.neighbors_threads,
+                                         backend=self.config.neighbors_backend,
+                                         subsampling=self.config.pooling_method,
+                                         seed=seed,
+                                         int64_indices=self.config.neighbors_dtype == 'int64',
+                                         **params)
+
+    def classification_inputs(self,
+                              stacked_points,
+                              stacked_features,
+                              labels,
+                              stack_lengths):
+
+        # Points, neighbors and pooling indices of every layer
+        input_points, input_neighbors, input_pools, _, input_stack_lengths = \
+            self.pyramid_inputs(stacked_points, stack_lengths, upsample=False)
+
         ###############
         # Return inputs
         ###############
 
-        # Save deform layers
-
         # list of network inputs
         li = input_points + input_neighbors + input_pools + input_stack_lengths
         li += [stacked_features, labels]
@@ -460,127 +677,557 @@ class PointCloudDataset(Dataset):
                             labels,
                             stack_lengths):
 
-        # Starting radius of convolutions
-        r_normal = self.config.first_subsampling_dl * self.config.conv_radius
+        # Padded neighbors matrices or CSR (offsets, indices) tuples
+        ragged = self.config.neighbors_format == 'ragged'
 
-        # Starting layer
-        layer_blocks = []
+        # Points, neighbors, pooling and upsampling indices of every layer
+        input_points, input_neighbors, input_pools, input_upsamples, input_stack_lengths = \
+            self.pyramid_inputs(stacked_points, stack_lengths, upsample=True, ragged=ragged)
 
-        # Lists of inputs
-        input_points = []
-        input_neighbors = []
-        input_pools = []
-        input_upsamples = []
-        input_stack_lengths = []
-        deform_layers = []
+        ###############
+        # Return inputs
+        ###############
 
-        ######################
-        # Loop over the blocks
-        ######################
+        # list of network inputs
+        li = input_points + input_neighbors + input_pools + input_upsamples + input_stack_lengths
+        li += [stacked_features, labels]
 
-        arch = self.config.architecture
+        return li
 
-        for block_i, block in enumerate(arch):
 
-            # Get all blocks of the layer
-            if not ('pool' in block or 'strided' in block or 'global' in block or 'upsample' in block):
-                layer_blocks += [block]
-                continue
+class RaggedNeighbors:
+    """
+    Neighbors of a layer in compressed sparse row (CSR) format. The neighbors of query i are
+    indices[offsets[i]:offsets[i + 1]], sorted by distance, without any shadow neighbor. The query of every neighbor
+    (rows) is stored as well, so that the convolutions can scatter their results without recomputing it.
+    """
 
-            # Convolution neighbors indices
-            # *****************************
+    def __init__(self, offsets, indices, rows=None):
+        """
+        :param offsets: [n_queries + 1] int64 tensor
+        :param indices: [n_edges] int32 or int64 tensor of support indices
+        :param rows: optional [n_edges] tensor of query indices (same type as indices)
+        """
 
-            deform_layer = False
-            if layer_blocks:
-                # Convolutions are done in this layer, compute the neighbors with the good radius
-                if np.any(['deformable' in blck for blck in layer_blocks]):
-                    r = r_normal * self.config.deform_radius / self.config.conv_radius
-                    deform_layer = True
-                else:
-                    r = r_normal
-                conv_i = batch_neighbors(stacked_points, stacked_points, stack_lengths, stack_lengths, r)
+        self.offsets = offsets
+        self.indices = indices
+        if rows is None:
+            rows = torch.repeat_interleave(torch.arange(len(offsets) - 1, dtype=indices.dtype, device=offsets.device),
+                                           self.counts())
+        self.rows = rows
 
-            else:
-                # This layer only perform pooling, no neighbors required
-                conv_i = np.zeros((0, 1), dtype=np.int32)
+        return
 
-            # Pooling neighbors indices
-            # *************************
+    @classmethod
+    def from_numpy(cls, neighbors):
+        offsets, indices = neighbors
+        return cls(torch.from_numpy(offsets), torch.from_numpy(indices))
 
-            # If end of layer is a pooling operation
-            if 'pool' in block or 'strided' in block:
+    @property
+    def num_queries(self):
+        return self.offsets.shape[0] - 1
 
-                # New subsampling length
-                dl = 2 * r_normal / self.config.conv_radius
+    def counts(self):
+        """Number of neighbors of each query"""
+        return self.offsets[1:] - self.offsets[:-1]
 
-                # Subsampled points
-                pool_p, pool_b = batch_grid_subsampling(stacked_points, stack_lengths, sampleDl=dl)
+    def closest(self, shadow_index):
+        """Index of the closest neighbor of each query, shadow_index for queries without neighbors"""
+        if self.indices.shape[0] == 0:
+            return torch.full((self.num_queries,), shadow_index, dtype=self.indices.dtype, device=self.indices.device)
+        first = self.indices[torch.clamp(self.offsets[:-1], max=self.indices.shape[0] - 1)]
+        return torch.where(self.counts() > 0, first, torch.full_like(first, shadow_index))
 
-                # Radius of pooled neighbors
-                if 'deformable' in block:
-                    r = r_normal * self.config.deform_radius / self.config.conv_radius
-                    deform_layer = True
-                else:
-                    r = r_normal
+    def to_dense(self, shadow_index):
+        """Padded [n_queries, max_count] neighbors matrix, as produced with config.neighbors_format == 'dense'"""
+        counts = self.counts()
+        max_count = int(torch.max(counts)) if counts.shape[0] > 0 else 0
+        dense = torch.full((self.num_queries, max_count), shadow_index, dtype=self.indices.dtype,
+                           device=self.indices.device)
+        dense[self.rows, torch.arange(self.indices.shape[0], device=self.rows.device) - self.offsets[self.rows]] = \
+            self.indices
+        return dense
 
-                # Subsample indices
-                pool_i = batch_neighbors(pool_p, stacked_points, pool_b, stack_lengths, r)
+    def pin_memory(self):
+        return RaggedNeighbors(self.offsets.pin_memory(), self.indices.pin_memory(), self.rows.pin_memory())
 
-                # Upsample indices (with the radius of the next layer to keep wanted density)
-                up_i = batch_neighbors(stacked_points, pool_p, stack_lengths, pool_b, 2 * r)
+    def to(self, device):
+        return RaggedNeighbors(self.offsets.to(device), self.indices.to(device), self.rows.to(device))
 
-            else:
-                # No pooling in the end of this layer, no pooling indices required
-                pool_i = np.zeros((0, 1), dtype=np.int32)
-                pool_p = np.zeros((0, 3), dtype=np.float32)
-                pool_b = np.zeros((0,), dtype=np.int32)
-                up_i = np.zeros((0, 1), dtype=np.int32)
-
-            # Reduce size of neighbors matrices by eliminating furthest point
-            conv_i = self.big_neighborhood_filter(conv_i, len(input_points))
-            pool_i = self.big_neighborhood_filter(pool_i, len(input_points))
-            if up_i.shape[0] > 0:
-                up_i = self.big_neighborhood_filter(up_i, len(input_points)+1)
-
-            # Updating input lists
-            input_points += [stacked_points]
-            input_neighbors += [conv_i.astype(np.int64)]
-            input_pools += [pool_i.astype(np.int64)]
-            input_upsamples += [up_i.astype(np.int64)]
-            input_stack_lengths += [stack_lengths]
-            deform_layers += [deform_layer]
-
-            # New points for next layer
-            stacked_points = pool_p
-            stack_lengths = pool_b
 
-            # Update radius and reset blocks
-            r_normal *= 2
-            layer_blocks = []
+class PotentialTree:
+    """
+    Potentials of the coarse points of a cloud, stored as the leaves of a min segment tree. Every node holds the
+    minimum of its subtree and the leaf where it is reached, so the argmin is read at the root in O(1) and a batch of
+    k increments costs O(k log n) instead of a full argmin over the cloud. The tree lives in shared memory tensors,
+    updated in place by all the DataLoader workers (under the dataset worker_lock).
+    """
 
-            # Stop when meeting a global pooling or upsampling
-            if 'global' in block or 'upsample' in block:
-                break
+    def __init__(self, potentials):
+        """
+        :param potentials: [n] initial potentials
+        """
+
+        # Complete binary tree: node i has children 2i and 2i + 1, the leaves start at index size
+        self.n = len(potentials)
+        self.size = 1 << max(0, int(self.n - 1).bit_length())
+        values = np.full(2 * self.size, np.inf, dtype=np.float64)
+        values[self.size:self.size + self.n] = potentials
+        argmins = np.zeros(2 * self.size, dtype=np.int64)
+        argmins[self.size:] = np.arange(self.size)
+
+        # Build the inner nodes level by level
+        level = self.size // 2
+        while level >= 1:
+            self._pull(values, argmins, np.arange(level, 2 * level))
+            level //= 2
+
+        self.values = torch.from_numpy(values)
+        self.argmins = torch.from_numpy(argmins)
+        self.values.share_memory_()
+        self.argmins.share_memory_()
+
+        return
+
+    @staticmethod
+    def _pull(values, argmins, nodes):
+        """Updates the given nodes from their children (ties go to the left child, i.e. the smallest index)"""
+        left = 2 * nodes
+        child = np.where(values[left + 1] < values[left], left + 1, left)
+        values[nodes] = values[child]
+        argmins[nodes] = argmins[child]
+
+    @property
+    def potentials(self):
+        """[n] tensor of the potentials (a view of the leaves, do not modify it directly)"""
+        return self.values[self.size:self.size + self.n]
+
+    def argmin(self):
+        """Index and value of the minimal potential"""
+        return int(self.argmins[1]), float(self.values[1])
+
+    def add(self, inds, increments):
+        """
+        Adds increments to the potentials of the points inds (unique indices, as returned by a radius query)
+        :param inds: [k] point indices
+        :param increments: [k] values added to their potentials
+        """
+
+        if len(inds) == 0:
+            return
+
+        # Numpy views of the shared memory
+        values = self.values.numpy()
+        argmins = self.argmins.numpy()
+
+        # Update the leaves
+        nodes = np.asarray(inds, dtype=np.int64) + self.size
+        values[nodes] += increments
+
+        # Then their ancestors level by level up to the root (sorted nodes stay sorted when halved, so duplicates are
+        # contiguous)
+        nodes = np.sort(nodes)
+        while nodes[0] > 1:
+            nodes >>= 1
+            keep = np.empty(len(nodes), dtype=bool)
+            keep[0] = True
+            np.not_equal(nodes[1:], nodes[:-1], out=keep[1:])
+            nodes = nodes[keep]
+            self._pull(values, argmins, nodes)
+
+        return
+
+
+class ShardedPotentials:
+    """
+    Potentials partitioned across the input workers. The coarse points of the clouds are grouped in square tiles, and
+    consecutive tiles (cloud by cloud, column by column) are split in one shard per worker holding the same number of
+    points. Each worker draws its spheres in its own shard and only updates the potentials of its shard, under a lock
+    that the other workers only take to rebalance: when a shard is behind the others by more than rebalance_margin
+    (the potential added at the center of a sphere by default), the workers ahead draw their next spheres in it.
+    """
+
+    def __init__(self, pot_points, potentials, num_shards, tile_size, rebalance_margin=1.0):
+        """
+        :param pot_points: list of [n_c, 3] coarse points of each cloud
+        :param potentials: list of [n_c] initial potentials of each cloud
+        :param num_shards: number of shards, i.e. of input workers
+        :param tile_size: side of the square tiles distributed to the shards
+        :param rebalance_margin: potential lag above which a shard is helped by the others
+        """
+
+        self.num_shards = max(1, num_shards)
+        self.rebalance_margin = rebalance_margin
+        potentials = [np.asarray(cloud_potentials, dtype=np.float64) for cloud_potentials in potentials]
+        num_clouds = len(pot_points)
 
         ###############
-        # Return inputs
+        # Tile the clouds
         ###############
 
-        # list of network inputs
-        li = input_points + input_neighbors + input_pools + input_upsamples + input_stack_lengths
-        li += [stacked_features, labels]
+        # Tile of every point, ordered by cloud then by column (x) and row (y)
+        cloud_ids = np.concatenate([np.full(len(points), c, dtype=np.int64) for c, points in enumerate(pot_points)])
+        tiles = np.vstack([np.floor(points[:, :2] / tile_size).astype(np.int64) for points in pot_points])
+        order = np.lexsort((tiles[:, 1], tiles[:, 0], cloud_ids))
+        sorted_keys = np.stack((cloud_ids[order], tiles[order, 0], tiles[order, 1]), axis=1)
+        first = np.concatenate(([True], np.any(sorted_keys[1:] != sorted_keys[:-1], axis=1)))
 
-        return li
+        # Each tile goes to the shard of its middle point in this order, so that shards get the same number of points
+        tile_starts = np.flatnonzero(first)
+        tile_ends = np.append(tile_starts[1:], len(order))
+        tile_shards = np.minimum((tile_starts + tile_ends) * self.num_shards // (2 * len(order)), self.num_shards - 1)
+        point_shards = np.empty(len(order), dtype=np.int64)
+        point_shards[order] = np.repeat(tile_shards, tile_ends - tile_starts)
+
+        ###############
+        # Shard potentials
+        ###############
+
+        # Owner shard and index in the shard tree of every point, points of each (shard, cloud) and their trees
+        self.owners = []
+        self.local_inds = []
+        self.shard_points = [[] for _ in range(self.num_shards)]
+        self.trees = [[] for _ in range(self.num_shards)]
+        self.shard_min = torch.full((self.num_shards, num_clouds), np.inf, dtype=torch.float64)
+        i0 = 0
+        for c, cloud_potentials in enumerate(potentials):
+            owners = point_shards[i0:i0 + len(cloud_potentials)]
+            local_inds = np.zeros(len(owners), dtype=np.int64)
+            for s in range(self.num_shards):
+                inds = np.flatnonzero(owners == s)
+                local_inds[inds] = np.arange(len(inds))
+                self.shard_points[s] += [inds]
+                self.trees[s] += [PotentialTree(cloud_potentials[inds]) if len(inds) > 0 else None]
+                if len(inds) > 0:
+                    self.shard_min[s, c] = self.trees[s][c].argmin()[1]
+            self.owners += [owners]
+            self.local_inds += [local_inds]
+            i0 += len(cloud_potentials)
+
+        # Full potentials and minimum of each cloud, as in the unsharded datasets
+        self.potentials = [torch.from_numpy(np.copy(cloud_potentials)) for cloud_potentials in potentials]
+        self.min_potentials = torch.min(self.shard_min, dim=0).values
+
+        # Share memory with the workers
+        self.shard_min.share_memory_()
+        self.min_potentials.share_memory_()
+        for cloud_potentials in self.potentials:
+            cloud_potentials.share_memory_()
+        self.locks = [multiprocessing.Lock() for _ in range(self.num_shards)]
+
+        return
+
+    def shard(self, worker_id):
+        """Shard where a worker draws its next sphere: its own one, unless another shard is too far behind"""
+        mins = torch.min(self.shard_min, dim=1).values
+        late = int(torch.argmin(mins))
+        if worker_id is None:
+            return late
+        own = worker_id % self.num_shards
+        if float(mins[own] - mins[late]) > self.rebalance_margin:
+            return late
+        return own
+
+    def argmin(self, shard):
+        """Cloud and point of minimal potential in a shard (call with the shard lock)"""
+        cloud_ind = int(torch.argmin(self.shard_min[shard]))
+        local_ind, _ = self.trees[shard][cloud_ind].argmin()
+        return cloud_ind, int(self.shard_points[shard][cloud_ind][local_ind])
+
+    def add(self, shard, cloud_ind, inds, increments):
+        """Adds increments to the potentials of the points inds owned by the shard (call with the shard lock)"""
+
+        owned = self.owners[cloud_ind][inds] == shard
+        inds = inds[owned]
+        increments = increments[owned]
+        tree = self.trees[shard][cloud_ind]
+        tree.add(self.local_inds[cloud_ind][inds], increments)
+        self.potentials[cloud_ind].numpy()[inds] += increments
+
+        # Minimums read by the other workers (and by the tester for the cloud)
+        self.shard_min[shard, cloud_ind] = tree.argmin()[1]
+        self.min_potentials[cloud_ind] = torch.min(self.shard_min[:, cloud_ind])
+
+        return
+
+
+class GridAccumulator:
+    """
+    Grid subsampling of a cloud fed by chunks, for clouds too large to be read at once. Each chunk is reduced to its
+    voxels (point counts and sums, label counts, or the best representative point so far) and these partial voxels are
+    merged as they pile up, so the memory held is in the order of the subsampled cloud. The grid is fixed by the
+    bounds of the whole cloud, given in advance (e.g. by a file header), and the voxels are the same as with
+    grid_subsampling, in the same order. Barycenters are accumulated in double precision.
+    """
+
+    def __init__(self, min_corner, max_corner, sampleDl, method='barycenters', seed=0, return_inverse=False):
+        """
+        :param min_corner: (3,) lower bounds of the whole cloud
+        :param max_corner: (3,) upper bounds of the whole cloud
+        :param sampleDl: parameter defining the size of grid voxels
+        :param method: 'barycenters', 'first', 'random' or 'center' (see grid_subsampling). The 'random' choice is
+                       drawn from the seed and the index of the points, and differs from the one of grid_subsampling
+        :param seed: seed of the 'random' method
+        :param return_inverse: if True, result also returns the index of the subsampled point of each input point
+        """
+
+        if method not in ['barycenters', 'first', 'random', 'center']:
+            raise ValueError('Unknown subsampling method: ' + method)
+
+        self.method = method
+        self.seed = seed
+        self.return_inverse = return_inverse
+
+        # Grid computed in single precision like grid_subsampling, which then finds the same voxels
+        self.dl = np.float32(sampleDl)
+        min_corner = np.asarray(min_corner).astype(np.float32)
+        max_corner = np.asarray(max_corner).astype(np.float32)
+        self.origin = np.floor(min_corner * (np.float32(1) / self.dl)) * self.dl
+        self.dims = np.floor((max_corner - self.origin) / self.dl).astype(np.int64) + 1
+        self.num_points = 0
 
+        # Merged voxels, partial voxels of the last chunks, and voxel keys of each chunk for the inverse indices
+        self.voxels = None
+        self.parts = []
+        self.chunk_keys = []
+        self.chunk_inverse = []
 
+        return
+
+    def voxel_keys(self, points):
+        """Key of the voxel of each point (x first, then y and z, as in grid_subsampling)"""
+        inds = np.floor((points - self.origin) / self.dl).astype(np.int64)
+        inds = np.clip(inds, 0, self.dims - 1)
+        return inds[:, 0] + self.dims[0] * (inds[:, 1] + self.dims[1] * inds[:, 2])
+
+    def add(self, points, features=None, labels=None):
+        """
+        Adds a chunk of points (the features and labels of all the chunks must have the same dimensions)
+        :param points: (n, 3) matrix of points
+        :param features: optional (n, d) matrix of features
+        :param labels: optional (n,) or (n, l) matrix of integer labels
+        """
+
+        points = np.asarray(points, dtype=np.float32)
+        if features is not None:
+            features = np.asarray(features, dtype=np.float32).reshape(len(points), -1)
+        if labels is not None:
+            labels = np.asarray(labels, dtype=np.int32).reshape(len(points), -1)
+
+        # Voxels of the chunk
+        keys = self.voxel_keys(points)
+        unique_keys, inverse, counts = np.unique(keys, return_inverse=True, return_counts=True)
+        if self.return_inverse:
+            self.chunk_keys += [unique_keys]
+            self.chunk_inverse += [inverse.astype(np.int32)]
+
+        if self.method == 'barycenters':
+            part = {'keys': unique_keys,
+                    'counts': counts,
+                    'points': self.voxel_sums(inverse, len(unique_keys), points),
+                    'features': None if features is None else self.voxel_sums(inverse, len(unique_keys), features),
+                    'labels': None if labels is None else [self.label_counts(keys, l) for l in labels.T]}
+        else:
+            part = self.representatives(keys, self.point_scores(points, keys), points, features, labels)
+
+        self.num_points += len(points)
+        self.parts += [part]
+
+        # Merging when the partial voxels outnumber the merged ones keeps the total merge cost linear
+        if sum(len(p['keys']) for p in self.parts) > (0 if self.voxels is None else len(self.voxels['keys'])):
+            self.merge()
+
+        return
+
+    @staticmethod
+    def voxel_sums(inverse, n_voxels, values):
+        """Sums of the columns of values in each voxel (double precision)"""
+        return np.stack([np.bincount(inverse, weights=col, minlength=n_voxels) for col in values.T], axis=1)
+
+    @staticmethod
+    def label_counts(keys, labels, counts=None):
+        """Number of points (or sum of counts) of each (voxel, label) pair, sorted by voxel key then label"""
+        order = np.lexsort((labels, keys))
+        keys, labels = keys[order], labels[order]
+        counts = np.ones(len(keys), dtype=np.int64) if counts is None else counts[order]
+        first = np.flatnonzero(np.concatenate(([True], (keys[1:] != keys[:-1]) | (labels[1:] != labels[:-1]))))
+        return keys[first], labels[first], np.add.reduceat(counts, first) if len(first) > 0 else counts
+
+    def point_scores(self, points, keys):
+        """Score of the points of a chunk, the representative of a voxel being its point of lowest score"""
+
+        if self.method == 'first':
+            return np.arange(self.num_points, self.num_points + len(points), dtype=np.float64)
+
+        if self.method == 'center':
+            ix = keys % self.dims[0]
+            iy = (keys // self.dims[0]) % self.dims[1]
+            iz = keys // (self.dims[0] * self.dims[1])
+            centers = self.origin + (np.stack((ix, iy, iz), axis=1).astype(np.float32) + np.float32(0.5)) * self.dl
+            return np.sum(np.square(points - centers), axis=1).astype(np.float64)
+
+        # Random: splitmix64 hash of the seed and of the point index
+        x = np.arange(self.num_points, self.num_points + len(points), dtype=np.uint64)
+        x += np.uint64(self.seed) * np.uint64(0x9E3779B97F4A7C15)
+        x = (x ^ (x >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+        x = (x ^ (x >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+        return (x ^ (x >> np.uint64(31))).astype(np.float64)
+
+    @staticmethod
+    def representatives(keys, scores, points, features, labels):
+        """Point of lowest score in each voxel, with its features and labels"""
+        order = np.lexsort((scores, keys))
+        first = order[np.flatnonzero(np.concatenate(([True], keys[order[1:]] != keys[order[:-1]])))]
+        return {'keys': keys[first],
+                'scores': scores[first],
+                'points': points[first],
+                'features': None if features is None else features[first],
+                'labels': None if labels is None else labels[first]}
+
+    def merge(self):
+        """Merges the partial voxels of the last chunks with the merged voxels"""
+
+        if not self.parts:
+            return
+        parts = self.parts if self.voxels is None else [self.voxels] + self.parts
+        self.parts = []
+        keys = np.concatenate([p['keys'] for p in parts])
+        concat = lambda name: None if parts[0][name] is None else np.concatenate([p[name] for p in parts])
+
+        if self.method != 'barycenters':
+            self.voxels = self.representatives(keys, concat('scores'), concat('points'), concat('features'),
+                                               concat('labels'))
+            return
+
+        unique_keys, inverse = np.unique(keys, return_inverse=True)
+        self.voxels = {'keys': unique_keys,
+                       'counts': np.bincount(inverse, weights=concat('counts'), minlength=len(unique_keys)),
+                       'points': self.voxel_sums(inverse, len(unique_keys), concat('points')),
+                       'features': None}
+        if parts[0]['features'] is not None:
+            self.voxels['features'] = self.voxel_sums(inverse, len(unique_keys), concat('features'))
+        self.voxels['labels'] = None
+        if parts[0]['labels'] is not None:
+            self.voxels['labels'] = []
+            for l in range(len(parts[0]['labels'])):
+                label_keys, label_values, label_counts = [np.concatenate(a) for a in zip(*[p['labels'][l]
+                                                                                           for p in parts])]
+                self.voxels['labels'] += [self.label_counts(label_keys, label_values, label_counts)]
+
+        return
 
+    def result(self):
+        """
+        :return: subsampled points, with features and/or labels depending of the input, and the (N,) int32 inverse
+                 indices last, as grid_subsampling
+        """
+
+        self.merge()
+        voxels = self.voxels
+        if voxels is None:
+            raise ValueError('No points were added to the grid')
+
+        if self.method == 'barycenters':
+            counts = voxels['counts'][:, None]
+            outputs = [(voxels['points'] / counts).astype(np.float32)]
+            if voxels['features'] is not None:
+                outputs += [(voxels['features'] / counts).astype(np.float32)]
+            if voxels['labels'] is not None:
+
+                # Most frequent label (the smallest one in case of tie)
+                voted = []
+                for label_keys, label_values, label_counts in voxels['labels']:
+                    order = np.lexsort((label_values, -label_counts, label_keys))
+                    first = order[np.flatnonzero(np.concatenate(([True], label_keys[order[1:]] !=
+                                                                         label_keys[order[:-1]])))]
+                    voted += [label_values[first]]
+                outputs += [np.stack(voted, axis=1).astype(np.int32)]
+        else:
+            outputs = [voxels['points']]
+            if voxels['features'] is not None:
+                outputs += [voxels['features']]
+            if voxels['labels'] is not None:
+                outputs += [voxels['labels']]
 
+        # Subsampled point of every input point, from the voxels of each chunk
+        if self.return_inverse:
+            inverse = [np.searchsorted(voxels['keys'], k).astype(np.int32)[inv]
+                       for k, inv in zip(self.chunk_keys, self.chunk_inverse)]
+            outputs += [np.concatenate(inverse) if inverse else np.zeros((0,), dtype=np.int32)]
 
+        return tuple(outputs) if len(outputs) > 1 else outputs[0]
 
 
+# Worker id of the threads of a ThreadedBatchLoader
+_loader_thread = threading.local()
+
+
+def input_worker_id():
+    """
+    Id of the input worker running the calling code: the DataLoader worker process or the ThreadedBatchLoader thread
+    (None in the main process)
+    """
+    info = torch.utils.data.get_worker_info()
+    if info is not None:
+        return info.id
+    return getattr(_loader_thread, 'worker_id', None)
 
 
+class ThreadedBatchLoader:
+    """
+    Thread based replacement for a DataLoader. Batches are produced by a pool of threads in the calling process, so
+    the dataset containers (trees, potentials, ...) are shared instead of being duplicated in every worker process.
+    This relies on the heavy parts of the input pipeline (cpp wrappers, KDTree queries, large numpy operations)
+    releasing the GIL.
+    """
 
+    def __init__(self, dataset, sampler, collate_fn, num_threads=8, prefetch=2, pin_memory=False):
+        """
+        :param dataset: the dataset producing one batch per index (as used with a batch_size=1 DataLoader)
+        :param sampler: the sampler yielding the indices of an epoch
+        :param collate_fn: function creating the custom batch from a list with one input list
+        :param num_threads: number of threads building batches at the same time
+        :param prefetch: number of batches prepared in advance by each thread
+        :param pin_memory: pin the memory of the batches (requires a pin_memory method on the custom batch)
+        """
 
+        self.dataset = dataset
+        self.sampler = sampler
+        self.collate_fn = collate_fn
+        self.num_threads = max(1, num_threads)
+        self.prefetch = max(1, prefetch)
+        self.pin_memory = pin_memory and torch.cuda.is_available()
 
+        return
 
+    def __len__(self):
+        return len(self.sampler)
+
+    def load_batch(self, batch_i):
+        batch = self.collate_fn([self.dataset[batch_i]])
+        if self.pin_memory:
+            batch = batch.pin_memory()
+        return batch
+
+    @staticmethod
+    def init_thread(worker_ids):
+        """Gives each thread of the pool its own worker id, as the DataLoader workers have (e.g. for the shards)"""
+        _loader_thread.worker_id = next(worker_ids)
+
+    def __iter__(self):
+
+        executor = ThreadPoolExecutor(max_workers=self.num_threads, initializer=self.init_thread,
+                                      initargs=(itertools.count(),))
+        pending = deque()
+        try:
+            for batch_i in self.sampler:
+                pending.append(executor.submit(self.load_batch, batch_i))
+                if len(pending) >= self.num_threads * self.prefetch:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+
+        finally:
+            # Batches that were not started are cancelled (loop broken by the caller), the running ones are waited for
+            # so that no thread still updates the dataset potentials afterwards
+            executor.shutdown(wait=True, cancel_futures=True)
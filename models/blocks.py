@@ -36,11 +36,15 @@ def gather(x, idx, method=2):
     """
     implementation of a custom gather operation for faster backwards.
     :param x: input with shape [N, D_1, ... D_d]
-    :param idx: indexing with shape [n_1, ..., n_m]
+    :param idx: indexing with shape [n_1, ..., n_m] (int32 or int64)
     :param method: Choice of the method
     :return: x[idx] with shape [n_1, ..., n_m, D_1, ... D_d]
     """
 
+    # torch.gather only takes int64 indices, int32 ones are widened here (on the device, after the transfer)
+    if method > 0:
+        idx = idx.long()
+
     if method == 0:
         return x[idx]
     elif method == 1:
@@ -80,13 +84,17 @@ def closest_pool(x, inds):
     """
     Pools features from the closest neighbors. WARNING: this function assumes the neighbors are ordered.
     :param x: [n1, d] features matrix
-    :param inds: [n2, max_num] Only the first column is used for pooling
+    :param inds: [n2, max_num] Only the first column is used for pooling (or RaggedNeighbors)
     :return: [n2, d] pooled features matrix
     """
 
     # Add a last row with minimum features for shadow pools
     x = torch.cat((x, torch.zeros_like(x[:1, :])), 0)
 
+    # First neighbor of each segment for ragged neighbors
+    if not isinstance(inds, torch.Tensor):
+        return gather(x, inds.closest(x.shape[0] - 1))
+
     # Get features for each pooling location [n2, d]
     return gather(x, inds[:, 0])
 
@@ -95,10 +103,20 @@ def max_pool(x, inds):
     """
     Pools features with the maximum values.
     :param x: [n1, d] features matrix
-    :param inds: [n2, max_num] pooling indices
+    :param inds: [n2, max_num] pooling indices (or RaggedNeighbors)
     :return: [n2, d] pooled features matrix
     """
 
+    # Maximum over the segment of each location for ragged neighbors. As in the dense format, where every row shorter
+    # than the longest one is padded with the zero shadow row, these locations also pool a zero
+    if not isinstance(inds, torch.Tensor):
+        counts = inds.counts()
+        max_features = torch.segment_reduce(gather(x, inds.indices), 'max', offsets=inds.offsets, axis=0)
+        if counts.shape[0] == 0:
+            return max_features
+        padded = (counts == 0) | (counts < torch.max(counts))
+        return torch.where(padded.unsqueeze(1), torch.clamp(max_features, min=0), max_features)
+
     # Add a last row with minimum features for shadow pools
     x = torch.cat((x, torch.zeros_like(x[:1, :])), 0)
 
@@ -273,6 +291,10 @@ class KPConv(nn.Module):
         # Deformed convolution
         ######################
 
+        # Neighbors in CSR format are aggregated by segments, without shadow neighbors
+        if not isinstance(neighb_inds, torch.Tensor):
+            return self.ragged_forward(q_pts, s_pts, neighb_inds, x, offsets, modulations)
+
         # Add a fake point in the last row for shadow neighbors
         s_pts = torch.cat((s_pts, torch.zeros_like(s_pts[:1, :]) + 1e6), 0)
 
@@ -321,56 +343,126 @@ class KPConv(nn.Module):
 
             # New shadow neighbors have to point to the last shadow point
             new_neighb_inds *= neighb_row_bool
-            new_neighb_inds -= (neighb_row_bool.type(torch.int64) - 1) * int(s_pts.shape[0] - 1)
+            new_neighb_inds -= (neighb_row_bool.type(new_neighb_inds.dtype) - 1) * int(s_pts.shape[0] - 1)
         else:
             new_neighb_inds = neighb_inds
 
         # Get Kernel point influences [n_points, n_kpoints, n_neighbors]
+        all_weights = torch.transpose(self.kernel_influences(sq_distances), 1, 2)
+
+        # Add a zero feature for shadow neighbors
+        x = torch.cat((x, torch.zeros_like(x[:1, :])), 0)
+
+        # Get the features of each neighborhood [n_points, n_neighbors, in_fdim]
+        neighb_x = gather(x, new_neighb_inds)
+
+        # Apply distance weights [n_points, n_kpoints, in_fdim]
+        weighted_features = torch.matmul(all_weights, neighb_x)
+
+        # Apply modulations
+        if self.deformable and self.modulated:
+            weighted_features *= modulations.unsqueeze(2)
+
+        # Apply network weights [n_kpoints, n_points, out_fdim]
+        weighted_features = weighted_features.permute((1, 0, 2))
+        kernel_outputs = torch.matmul(weighted_features, self.weights)
+
+        # Convolution sum [n_points, out_fdim]
+        return torch.sum(kernel_outputs, dim=0)
+
+    def ragged_forward(self, q_pts, s_pts, neighbors, x, offsets, modulations):
+        """
+        Deformed convolution with neighbors in CSR format (RaggedNeighbors). Each neighbor is an edge between a query
+        and a support point, and the weighted features of the edges are summed over the segment of each query.
+        """
+
+        # Get the neighbors centered on their query [n_edges, dim]
+        inds = neighbors.indices
+        rows = neighbors.rows
+        seg_offsets = neighbors.offsets
+        edges = s_pts[inds, :] - q_pts[rows, :]
+
+        # Apply offsets to kernel points [n_edges, n_kpoints, dim]
+        if self.deformable:
+            self.deformed_KP = offsets + self.kernel_points
+            deformed_K_points = self.deformed_KP[rows]
+        else:
+            deformed_K_points = self.kernel_points
+
+        # Get the square distances [n_edges, n_kpoints]
+        differences = edges.unsqueeze(1) - deformed_K_points
+        sq_distances = torch.sum(differences ** 2, dim=2)
+
+        # Optimization by ignoring points outside a deformed KP range
+        if self.deformable:
+
+            # Save distances for loss (queries without neighbors do not contribute)
+            min_d2 = torch.segment_reduce(sq_distances, 'min', offsets=seg_offsets, axis=0)
+            self.min_d2 = min_d2.masked_fill((neighbors.counts() == 0).unsqueeze(1), 0)
+
+            # Only keep the edges in range of a kernel point
+            in_range = torch.any(sq_distances < self.KP_extent ** 2, dim=1)
+            inds = inds[in_range]
+            rows = rows[in_range]
+            sq_distances = sq_distances[in_range]
+            new_counts = torch.bincount(rows, minlength=neighbors.num_queries)
+            seg_offsets = torch.cat((seg_offsets[:1], torch.cumsum(new_counts, dim=0)))
+
+        # Get Kernel point influences [n_edges, n_kpoints]
+        all_weights = self.kernel_influences(sq_distances)
+
+        # Get the features of each neighbor [n_edges, in_fdim]
+        neighb_x = gather(x, inds)
+
+        # Apply distance weights and sum them over each neighborhood [n_points, n_kpoints, in_fdim]. Kernel points
+        # are handled one at a time to avoid a [n_edges, n_kpoints, in_fdim] tensor
+        weighted_features = [torch.segment_reduce(all_weights[:, k:k + 1] * neighb_x, 'sum',
+                                                  offsets=seg_offsets, axis=0)
+                             for k in range(self.K)]
+        weighted_features = torch.stack(weighted_features, dim=1)
+
+        # Apply modulations
+        if self.deformable and self.modulated:
+            weighted_features *= modulations.unsqueeze(2)
+
+        # Apply network weights [n_kpoints, n_points, out_fdim]
+        weighted_features = weighted_features.permute((1, 0, 2))
+        kernel_outputs = torch.matmul(weighted_features, self.weights)
+
+        # Convolution sum [n_points, out_fdim]
+        return torch.sum(kernel_outputs, dim=0)
+
+    def kernel_influences(self, sq_distances):
+        """
+        Influence of each kernel point on each neighbor.
+        :param sq_distances: [..., n_kpoints] square distances between neighbors and kernel points
+        :return: [..., n_kpoints] influences
+        """
+
         if self.KP_influence == 'constant':
             # Every point get an influence of 1.
             all_weights = torch.ones_like(sq_distances)
-            all_weights = torch.transpose(all_weights, 1, 2)
 
         elif self.KP_influence == 'linear':
             # Influence decrease linearly with the distance, and get to zero when d = KP_extent.
             all_weights = torch.clamp(1 - torch.sqrt(sq_distances) / self.KP_extent, min=0.0)
-            all_weights = torch.transpose(all_weights, 1, 2)
 
         elif self.KP_influence == 'gaussian':
             # Influence in gaussian of the distance.
             sigma = self.KP_extent * 0.3
             all_weights = radius_gaussian(sq_distances, sigma)
-            all_weights = torch.transpose(all_weights, 1, 2)
         else:
             raise ValueError('Unknown influence function type (config.KP_influence)')
 
         # In case of closest mode, only the closest KP can influence each point
         if self.aggregation_mode == 'closest':
-            neighbors_1nn = torch.argmin(sq_distances, dim=2)
-            all_weights *= torch.transpose(nn.functional.one_hot(neighbors_1nn, self.K), 1, 2)
+            neighbors_1nn = torch.argmin(sq_distances, dim=-1)
+            all_weights = all_weights * nn.functional.one_hot(neighbors_1nn, self.K)
 
         elif self.aggregation_mode != 'sum':
             raise ValueError("Unknown convolution mode. Should be 'closest' or 'sum'")
 
-        # Add a zero feature for shadow neighbors
-        x = torch.cat((x, torch.zeros_like(x[:1, :])), 0)
-
-        # Get the features of each neighborhood [n_points, n_neighbors, in_fdim]
-        neighb_x = gather(x, new_neighb_inds)
-
-        # Apply distance weights [n_points, n_kpoints, in_fdim]
-        weighted_features = torch.matmul(all_weights, neighb_x)
-
-        # Apply modulations
-        if self.deformable and self.modulated:
-            weighted_features *= modulations.unsqueeze(2)
-
-        # Apply network weights [n_kpoints, n_points, out_fdim]
-        weighted_features = weighted_features.permute((1, 0, 2))
-        kernel_outputs = torch.matmul(weighted_features, self.weights)
-
-        # Convolution sum [n_points, out_fdim]
-        return torch.sum(kernel_outputs, dim=0)
+        return all_weights
 
     def __repr__(self):
         return 'KPConv(radius: {:.2f}, in_feat: {:d}, out_feat: {:d})'.format(self.radius,
@@ -8,6 +8,7 @@ from torch.utils.data import DataLoader
 
 
 from datasets.LAS import *
+from datasets.common import ThreadedBatchLoader
 from models.architectures import KPFCNN
 from utils.config import Config
 from utils.trainer import ModelTrainer
@@ -265,22 +266,39 @@ if __name__ == "__main__":
     test_sampler = LASSampler(test_dataset)
 
     # Initialize the dataloader
-    training_loader = DataLoader(
-        training_dataset,
-        batch_size=1,
-        sampler=training_sampler,
-        collate_fn=LASCollate,
-        num_workers=config.input_threads,
-        pin_memory=True
-    )
-    test_loader = DataLoader(
-        test_dataset,
-        batch_size=1,
-        sampler=test_sampler,
-        collate_fn=LASCollate,
-        num_workers=config.input_threads,
-        pin_memory=True
-    )
+    if config.input_pipeline == "threads":
+        # Batches built by threads sharing the dataset memory
+        training_loader = ThreadedBatchLoader(
+            training_dataset,
+            training_sampler,
+            LASCollate,
+            num_threads=config.input_threads,
+            pin_memory=True
+        )
+        test_loader = ThreadedBatchLoader(
+            test_dataset,
+            test_sampler,
+            LASCollate,
+            num_threads=config.input_threads,
+            pin_memory=True
+        )
+    else:
+        training_loader = DataLoader(
+            training_dataset,
+            batch_size=1,
+            sampler=training_sampler,
+            collate_fn=LASCollate,
+            num_workers=config.input_threads,
+            pin_memory=True
+        )
+        test_loader = DataLoader(
+            test_dataset,
+            batch_size=1,
+            sampler=test_sampler,
+            collate_fn=LASCollate,
+            num_workers=config.input_threads,
+            pin_memory=True
+        )
 
     # Calibrate samplers
     training_sampler.calibration(training_loader, verbose=True)
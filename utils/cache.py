@@ -0,0 +1,158 @@
+#
+#
+#      0=================================0
+#      |    Kernel Point Convolutions    |
+#      0=================================0
+#
+#
+# ----------------------------------------------------------------------------------------------------------------------
+#
+#      Manifest of the preprocessing caches
+#
+# ----------------------------------------------------------------------------------------------------------------------
+#
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+#
+#           Imports and global variables
+#       \**********************************/
+#
+
+
+# Basic libs
+import os
+import json
+import time
+import hashlib
+
+
+# Version of the preprocessing code. Increase it when a change of the preprocessing alters the cached artifacts, they
+# are then all prepared again
+CACHE_VERSION = 3
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+#
+#           Utility functions
+#       \***********************/
+#
+
+
+def source_stat(file_path):
+    """Size and modification time of a source file, compared to detect changes"""
+    stat = os.stat(file_path)
+    return {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+
+def source_hash(file_path, block_size=1 << 24):
+    """SHA-1 of the content of a source file, read by blocks"""
+    sha1 = hashlib.sha1()
+    with open(file_path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            sha1.update(block)
+    return sha1.hexdigest()
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+#
+#           Class definition
+#       \**********************/
+#
+
+
+class CacheManifest:
+    """
+    Manifest of the artifacts of a cache folder, saved as manifest.json in the folder. Each artifact is recorded with
+    the path, size and modification time of its source files (and optionally the hash of their content), the
+    parameters it was prepared with and the version of the preprocessing code. An artifact is valid only if all of
+    them are unchanged, so that only the clouds whose source or parameters changed are prepared again.
+    """
+
+    def __init__(self, folder, content_hash=False):
+        """
+        :param folder: cache folder
+        :param content_hash: also record the SHA-1 of the sources. A source whose modification time changed but not
+                             its content (copied or touched file) then keeps its artifacts
+        """
+
+        self.path = os.path.join(folder, 'manifest.json')
+        self.content_hash = content_hash
+        self.artifacts = {}
+        if os.path.isfile(self.path):
+            with open(self.path, 'r') as f:
+                self.artifacts = json.load(f)['artifacts']
+
+        return
+
+    @staticmethod
+    def normalize(params):
+        """Parameters as they are read back from the json file (tuples become lists)"""
+        return json.loads(json.dumps(params, sort_keys=True))
+
+    @staticmethod
+    def source_paths(source):
+        """Absolute paths of the source files of an artifact (a single path or a list of paths)"""
+        if isinstance(source, str):
+            source = [source]
+        return [os.path.abspath(file_path) for file_path in source]
+
+    def is_valid(self, name, source, params):
+        """
+        :param name: name of the artifact
+        :param source: path of its source file, or list of paths
+        :param params: dict of the parameters of its preparation
+        :return: True if the artifact was recorded with the same sources, parameters and code version
+        """
+
+        entry = self.artifacts.get(name)
+        if entry is None or entry['code'] != CACHE_VERSION or entry['params'] != self.normalize(params):
+            return False
+
+        # Same source files (artifacts of the same name may come from another split)
+        paths = self.source_paths(source)
+        if [file_entry['path'] for file_entry in entry['sources']] != paths:
+            return False
+
+        for file_entry, file_path in zip(entry['sources'], paths):
+
+            # Unchanged source file
+            stat = source_stat(file_path)
+            if file_entry['stat'] == stat:
+                continue
+
+            # Touched but unmodified source file
+            if self.content_hash and file_entry.get('sha1') == source_hash(file_path):
+                file_entry['stat'] = stat
+                continue
+
+            return False
+
+        return True
+
+    def record(self, name, source, params):
+        """Records an artifact after its preparation (saved with save)"""
+
+        sources = []
+        for file_path in self.source_paths(source):
+            file_entry = {'path': file_path, 'stat': source_stat(file_path)}
+            if self.content_hash:
+                file_entry['sha1'] = source_hash(file_path)
+            sources += [file_entry]
+
+        self.artifacts[name] = {'sources': sources,
+                                'params': self.normalize(params),
+                                'code': CACHE_VERSION,
+                                'date': time.strftime('%Y-%m-%d %H:%M:%S')}
+
+        return
+
+    def save(self):
+        """Writes the manifest (under a temporary name first, so that it is never left truncated)"""
+
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({'version': CACHE_VERSION, 'artifacts': self.artifacts}, f, indent=2, sort_keys=True)
+        os.replace(tmp_path, self.path)
+
+        return
@@ -61,6 +61,49 @@ class Config:
     # Number of CPU threads for the input pipeline
     input_threads = 8
 
+    # Number of threads used by each input worker for the radius neighbors queries (0 for all the available cores)
+    neighbors_threads = 1
+
+    # Number of threads used for the subsampling of the input clouds when preparing a dataset (0 for all the cores)
+    subsampling_threads = 0
+
+    # Number of processes preparing the clouds missing from the cache of a dataset (0 for all the available cores)
+    preprocessing_workers = 1
+
+    # Also record the SHA-1 of the source files in the cache manifests, so that files touched or copied without being
+    # modified do not invalidate their preprocessed clouds (reads each changed source file once more)
+    cache_content_hash = False
+
+    # Number of points read at once from the LAS/LAZ files when preparing a dataset. The files are subsampled chunk by
+    # chunk, which bounds the memory by the size of the subsampled clouds (0 to read whole files)
+    ingest_chunk_points = 5000000
+
+    # Input pipeline workers: 'processes' (DataLoader workers) or 'threads' (pool of threads in the main process)
+    input_pipeline = 'processes'
+
+    # Partition the potentials in spatial tiles across the input workers, which then draw their spheres without a
+    # global lock (scene datasets with potentials)
+    sharded_potentials = False
+
+    # Maximum number of sphere centers drawn from the potentials per lock acquisition. Their input points are then
+    # gathered with one radius query per cloud (scene datasets with potentials)
+    centers_per_draw = 1
+
+    # Neighbors format: 'dense' (padded matrices) or 'ragged' (CSR offsets and indices, segmentation datasets only)
+    neighbors_format = 'dense'
+
+    # Neighbors search engine: 'kdtree' (nanoflann) or 'grid' (voxel hash grid, faster on dense uniform clouds)
+    neighbors_backend = 'kdtree'
+
+    # Type of the neighbors, pooling and upsampling indices: 'int64' or 'int32' (half the memory and transfers, the
+    # indices are only widened on the device where torch needs int64)
+    neighbors_dtype = 'int64'
+
+    # Subsampled points of the input clouds (LAS) and of the pooling layers: 'barycenters' (mean points, features and
+    # voted labels) or one representative point per voxel, 'first', 'random' or 'center' (closest to the voxel center)
+    subsampling_method = 'barycenters'
+    pooling_method = 'barycenters'
+
     ##################
     # Model parameters
     ##################
@@ -297,7 +340,20 @@ class Config:
             text_file.write('in_points_dim = {:d}\n'.format(self.in_points_dim))
             text_file.write('in_features_dim = {:d}\n'.format(self.in_features_dim))
             text_file.write('in_radius = {:.6f}\n'.format(self.in_radius))
-            text_file.write('input_threads = {:d}\n\n'.format(self.input_threads))
+            text_file.write('input_threads = {:d}\n'.format(self.input_threads))
+            text_file.write('neighbors_threads = {:d}\n'.format(self.neighbors_threads))
+            text_file.write('subsampling_threads = {:d}\n'.format(self.subsampling_threads))
+            text_file.write('preprocessing_workers = {:d}\n'.format(self.preprocessing_workers))
+            text_file.write('cache_content_hash = {:d}\n'.format(int(self.cache_content_hash)))
+            text_file.write('ingest_chunk_points = {:d}\n'.format(self.ingest_chunk_points))
+            text_file.write('input_pipeline = {:s}\n'.format(self.input_pipeline))
+            text_file.write('sharded_potentials = {:d}\n'.format(int(self.sharded_potentials)))
+            text_file.write('centers_per_draw = {:d}\n'.format(self.centers_per_draw))
+            text_file.write('neighbors_format = {:s}\n'.format(self.neighbors_format))
+            text_file.write('neighbors_backend = {:s}\n'.format(self.neighbors_backend))
+            text_file.write('neighbors_dtype = {:s}\n'.format(self.neighbors_dtype))
+            text_file.write('subsampling_method = {:s}\n'.format(self.subsampling_method))
+            text_file.write('pooling_method = {:s}\n\n'.format(self.pooling_method))
 
             # Model parameters
             text_file.write('# Model parameters\n')
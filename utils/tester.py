@@ -328,7 +328,7 @@ class ModelTester:
                         preds = test_loader.dataset.label_values[np.argmax(probs, axis=1)].astype(np.int32)
 
                         # Targets
-                        targets = test_loader.dataset.input_labels[i]
+                        targets = test_loader.dataset.input_labels[i].astype(np.int32)
 
                         # Confs
                         Confs += [fast_confusion(targets, preds, test_loader.dataset.label_values)]
@@ -440,10 +440,12 @@ class ModelTester:
 
                         # Save potentials
                         pot_points = np.array(test_loader.dataset.pot_trees[i].data, copy=False)
+                        # Back in the frame of the original points (double precision)
+                        pot_points = pot_points + test_loader.dataset.cloud_origin(i)
                         pot_name = join(test_path, 'potentials', cloud_name)
                         pots = test_loader.dataset.potentials[i].numpy().astype(np.float32)
                         write_ply(pot_name,
-                                  [pot_points.astype(np.float32), pots],
+                                  [pot_points, pots],
                                   ['x', 'y', 'z', 'pots'])
 
                         # Save ascii preds
@@ -592,11 +592,13 @@ class ModelTrainer:
                 files = val_loader.dataset.files
                 for i, file_path in enumerate(files):
                     pot_points = np.array(val_loader.dataset.pot_trees[i].data, copy=False)
+                    # Back in the frame of the original points (double precision)
+                    pot_points = pot_points + val_loader.dataset.cloud_origin(i)
                     cloud_name = os.path.basename(file_path)[:-4]
                     pot_name = join(pot_path, cloud_name)
                     pots = val_loader.dataset.potentials[i].numpy().astype(np.float32)
                     write_ply(pot_name,
-                            [pot_points.astype(np.float32), pots],
+                            [pot_points, pots],
                             ['x', 'y', 'z', 'pots'])
 
         t6 = time.time()